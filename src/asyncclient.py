@@ -0,0 +1,108 @@
+from couchdbkit import client
+from restkit.conn import Connection
+from socketpool import ConnectionPool
+import connpool
+
+try:
+    import gevent
+    from gevent.pool import Pool
+except ImportError:
+    gevent = None
+
+
+# asynchronous access to couchdb for the load suites. python 2 has no asyncio
+# so this is built on gevent: requests go through restkit's gevent backend,
+# whose sockets yield to other greenlets while waiting, and every call below
+# returns a greenlet (greenlet.get() waits for the result). a bounded pool
+# caps the requests in flight, each one costs a greenlet instead of an OS
+# thread so one process can keep thousands open.
+#
+# requests made from inside a greenlet should use the blocking couchdbkit
+# objects (AsyncDatabase.sync, AsyncServer.sync), they are cooperative too
+# and waiting on the pool from inside the pool can deadlock it.
+class AsyncServer(object):
+    def __init__(self, uri, concurrency=1000, pool_size=None):
+        if gevent is None:
+            raise ImportError("the async client needs gevent")
+        self._requests = Pool(concurrency)
+        connections = ConnectionPool(factory=Connection, backend="gevent", max_size=pool_size or concurrency)
+        # the same resource class as connpool, so async requests are counted
+        # per node and their latency goes to stats.operations like any other
+        uri = uri.rstrip("/")
+        res = connpool.PooledResource(uri, backend="gevent", pool=connections)
+        self.sync = client.Server(uri, full_commit=False, resource_instance=res)
+
+    def __getitem__(self, dbname):
+        return AsyncDatabase(self, self.sync[dbname])
+
+    def get_or_create_db(self, dbname):
+        return AsyncDatabase(self, self.sync.get_or_create_db(dbname))
+
+    # runs fn(*args) in the request pool, waits for a free slot when all of
+    # them are busy
+    def spawn(self, fn, *args, **kwargs):
+        return self._requests.spawn(fn, *args, **kwargs)
+
+    # runs a workload outside the request pool, e.g. one simulated user
+    # which issues its own requests
+    def start_actor(self, fn, *args, **kwargs):
+        return gevent.spawn(fn, *args, **kwargs)
+
+    # waits for all greenlets and returns their values, raises the first error
+    @staticmethod
+    def wait(greenlets):
+        gevent.joinall(greenlets, raise_error=True)
+        return [greenlet.value for greenlet in greenlets]
+
+    # waits until every request spawned so far is done
+    def join(self):
+        self._requests.join()
+
+    def replicate(self, source, target, **params):
+        return self.spawn(self.sync.replicate, source, target, **params)
+
+    def active_tasks(self):
+        return self.spawn(self.sync.active_tasks)
+
+    def login(self, name, password):
+        return self.spawn(self._session, "POST", payload={"name": name, "password": password})
+
+    def logout(self):
+        return self.spawn(self._session, "DELETE")
+
+    def _session(self, method, payload=None):
+        return self.sync.res.request(method, "/_session", payload=payload,
+                                     headers={"Content-Type": "application/json",
+                                              "X-CouchDB-WWW-Authenticate": "Cookie"}).json_body
+
+
+class AsyncDatabase(object):
+    def __init__(self, server, db):
+        self._server = server
+        self.sync = db
+        self.dbname = db.dbname
+
+    def get(self, docid, **params):
+        return self._server.spawn(self.sync.get, docid, **params)
+
+    def save_doc(self, doc, **params):
+        return self._server.spawn(self.sync.save_doc, doc, **params)
+
+    def bulk_save(self, docs, **params):
+        return self._server.spawn(self.sync.bulk_save, docs, **params)
+
+    # view results are fetched inside the greenlet, not when first iterated
+    def view(self, view_name, **params):
+        return self._server.spawn(self._fetch, self.sync.view, view_name, **params)
+
+    def all_docs(self, **params):
+        return self._server.spawn(self._fetch, self.sync.all_docs, **params)
+
+    def put_attachment(self, doc, content, name=None, content_type=None, **params):
+        return self._server.spawn(self.sync.put_attachment, doc, content, name, content_type, **params)
+
+    @staticmethod
+    def _fetch(query, *args, **params):
+        results = query(*args, **params)
+        results.fetch()
+        return results
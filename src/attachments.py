@@ -4,9 +4,11 @@ from couchdbkit.exceptions import ResourceConflict
 from nose import tools
 from nose.case import Test
 from testconfig import config
-from couchdbkit import client
 import time
 from docmaker import DocumentGenerator
+from uploader import BulkWriter
+import connpool
+import stats
 import logger
 
 log = logger.logger("CrudLongevityTests")
@@ -15,17 +17,19 @@ class AttachmentTests(unittest.TestCase):
     cleanup_dbs = []
 
     def setUp(self):
+        stats.start_test()
         self.node = config['couchdb-local']
         self.params = config["test-params"]
         self.log = log
         url = "http://{0}:{1}/".format(self.node['ip'], self.node['port'])
         self.log.info("connecting to couchdb @ {0}".format(url))
-        self.server = client.Server(url, full_commit=False)
+        self.server = connpool.server(url)
 
     def tearDown(self):
+        stats.dump_test(self.id())
         nodes = [config["couchdb-local"]]
         urls = ["http://{0}:{1}/".format(n['ip'], n['port']) for n in nodes]
-        servers = [client.Server(url, full_commit=False) for url in urls]
+        servers = [connpool.server(url) for url in urls]
         for server in servers:
             for db in server:
                 if db.dbname.find("test_suite") != -1 or db.dbname.find(
@@ -61,7 +65,6 @@ class AttachmentTests(unittest.TestCase):
         log.info("ATTCH003: add a new attachment to a document which already has an attachment")
         src_db, docs = self._get_db_and_generated_docs()
         for doc in docs:
-            src_db.save_doc(doc)
             text_attachment = u"a random text attachment-1-{0}".format(doc["_id"])
             src_db.put_attachment(doc, text_attachment, "attach003-1", "text/plain")
             file = src_db.fetch_attachment(doc, 'attach001-1')
@@ -77,7 +80,6 @@ class AttachmentTests(unittest.TestCase):
         src_db, docs = self._get_db_and_generated_docs()
 
         for doc in docs:
-            src_db.save_doc(doc)
             text_attachment = u"a random text attachment-{0}".format(doc["_id"])
             src_db.put_attachment(doc, text_attachment, "attach001", "text/plain")
             file = src_db.fetch_attachment(doc, 'attach001')
@@ -99,7 +101,6 @@ class AttachmentTests(unittest.TestCase):
         log.info("ATTCH006: delete an attachment without specifying a revision ( should fail)")
         src_db, docs = self._get_db_and_generated_docs()
         for doc in docs:
-            src_db.save_doc(doc)
             text_attachment = u"a random text attachment-{0}".format(doc["_id"])
             src_db.put_attachment(doc, text_attachment, "attach006", "text/plain")
             file = src_db.fetch_attachment(doc, 'attach006')
@@ -116,7 +117,6 @@ class AttachmentTests(unittest.TestCase):
         log.info("ATTCH007: delete an attachment by specifying the right revision")
         src_db, docs = self._get_db_and_generated_docs()
         for doc in docs:
-            src_db.save_doc(doc)
             text_attachment = u"a random text attachment-{0}".format(doc["_id"])
             src_db.put_attachment(doc, text_attachment, "attach007", "text/plain")
             file = src_db.fetch_attachment(doc, 'attach007')
@@ -128,7 +128,6 @@ class AttachmentTests(unittest.TestCase):
         log.info("#ATTCH008 : from a document with two attachments delete only one attachment")
         src_db, docs = self._get_db_and_generated_docs()
         for doc in docs:
-            src_db.save_doc(doc)
             text_attachment = u"a random text attachment-1-{0}".format(doc["_id"])
             src_db.put_attachment(doc, text_attachment, "attach008-1", "text/plain")
             file = src_db.fetch_attachment(doc, 'attach008-1')
@@ -150,14 +149,14 @@ class AttachmentTests(unittest.TestCase):
         self.server.create_db(db_name)
         src_db = self.server[db_name]
         number_of_items = 100
-        docs = DocumentGenerator.make_docs(number_of_items,
+        docs = list(DocumentGenerator.make_docs(number_of_items,
                 {"name": "user-${prefix}", "payload": "payload-${prefix}-${padding}"},
-                {"size": 1024, "seed": str(uuid.uuid4())})
+                {"size": 1024, "seed": str(uuid.uuid4())}))
+        BulkWriter(src_db).write(docs)
         return src_db, docs
 
     def _set_and_verify_attachment(self, src_db, docs, attachment_base_string, content_type, attachment_name):
         for doc in docs:
-            src_db.save_doc(doc)
             text_attachment = attachment_base_string
             if attachment_base_string != "":
                 text_attachment = u"{0}-{1}".format(attachment_base_string, doc["_id"])
@@ -0,0 +1,173 @@
+import json
+import os
+import time
+import unittest
+import uuid
+from nose import tools
+from testconfig import config
+from docmaker import DocumentGenerator
+from designs import MULTI_VIEW_DESIGN, MULTI_VIEW_QUERIES
+from uploader import BulkWriter, dedicated_db
+from pipeline import DocumentPipeline
+from stats import percentiles
+import connpool
+import stats
+import logger
+
+log = logger.logger("BenchmarkTests")
+
+# [benchmark] settings in tests.ini and their defaults
+defaults = {"runs": 3, "items": 10000, "writers": 4, "threshold": 0.2, "baseline": "benchmark-baseline.json",
+            "update_baseline": "false", "results": "benchmark-results.jsonl"}
+
+
+# runs the existing scenarios several times each and compares the median
+# throughput and p99 latency with a stored baseline. a scenario fails when its
+# throughput drops, or its p99 latency grows, by more than the threshold.
+# the first run of a scenario, or any run with update_baseline:true, stores
+# the baseline instead.
+class BenchmarkTests(unittest.TestCase):
+    cleanup_dbs = []
+
+    def setUp(self):
+        stats.start_test()
+        self.node = config['couchdb-local']
+        self.params = dict(defaults, **config.get("benchmark", {}))
+        self.items = int(self.params["items"])
+        self.log = log
+        self.server = connpool.server(self.node)
+
+    def tearDown(self):
+        stats.dump_test(self.id())
+        servers = [self.server, connpool.server(config['couchdb-remote-1'])]
+        for db in self.cleanup_dbs:
+            for server in servers:
+                try:
+                    server.delete_db(db)
+                except Exception:
+                    pass
+        self.cleanup_dbs = []
+
+    def _get_db_name(self):
+        name = "doctests-{0}".format(str(uuid.uuid4())[:6])
+        self.cleanup_dbs.append(name)
+        return name
+
+    def _docs(self, items, type, seed):
+        return DocumentGenerator.make_docs(items, {"a": "${rand_int:0:100}", "b": "${rand_int:0:10000}",
+                                                   "c": "${uuid}", "type": type, "payload": "${padding}"},
+                                           {"size": 1024, "seed": seed})
+
+    def _load(self, db, items):
+        writer = BulkWriter(db)
+        writer.write(self._docs(items / 2, "even", "even"))
+        writer.write(self._docs(items - items / 2, "odd", "odd"))
+
+    # the documents are generated and encoded in a process pool and posted by
+    # writers threads, see pipeline.py
+    def test_bulk_load(self):
+        def run():
+            db = self.server.create_db(self._get_db_name())
+            docs = self._docs(self.items, "even", str(uuid.uuid4()))
+            saved, failed, elapsed = DocumentPipeline(docs).run(lambda: dedicated_db(db.server_uri, db.dbname),
+                                                                 int(self.params["writers"]))
+            tools.eq_(failed, [])
+            return saved, elapsed
+        self._benchmark("bulk_load", run, "bulk")
+
+    def test_view_queries(self):
+        db = self.server.create_db(self._get_db_name())
+        self._load(db, self.items)
+        db.save_doc(dict(MULTI_VIEW_DESIGN))
+        queries = MULTI_VIEW_QUERIES
+        # builds the index before anything is timed
+        db.view(queries[0][0], limit=1, reduce=False).fetch()
+
+        def run():
+            start = time.time()
+            for i in range(10):
+                for view, params in queries:
+                    db.view(view, **params).fetch()
+            return 10 * len(queries), time.time() - start
+        self._benchmark("view_queries", run, "view")
+
+    def test_replication(self):
+        source = self.server.create_db(self._get_db_name())
+        self._load(source, self.items)
+        remote = config['couchdb-remote-1']
+
+        def run():
+            target = self._get_db_name()
+            connpool.server(remote).create_db(target)
+            start = time.time()
+            self.server.replicate(connpool.node_url(self.node) + source.dbname, connpool.node_url(remote) + target)
+            return self.items, time.time() - start
+        self._benchmark("replication", run)
+
+    # the same pattern as test_revision_compaction but over items documents
+    # with three revisions each
+    def test_revision_compaction(self):
+        def run():
+            db = self.server.create_db(self._get_db_name())
+            seed = str(uuid.uuid4())
+            for revision in range(3):
+                BulkWriter(db, on_conflict="update").write(self._docs(self.items, str(revision), seed))
+            start = time.time()
+            db.compact()
+            while db.info()['compact_running']:
+                time.sleep(0.1)
+            return self.items, time.time() - start
+        self._benchmark("revision_compaction", run)
+
+    def test_attachment_round_trip(self):
+        db = self.server.create_db(self._get_db_name())
+        docs = list(self._docs(self.items / 10, "even", str(uuid.uuid4())))
+        BulkWriter(db).write(docs)
+        attachment = DocumentGenerator.create_value("attachment ", 4096)
+
+        def run():
+            start = time.time()
+            for doc in docs:
+                db.put_attachment(doc, attachment, "benchmark", "text/plain")
+                tools.eq_(db.fetch_attachment(doc, "benchmark"), attachment)
+            return len(docs) * 2, time.time() - start
+        self._benchmark("attachment_round_trip", run, "attachment_fetch")
+
+    # run() returns (operations, seconds). latency_op names the operation in
+    # stats.operations whose p99 is tracked, None to only track throughput.
+    def _benchmark(self, scenario, run, latency_op=None):
+        runs = []
+        for i in range(int(self.params["runs"])):
+            stats.operations.reset()
+            ops, elapsed = run()
+            summary = stats.operations.summary()
+            p99 = summary[latency_op]["p99"] if latency_op in summary else None
+            runs.append({"throughput": ops / max(elapsed, 0.001), "p99": p99, "seconds": elapsed})
+            self.log.info("{0} run {1}: {2:.1f} ops/sec, p99 {3}".format(scenario, i, runs[-1]["throughput"], p99))
+        result = {"throughput": percentiles([r["throughput"] for r in runs], (50,))[50],
+                  "p99": percentiles([r["p99"] for r in runs if r["p99"] is not None], (50,))[50]}
+        with open(self.params["results"], "a") as f:
+            f.write(json.dumps({"scenario": scenario, "time": time.time(), "result": result, "runs": runs}) + "\n")
+        self._compare(scenario, result)
+
+    def _compare(self, scenario, result):
+        path = self.params["baseline"]
+        baselines = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                baselines = json.load(f)
+        baseline = baselines.get(scenario)
+        if baseline is None or self.params["update_baseline"].lower() == "true":
+            baselines[scenario] = result
+            with open(path, "w") as f:
+                json.dump(baselines, f, indent=2, sort_keys=True)
+            self.log.info("stored {0} baseline {1}".format(scenario, result))
+            return
+        threshold = float(self.params["threshold"])
+        tools.ok_(result["throughput"] >= baseline["throughput"] * (1 - threshold),
+                  msg="{0} throughput regressed: {1:.1f} ops/sec, baseline {2:.1f}".format(
+                      scenario, result["throughput"], baseline["throughput"]))
+        if result["p99"] is not None and baseline.get("p99") is not None:
+            tools.ok_(result["p99"] <= baseline["p99"] * (1 + threshold),
+                      msg="{0} p99 latency regressed: {1:.4f}s, baseline {2:.4f}s".format(
+                          scenario, result["p99"], baseline["p99"]))
@@ -0,0 +1,122 @@
+import threading
+import time
+import urlparse
+from couchdbkit import client, CouchdbResource
+from restkit.conn import Connection
+from socketpool import ConnectionPool
+from testconfig import config
+import stats
+
+# one keep-alive connection pool per couchdb node, shared by every test class
+# in the process. the size comes from [connection-pool] size in tests.ini.
+
+_lock = threading.RLock()
+_pools = {}
+_servers = {}
+_stats = {}
+
+
+def pool_size():
+    return int(config.get("connection-pool", {}).get("size", 10))
+
+
+def node_url(node):
+    if isinstance(node, basestring):
+        return node
+    return "http://{0}:{1}/".format(node['ip'], node['port'])
+
+
+class NodeStats(object):
+    def __init__(self, node):
+        self.node = node
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.errors = 0
+            self.seconds = 0.0
+
+    def record(self, elapsed, error):
+        with self._lock:
+            self.requests += 1
+            self.seconds += elapsed
+            if error:
+                self.errors += 1
+
+    def to_dict(self):
+        return {"node": self.node, "requests": self.requests, "errors": self.errors, "seconds": self.seconds,
+                "pool_size": pool_size()}
+
+
+def _stats_for(netloc):
+    found = _stats.get(netloc)
+    if found is None:
+        with _lock:
+            found = _stats.setdefault(netloc, NodeStats(netloc))
+    return found
+
+
+# a CouchdbResource that counts requests, errors and time per node, and
+# records the latency of every operation in stats.operations. clones made by
+# couchdbkit for databases and documents keep the class and the pool.
+class PooledResource(CouchdbResource):
+    def request(self, method, path=None, payload=None, headers=None, **params):
+        uri = urlparse.urlparse(self.uri)
+        node = _stats_for(uri.netloc)
+        op = stats.classify(method, "{0}/{1}".format(uri.path, path or ""))
+        start = time.time()
+        try:
+            response = CouchdbResource.request(self, method, path=path, payload=payload, headers=headers, **params)
+        except Exception:
+            elapsed = time.time() - start
+            node.record(elapsed, True)
+            stats.operations.record(op, elapsed, True)
+            raise
+        elapsed = time.time() - start
+        node.record(elapsed, False)
+        stats.operations.record(op, elapsed)
+        return response
+
+
+def _pool(netloc):
+    pool = _pools.get(netloc)
+    if pool is None:
+        with _lock:
+            if netloc not in _pools:
+                _pools[netloc] = ConnectionPool(factory=Connection, max_size=pool_size())
+            pool = _pools[netloc]
+    return pool
+
+
+# returns a PooledResource for url (default the local node) on the shared pool
+def resource(url="http://127.0.0.1:5984"):
+    url = url.rstrip("/")
+    return PooledResource(url, pool=_pool(urlparse.urlparse(url).netloc))
+
+
+# returns the shared couchdbkit Server for a node dict from tests.ini or a url
+def server(node):
+    url = node_url(node).rstrip("/")
+    found = _servers.get(url)
+    if found is None:
+        with _lock:
+            if url not in _servers:
+                _servers[url] = client.Server(url, full_commit=False, resource_instance=resource(url))
+            found = _servers[url]
+    return found
+
+
+# {node: {requests, errors, seconds, pool_size}} since the test started,
+# written with the operations of every test by stats.dump_test
+def node_stats():
+    return dict((netloc, node.to_dict()) for netloc, node in _stats.items())
+
+
+def reset_node_stats():
+    for node in _stats.values():
+        node.reset()
+
+
+stats.sections["nodes"] = (node_stats, reset_node_stats)
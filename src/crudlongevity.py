@@ -1,9 +1,13 @@
 import unittest
 import uuid
 from testconfig import config
-from couchdbkit import client
 import time
 from docmaker import DocumentGenerator
+from uploader import BulkWriter
+from workload import Workload
+from reporter import IntervalReporter
+import connpool
+import stats
 import logger
 
 log = logger.logger("CrudLongevityTests")
@@ -12,17 +16,19 @@ class CrudLongevityTests(unittest.TestCase):
     cleanup_dbs = []
 
     def setUp(self):
+        stats.start_test()
         self.node = config['couchdb-local']
         self.params = config["test-params"]
         self.log = log
         url = "http://{0}:{1}/".format(self.node['ip'], self.node['port'])
         self.log.info("connecting to couchdb @ {0}".format(url))
-        self.server = client.Server(url, full_commit=False)
+        self.server = connpool.server(url)
 
     def tearDown(self):
+        stats.dump_test(self.id())
         nodes = [config["couchdb-local"]]
         urls = ["http://{0}:{1}/".format(n['ip'], n['port']) for n in nodes]
-        servers = [client.Server(url, full_commit=False) for url in urls]
+        servers = [connpool.server(url) for url in urls]
         for server in servers:
             for db in server:
                 if db.dbname.find("test_suite") != -1 or db.dbname.find(
@@ -43,13 +49,18 @@ class CrudLongevityTests(unittest.TestCase):
 
     def test_crud(self):
         db_name = self._get_db_name()
-        self.server.create_db(db_name)
+        db = self.server.create_db(db_name)
         number_of_items = int(self.params["number_of_items"])
         duration = int(self.params["duration"])
+        with IntervalReporter(db, self.id()):
+            self._crud(db_name, number_of_items, duration)
+
+    def _crud(self, db_name, number_of_items, duration):
         if duration == -1:
             self.seed = str(uuid.uuid4())
             self._insert_data(number_of_items, db_name)
             self._update_data(number_of_items, db_name)
+            self._delete_data(number_of_items / 10, db_name)
         else:
             loop_counter = 1
             finish = time.time() + duration
@@ -58,16 +69,36 @@ class CrudLongevityTests(unittest.TestCase):
                 self.seed = str(uuid.uuid4())
                 self._insert_data(number_of_items, db_name)
                 self._update_data(number_of_items, db_name)
+                self._delete_data(number_of_items / 10, db_name)
                 loop_counter += 1
 
+    # a weighted mix of reads, inserts, updates, deletes, view queries and
+    # attachments from [workload] for test-params.duration seconds, or
+    # number_of_items operations when the duration is -1
+    def test_crud_mix(self):
+        db_name = self._get_db_name()
+        db = self.server.create_db(db_name)
+        number_of_items = int(self.params["number_of_items"])
+        duration = int(self.params["duration"])
+        workload = Workload(db, config.get("workload", {}))
+        with IntervalReporter(db, self.id()):
+            workload.preload(number_of_items)
+            if duration == -1:
+                report = workload.run(operations=number_of_items)
+            else:
+                report = workload.run(duration=duration)
+        for op, summary in sorted(report["operations"].items()):
+            log.info("{0}: {1} ops, {2:.1f} ops/sec, p99 {3}s, {4} errors".format(
+                op, summary["count"], summary["ops_per_sec"], summary["p99"], summary["error"]))
+        self.assertEqual(sum(summary["error"] for summary in report["operations"].values()), 0)
+
 
     def _insert_data(self, number_of_items, db_name):
         docs = DocumentGenerator.make_docs(number_of_items,
                 {"name": "user-${prefix}", "payload": "payload-${prefix}-${padding}"},
                 {"size": 1024, "seed": self.seed})
         src_db = self.server[db_name]
-        for doc in docs:
-            src_db.save_doc(doc)
+        BulkWriter(src_db).write(docs)
         log.info("inserted {0} items".format(number_of_items))
 
     def _update_data(self, number_of_items, db_name):
@@ -75,12 +106,17 @@ class CrudLongevityTests(unittest.TestCase):
                 {"name": "user-${prefix}", "payload": "updated-payload-${prefix}-${padding}"},
                 {"size": 128, "seed": self.seed})
         src_db = self.server[db_name]
-        for doc in docs:
-            src_db.save_doc(doc, force_update=True)
+        BulkWriter(src_db, on_conflict="update").write(docs)
         log.info("updated {0} items".format(number_of_items))
 
 
-    def _delete_data(self, docs, db_name):
+    # deletes the first number_of_items documents of the current seed. their
+    # revisions are read with one _all_docs request, a delete without _rev
+    # is rejected as a conflict
+    def _delete_data(self, number_of_items, db_name):
+        docs = DocumentGenerator.make_docs(number_of_items, {"_deleted": True}, {"size": 0, "seed": self.seed})
         src_db = self.server[db_name]
-        for doc in docs:
-            src_db.delete(doc)
\ No newline at end of file
+        rows = src_db.all_docs(keys=[doc["_id"] for doc in docs])
+        BulkWriter(src_db).write({"_id": row["id"], "_rev": row["value"]["rev"], "_deleted": True}
+                                 for row in rows if "value" in row and not row["value"].get("deleted"))
+        log.info("deleted {0} items".format(number_of_items))
\ No newline at end of file
@@ -0,0 +1,68 @@
+# design documents shared by the load, view and benchmark suites
+
+# nine views over {"a": int, "b": int, "c": str, "type": "odd"|"even"} docs.
+# the reduces are the _count and _sum builtins, the javascript functions that
+# returned them failed with a ReferenceError as soon as a reduce was queried
+MULTI_VIEW_DESIGN = {
+    "_id": "_design/test",
+    "language": "javascript",
+    "views": {
+        "all_docs": {
+            "map": "function(doc) { emit([doc.a, doc.b, doc.type], 1) };",
+            "reduce": "_count"
+        },
+        "multi_emit": {
+            "map": "function(doc) {for(var i = 0 ; i < 3 ; i++) { emit(i, doc.a) ; } }"
+        },
+        "summate": {
+            "map": "function (doc) {emit(doc.type, 1)};",
+            "reduce": "_count"
+        },
+        "get_by_a" : {
+            "map": "function(doc) { if (doc.a > 50) emit(doc.a, 1) };"
+        },
+        "get_by_b" : {
+            "map": "function(doc) { if (doc.b < 1000) emit(doc.b, 1) };",
+            "reduce": "_sum"
+        },
+        "get_by_c" : {
+            "map": "function(doc) { emit(doc.c, [doc.a, doc.type]); };"
+        },
+        "get_by_ab" : {
+            "map": "function(doc) { if (a > b) emit([doc.a, doc.b], 1); }",
+            "reduce": "_count"
+        },
+        "get_even" : {
+            "map": """function(doc) { if (doc.type == "even") emit(null, 1);}"""
+        },
+        "get_odd" : {
+            "map": """function(doc) { if (doc.type == "odd") emit(null, 1);}"""
+        }
+    }
+}
+
+# the queries test_heavy_load_single_db makes against MULTI_VIEW_DESIGN, except
+# that get_by_c is not grouped as it has no reduce
+MULTI_VIEW_QUERIES = [
+    ("test/all_docs", {}),
+    ("test/multi_emit", {"startkey": 100, "endkey": 300}),
+    ("test/summate", {"reduce": True, "startkey_docid": "1000", "endkey_docid": "4000"}),
+    ("test/get_by_a", {"descending": True}),
+    ("test/get_by_b", {"group": True}),
+    ("test/get_by_c", {}),
+    ("test/get_by_ab", {"group_level": 1}),
+    ("test/get_even", {}),
+    ("test/get_odd", {})
+]
+
+
+# whether view ("test/name") of MULTI_VIEW_DESIGN has a reduce, its queries
+# then return one row per group rather than every row of the map
+def reduces(view):
+    return "reduce" in MULTI_VIEW_DESIGN["views"][view.split("/", 1)[1]]
+
+
+# the view_index part of GET /db/_design/name/_info: disk_size, update_seq,
+# updater_running and the others
+def design_info(db, design_id):
+    return db.res.get("/{0}/_info".format(design_id)).json_body["view_index"]
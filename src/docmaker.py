@@ -1,6 +1,16 @@
+import base64
+import bisect
+import copy
+import hashlib
+import itertools
+import json
+import math
 import os
 import random
+import re
 import string
+import struct
+import time
 import uuid
 
 class DocumentGenerator(object):
@@ -9,44 +19,566 @@ class DocumentGenerator(object):
     def make_docs(items, kv_template, options=dict(size=1024, seed=str(uuid.uuid4()))):
         return GeneratedDocuments(items, kv_template, options)
 
+    #parses kv_template once and returns a DocumentTemplate, calling it with
+    #an index renders one document body (without _id)
     @staticmethod
-    def _random_string(length):
-        return (("%%0%dX" % (length * 2)) % random.getrandbits(length * 8)).decode("hex")
+    def compile_template(kv_template, options=dict(size=1024)):
+        return DocumentTemplate(kv_template, DocumentGenerator.create_padding(options))
+
+    #returns the ${padding} value for options: a plain string when every
+    #document gets the same padding, otherwise a PaddingPool
+    @staticmethod
+    def create_padding(options):
+        entropy = options.get("entropy", "constant")
+        if options.get("size_dist", "fixed") == "fixed" and entropy in PaddingPool.patterns:
+            return DocumentGenerator.create_value(PaddingPool.patterns[entropy], options["size"])
+        return PaddingPool(options)
+
+    @staticmethod
+    def _random_string(length, rng=random):
+        return (("%%0%dX" % (length * 2)) % rng.getrandbits(length * 8)).decode("hex")
 
     @staticmethod
     def create_value(pattern, size):
         return (pattern * (size / len(pattern))) + pattern[0:(size % len(pattern))]
 
 
+# supported placeholders:
+#   ${prefix}           the document index
+#   ${padding}          padding as described by the size options
+#   ${uuid}             a random uuid4 string
+#   ${seq}              a counter incremented for every rendered value
+#   ${rand_int:lo:hi}   a random integer between lo and hi (inclusive)
+#   ${now}              the current unix time
+# ${seq}, ${rand_int} and ${now} keep their type (int/float) when they are
+# the whole value, otherwise they are formatted into the string. unknown
+# placeholders are left untouched.
+class DocumentTemplate(object):
+    _placeholder = re.compile(r"\$\{(\w+)((?::[^:}]*)*)\}")
+
+    def __init__(self, kv_template, pad):
+        self._template = kv_template
+        self._pad = pad
+        self.uses_rng = False
+        self._seq = itertools.count()
+        self._static, self._dynamic = self._compile_fields(kv_template.items())
+        self._static_values = tuple(self._static.values())
+        self.keys = DocRecord.schema(self._static.keys() + [k for k, render in self._dynamic])
+
+    def __call__(self, i, rng=random):
+        prefix = str(i)
+        doc = self._static.copy()
+        for k, render in self._dynamic:
+            doc[k] = render(i, prefix, rng)
+        return doc
+
+    # the values of one document in the order of self.keys
+    def render_values(self, i, rng=random):
+        prefix = str(i)
+        return self._static_values + tuple([render(i, prefix, rng) for k, render in self._dynamic])
+
+    # returns (static dict, [(key, render)]) for a list of key/value pairs
+    def _compile_fields(self, items):
+        static = {}
+        dynamic = []
+        for k, v in items:
+            render = self._compile(v)
+            if render is None:
+                static[k] = self._substitute(v)
+            else:
+                dynamic.append((k, render))
+        return static, dynamic
+
+    # returns None for values which are the same in every document, otherwise
+    # a function of (i, prefix, rng) producing the value
+    def _compile(self, v):
+        if isinstance(v, str):
+            return self._compile_string(v)
+        if isinstance(v, dict):
+            static, dynamic = self._compile_fields(v.items())
+            if not dynamic:
+                return None
+
+            def render_dict(i, prefix, rng):
+                d = static.copy()
+                for k, render in dynamic:
+                    d[k] = render(i, prefix, rng)
+                return d
+            return render_dict
+        if isinstance(v, list):
+            renders = [self._compile(item) for item in v]
+            if not any(renders):
+                return None
+            parts = [(self._substitute(item), render) for item, render in zip(v, renders)]
+            return lambda i, prefix, rng: [item if render is None else render(i, prefix, rng)
+                                           for item, render in parts]
+        return None
+
+    def _compile_string(self, v):
+        parts = self._parse_string(v)
+        if parts is None:
+            return None
+        if len(parts) == 1:
+            return parts[0]
+        if all(p is self._render_prefix or isinstance(p, str) for p in parts):
+            # only ${prefix}, keep the cheap split/join path
+            static = self._replace_padding(v).split("${prefix}")
+            return lambda i, prefix, rng: prefix.join(static)
+
+        def render_string(i, prefix, rng):
+            return "".join([p if isinstance(p, str) else str(p(i, prefix, rng)) for p in parts])
+        return render_string
+
+    # splits v into literal strings and placeholder renders, None if v has no
+    # known placeholder. ${padding} is substituted here once.
+    def _parse_string(self, v):
+        if v.find("${") == -1:
+            return None
+        v = self._replace_padding(v)
+        parts = []
+        last = 0
+        for match in self._placeholder.finditer(v):
+            render = self._compile_placeholder(match.group(1), match.group(2)[1:].split(":"))
+            if render is None:
+                continue
+            if match.start() > last:
+                parts.append(v[last:match.start()])
+            parts.append(render)
+            last = match.end()
+        if not parts:
+            return None
+        if last < len(v):
+            parts.append(v[last:])
+        return parts
+
+    # a constant padding is substituted once, a PaddingPool stays a placeholder
+    def _replace_padding(self, v):
+        if isinstance(self._pad, str):
+            return v.replace("${padding}", self._pad)
+        return v
+
+    # a value without any other placeholder, with the constant padding in
+    # place of ${padding} at any depth
+    def _substitute(self, v):
+        if isinstance(v, str):
+            return self._replace_padding(v)
+        if isinstance(v, dict):
+            return dict((k, self._substitute(item)) for k, item in v.items())
+        if isinstance(v, list):
+            return [self._substitute(item) for item in v]
+        return v
+
+    # returns a function of (i, rng) producing the document as JSON text.
+    # everything constant, including the padding, is encoded once here and
+    # only the placeholders are spliced in per document.
+    def compile_json(self, id_suffix=None):
+        pieces = ["{"]
+        if id_suffix is not None:
+            pieces.extend(['"_id": "', self._render_prefix, json.dumps(id_suffix)[1:-1] + '"'])
+        for n, (k, v) in enumerate(self._template.items()):
+            if n or id_suffix is not None:
+                pieces.append(", ")
+            pieces.append(json.dumps(k) + ": ")
+            pieces.extend(self._json_pieces(v))
+        pieces.append("}")
+        merged = []
+        for p in pieces:
+            if isinstance(p, str) and merged and isinstance(merged[-1], str):
+                merged[-1] += p
+            else:
+                merged.append(p)
+        merged = tuple(merged)
+
+        def render_json(i, rng=random):
+            prefix = str(i)
+            return "".join([p if p.__class__ is str else p(i, prefix, rng) for p in merged])
+        return render_json
+
+    # JSON text pieces for v: encoded literals and functions returning encoded text
+    def _json_pieces(self, v):
+        if isinstance(v, str):
+            parts = self._parse_string(v)
+            if parts is None:
+                return [json.dumps(self._replace_padding(v))]
+            if len(parts) == 1 and not self._renders_string(parts[0]):
+                render = parts[0]
+                return [lambda i, prefix, rng: json.dumps(render(i, prefix, rng))]
+            # placeholders only produce digits, hex, dashes and padding pool
+            # characters so their text never needs escaping
+            pieces = ['"']
+            for p in parts:
+                if isinstance(p, str):
+                    pieces.append(json.dumps(p)[1:-1])
+                elif self._renders_string(p):
+                    pieces.append(p)
+                else:
+                    pieces.append(self._as_text(p))
+            pieces.append('"')
+            return pieces
+        if isinstance(v, dict):
+            pieces = ["{"]
+            for n, (k, item) in enumerate(v.items()):
+                if n:
+                    pieces.append(", ")
+                pieces.append(json.dumps(k) + ": ")
+                pieces.extend(self._json_pieces(item))
+            pieces.append("}")
+            return pieces
+        if isinstance(v, list):
+            pieces = ["["]
+            for n, item in enumerate(v):
+                if n:
+                    pieces.append(", ")
+                pieces.extend(self._json_pieces(item))
+            pieces.append("]")
+            return pieces
+        return [json.dumps(v)]
+
+    def _renders_string(self, render):
+        return render is self._render_prefix or render is self._render_uuid or render is self._pad
+
+    @staticmethod
+    def _as_text(render):
+        return lambda i, prefix, rng: str(render(i, prefix, rng))
+
+    def _compile_placeholder(self, name, args):
+        if name == "prefix":
+            return self._render_prefix
+        if name == "padding":
+            self.uses_rng = True
+            return self._pad
+        if name == "uuid":
+            self.uses_rng = True
+            return self._render_uuid
+        if name == "seq":
+            seq = self._seq
+            return lambda i, prefix, rng: seq.next()
+        if name == "rand_int" and len(args) == 2:
+            lo, hi = int(args[0]), int(args[1])
+            self.uses_rng = True
+            return lambda i, prefix, rng: rng.randint(lo, hi)
+        if name == "now":
+            return lambda i, prefix, rng: time.time()
+        return None
+
+    @staticmethod
+    def _render_prefix(i, prefix, rng):
+        return prefix
+
+    @staticmethod
+    def _render_uuid(i, prefix, rng):
+        return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+# padding of varying size and content. one pool string is built up front and
+# each document gets a slice of it, with the size drawn from the configured
+# distribution. options:
+#   size_dist   fixed (default), uniform, normal, zipf or histogram
+#   size        the fixed size, the mean for normal
+#   min_size, max_size   bounds for uniform, normal and zipf
+#   stddev      for normal, defaults to size / 4
+#   zipf_s      exponent for zipf, small sizes are the most frequent
+#   histogram   [[size, weight], ...] e.g. captured from production
+#   entropy     constant ("*", the default), zeros, text or random
+class PaddingPool(object):
+    patterns = {"constant": "*", "zeros": "0"}
+    words = ("the", "of", "and", "to", "in", "is", "that", "for", "it", "as", "was", "with", "be", "by",
+             "on", "not", "he", "this", "are", "or", "his", "from", "at", "which", "but", "have", "an",
+             "had", "they", "you", "were", "their", "one", "all", "we", "can", "her", "has", "there",
+             "been", "if", "more", "when", "will", "would", "who", "so", "no", "document", "couchdb",
+             "replication", "view", "index", "revision", "database", "cluster", "node", "user")
+
+    def __init__(self, options):
+        size = options["size"]
+        self._dist = options.get("size_dist", "fixed")
+        self._size = size
+        self._min = options.get("min_size", 1)
+        self._max = options.get("max_size", size * 2)
+        self._stddev = options.get("stddev", size / 4.0)
+        self._sizes = None
+        if self._dist == "zipf":
+            # 16 buckets from min_size to max_size, geometrically spaced
+            s = options.get("zipf_s", 1.0)
+            ratio = (float(self._max) / max(self._min, 1)) ** (1 / 15.0)
+            histogram = [(int(max(self._min, 1) * ratio ** k), 1 / float(k + 1) ** s) for k in range(16)]
+            self._set_histogram(histogram)
+        elif self._dist == "histogram":
+            self._set_histogram(options["histogram"])
+        elif self._dist not in ("fixed", "uniform", "normal"):
+            raise ValueError("unknown size_dist {0}".format(self._dist))
+        largest = max(self._sizes) if self._sizes else (self._size if self._dist == "fixed" else self._max)
+        self._pool = self._create_pool(options.get("entropy", "constant"), largest + max(largest, 65536),
+                                       random.Random(options.get("seed")))
+        self._pool_size = len(self._pool)
+
+    def _set_histogram(self, histogram):
+        self._sizes = [int(size) for size, weight in histogram]
+        self._cumulative = []
+        total = 0.0
+        for size, weight in histogram:
+            total += weight
+            self._cumulative.append(total)
+        self._max = max(self._sizes)
+
+    def _create_pool(self, entropy, length, rng):
+        if entropy in self.patterns:
+            return DocumentGenerator.create_value(self.patterns[entropy], length)
+        if entropy == "text":
+            words = []
+            total = 0
+            while total < length:
+                word = self.words[rng.randint(0, len(self.words) - 1)]
+                words.append(word)
+                total += len(word) + 1
+            return " ".join(words)[:length]
+        if entropy == "random":
+            # base64 keeps it json safe, 6 random bits per character
+            return base64.b64encode(DocumentGenerator._random_string(length * 3 / 4 + 3, rng))[:length]
+        raise ValueError("unknown entropy {0}".format(entropy))
+
+    def size(self, rng):
+        if self._dist == "fixed":
+            return self._size
+        if self._dist == "uniform":
+            return rng.randint(self._min, self._max)
+        if self._dist == "normal":
+            return max(self._min, min(self._max, int(rng.gauss(self._size, self._stddev))))
+        return self._sizes[bisect.bisect_left(self._cumulative, rng.random() * self._cumulative[-1])]
+
+    # renders the padding of one document, used as a template placeholder
+    def __call__(self, i, prefix, rng):
+        size = self.size(rng)
+        offset = rng.randint(0, self._pool_size - size)
+        return self._pool[offset:offset + size]
+
+
+# the random draws of one document: 64 bits at a time from the md5 digest of
+# its key and from the digests chained after it. seeding a random.Random for
+# every document costs more than rendering most documents, this is a hash a
+# couple of draws and covers what the templates and padding call.
+class DocumentRandom(object):
+    __slots__ = ("_digest", "_words")
+
+    def __init__(self, key):
+        self._digest = hashlib.md5(key).digest()
+        self._words = list(_WORDS.unpack(self._digest))
+
+    def _next(self):
+        if not self._words:
+            self._digest = hashlib.md5(self._digest).digest()
+            self._words = list(_WORDS.unpack(self._digest))
+        return self._words.pop()
+
+    # a float in [0, 1) with 53 random bits, like random.random()
+    def random(self):
+        words = self._words
+        return ((words.pop() if words else self._next()) >> 11) * _FLOAT_SCALE
+
+    def getrandbits(self, k):
+        value = 0
+        for shift in range(0, k, 64):
+            value |= self._next() << shift
+        return value & ((1 << k) - 1)
+
+    def randint(self, a, b):
+        n = b - a + 1
+        if n < _FLOAT_RANGE:
+            words = self._words
+            return a + int(((words.pop() if words else self._next()) >> 11) * _FLOAT_SCALE * n)
+        return a + self.getrandbits(n.bit_length() + 64) % n
+
+    # box-muller, one normal value from two uniform ones
+    def gauss(self, mu, sigma):
+        radius = math.sqrt(-2.0 * math.log(1.0 - self.random()))
+        return mu + sigma * radius * math.cos(2.0 * math.pi * self.random())
+
+
+_WORDS = struct.Struct("<QQ")
+_FLOAT_SCALE = 2.0 ** -53
+_FLOAT_RANGE = 1 << 53
+
+
+# every document is a function of (seed, index) only: ${uuid} and
+# ${rand_int} draw from a DocumentRandom keyed with both, so any document
+# can be rebuilt without replaying the ones before it. ${seq} and ${now} are
+# the exceptions and differ between runs.
 class GeneratedDocuments(object):
     def __init__(self, items, kv_template, options=dict(size=1024)):
         self._items = items
         self._kv_template = kv_template
         self._options = options
+        self._start = 0
+        self._stop = items
         self._pointer = 0
-        self._pad = DocumentGenerator.create_value("*", options["size"])
+        self._pad = DocumentGenerator.create_padding(options)
+        self._seed = options.get("seed") or str(uuid.uuid4())
+        self._id_suffix = "-{0}".format(self._seed)
+        self._rng_key = "{0}:".format(self._seed)
+        self._template = DocumentTemplate(kv_template, self._pad)
+        self._set_id = "_id" not in kv_template
+        self._render_json = None
+        if self._set_id:
+            self._record_keys = DocRecord.schema(("_id",) + self._template.keys)
+        else:
+            self._record_keys = self._template.keys
+
+    # returns the draws of document i, of its own so threads building
+    # documents at the same time never share them, or the module level
+    # generator when the template does not use random values at all
+    def _rng_for(self, i):
+        if not self._template.uses_rng:
+            return random
+        return DocumentRandom(self._rng_key + str(i))
+
+    def _make_doc(self, i):
+        doc = self._template(i, self._rng_for(i))
+        if self._set_id:
+            doc["_id"] = str(i) + self._id_suffix
+        return doc
+
+    # returns a new generator over documents [start, stop) of this one,
+    # sharing the compiled template
+    def _range(self, start, stop):
+        docs = copy.copy(self)
+        docs._start = docs._pointer = start
+        docs._stop = stop
+        return docs
 
     # Required for the for-in syntax
     def __iter__(self):
         return self
 
     def __len__(self):
-        return self._items
+        return self._stop - self._start
+
+    # docs[i] rebuilds the i-th document, docs[i:j] is a new generator over
+    # that range. the position of an ongoing iteration is not affected.
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("slice step is not supported")
+            return self._range(self._start + start, self._start + max(start, stop))
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError("document index out of range")
+        return self._make_doc(self._start + key)
+
+    # (items, kv_template, options, start, stop) to rebuild this generator,
+    # e.g. in another process. the options carry the seed actually used.
+    def spec(self):
+        options = dict(self._options, seed=self._seed)
+        return self._items, self._kv_template, options, self._start, self._stop
+
+    @staticmethod
+    def from_spec(items, kv_template, options, start, stop):
+        return GeneratedDocuments(items, kv_template, options)[start:stop]
+
+    # a fresh generator over the same documents, e.g. to verify what was saved
+    # without having kept the documents around
+    def regenerate(self):
+        return self._range(self._start, self._stop)
+
+    # splits the documents into k disjoint generators covering all of them,
+    # e.g. one per writer
+    def partition(self, k):
+        bounds = [self._start + (len(self) * n) / k for n in range(k + 1)]
+        return [self._range(bounds[n], bounds[n + 1]) for n in range(k)]
 
     # Returns the next value of the iterator
     def next(self):
-        if self._pointer == self._items:
+        if self._pointer == self._stop:
             raise StopIteration
-        else:
-            i = self._pointer
-            doc = {"_id": "{0}-{1}".format(i, self._options["seed"])}
-            for k in self._kv_template:
-                v = self._kv_template[k]
-                if isinstance(v, str) and v.find("${prefix}") != -1:
-                    v = v.replace("${prefix}", "{0}".format(i))
-                    #how about the value size
-                if isinstance(v, str) and v.find("${padding}") != -1:
-                    v = v.replace("${padding}", self._pad)
-                doc[k] = v
+        doc = self._make_doc(self._pointer)
+        self._pointer += 1
+        return doc
+
+    # returns up to n documents in one list, an empty list once exhausted
+    def next_batch(self, n):
+        start = self._pointer
+        stop = min(start + n, self._stop)
+        self._pointer = stop
+        return map(self._make_doc, xrange(start, stop))
+
+    # yields the remaining documents as lists of batch_size, ready for bulk_save
+    def batches(self, batch_size):
+        batch = self.next_batch(batch_size)
+        while batch:
+            yield batch
+            batch = self.next_batch(batch_size)
+
+    # same documents as next() as compact DocRecords
+    def next_record(self):
+        if self._pointer == self._stop:
+            raise StopIteration
+        i = self._pointer
+        values = self._template.render_values(i, self._rng_for(i))
+        if self._set_id:
+            values = (str(i) + self._id_suffix,) + values
+        self._pointer += 1
+        return DocRecord(self._record_keys, values)
+
+    def records(self):
+        while True:
+            yield self.next_record()
+
+    # same documents as next(), already encoded as JSON text
+    def next_json(self):
+        if self._render_json is None:
+            self._render_json = self._template.compile_json(self._id_suffix if self._set_id else None)
+        if self._pointer == self._stop:
+            raise StopIteration
+        i = self._pointer
+        body = self._render_json(i, self._rng_for(i))
         self._pointer += 1
-        return doc
\ No newline at end of file
+        return body
+
+    def json_docs(self):
+        while True:
+            yield self.next_json()
+
+    # yields ready to post {"docs": [...]} bodies of up to batch_size documents
+    def bulk_bodies(self, batch_size):
+        docs = self.json_docs()
+        while True:
+            batch = list(itertools.islice(docs, batch_size))
+            if not batch:
+                return
+            yield '{"docs": [' + ", ".join(batch) + "]}"
+
+
+# a document held as a tuple of values against a key tuple shared by every
+# record of the same shape, a lot smaller than a dict per document when
+# thousands are kept in a list. to_dict()/to_json() build the real document
+# when it is sent.
+class DocRecord(object):
+    __slots__ = ("keys", "values")
+    _schemas = {}
+
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
+
+    # returns the shared, interned key tuple for keys
+    @staticmethod
+    def schema(keys):
+        keys = tuple(keys)
+        schema = DocRecord._schemas.get(keys)
+        if schema is None:
+            schema = DocRecord._schemas.setdefault(keys, tuple([intern(k) if isinstance(k, str) else k for k in keys]))
+        return schema
+
+    @staticmethod
+    def from_dict(doc):
+        keys = DocRecord.schema(sorted(doc.keys()))
+        return DocRecord(keys, tuple([doc[k] for k in keys]))
+
+    def __getitem__(self, key):
+        return self.values[self.keys.index(key)]
+
+    def to_dict(self):
+        return dict(zip(self.keys, self.values))
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
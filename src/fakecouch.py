@@ -0,0 +1,1015 @@
+import base64
+import BaseHTTPServer
+import bisect
+import copy
+import hashlib
+import json
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import uuid
+from jsview import compile_function, JSError
+import logger
+
+log = logger.logger("fakecouch")
+
+# an in-process stand-in for the subset of the CouchDB 1.x HTTP API the suites
+# use: databases, documents, _bulk_docs, _all_docs, _changes, views written in
+# the javascript subset jsview understands (plus the _count, _sum and _stats
+# builtin reduces), attachments, _compact, _active_tasks, _replicate,
+# _session, _config and _uuids. everything is kept in memory and nothing is
+# validated beyond what the suites rely on, it exists to exercise and time the
+# client side of the harness without a cluster.
+#
+#   servers = [FakeCouch().start() for i in range(3)]
+#   config["couchdb-local"] = servers[0].node
+#
+# or from the command line, one server per port:
+#
+#   python fakecouch.py 5984 5985 5986
+
+
+class CouchError(Exception):
+    def __init__(self, status, error, reason):
+        Exception.__init__(self, reason)
+        self.status = status
+        self.error = error
+        self.reason = reason
+
+
+def not_found(reason="missing"):
+    return CouchError(404, "not_found", reason)
+
+
+def conflict():
+    return CouchError(409, "conflict", "Document update conflict.")
+
+
+# view collation: null < false < true < numbers < strings < arrays < objects,
+# strings compare case insensitively first with lower case before upper case
+def collate(value):
+    if value is None:
+        return (0,)
+    if value is False:
+        return (1,)
+    if value is True:
+        return (2,)
+    if isinstance(value, (int, long, float)):
+        return (3, value)
+    if isinstance(value, basestring):
+        return (4, value.lower(), value.swapcase())
+    if isinstance(value, list):
+        return (5, [collate(v) for v in value])
+    return (6, [(collate(k), collate(v)) for k, v in value.items()])
+
+
+def _next_rev(rev, body):
+    generation = int(rev.split("-")[0]) + 1 if rev else 1
+    digest = hashlib.md5((rev or "") + json.dumps(body, sort_keys=True)).hexdigest()
+    return "{0}-{1}".format(generation, digest)
+
+
+def _generation(rev):
+    return int(rev.split("-")[0])
+
+
+# json.loads gives unicode strings, four bytes a character on this build, so
+# ascii ones are kept as str. they compare and hash the same either way
+def _compact(value):
+    if isinstance(value, unicode):
+        try:
+            return value.encode("ascii")
+        except UnicodeEncodeError:
+            return value
+    if isinstance(value, dict):
+        return dict((_compact(k), _compact(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_compact(v) for v in value]
+    return value
+
+
+class _Doc(object):
+    __slots__ = ("id", "rev", "seq", "size", "deleted", "body", "attachments")
+
+    def __init__(self, id):
+        self.id = id
+        self.rev = None
+        self.seq = 0
+        self.size = 0
+        self.deleted = False
+        self.body = {}
+        self.attachments = {}
+
+    def to_dict(self, attachments=False):
+        doc = {"_id": self.id, "_rev": self.rev}
+        if self.deleted:
+            doc["_deleted"] = True
+        doc.update(self.body)
+        if self.attachments:
+            doc["_attachments"] = dict((name, self._attachment(att, attachments))
+                                       for name, att in self.attachments.items())
+        return doc
+
+    @staticmethod
+    def _attachment(att, data):
+        info = {"content_type": att["content_type"], "revpos": att["revpos"], "digest": att["digest"],
+                "length": len(att["data"])}
+        if data:
+            info["data"] = base64.b64encode(att["data"])
+        else:
+            info["stub"] = True
+        return info
+
+
+class Database(object):
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.update_seq = 0
+        # the latest revision of every document at the position of its seq,
+        # None where a later revision replaced it, so changes() is a slice
+        self.by_seq = []
+        # the ids of the documents that are not deleted, sorted for _all_docs
+        self.ids = []
+        self.doc_del_count = 0
+        self.data_size = 0
+        self.disk_size = 0
+        self.compact_running = False
+        self.views = {}
+        self.lock = threading.RLock()
+
+    def info(self):
+        with self.lock:
+            return {"db_name": self.name, "doc_count": len(self.docs) - self.doc_del_count,
+                    "doc_del_count": self.doc_del_count, "update_seq": self.update_seq, "purge_seq": 0,
+                    "compact_running": self.compact_running, "disk_size": self.disk_size,
+                    "data_size": self.data_size, "instance_start_time": "0", "disk_format_version": 6,
+                    "committed_update_seq": self.update_seq}
+
+    def get(self, doc_id, rev=None):
+        with self.lock:
+            doc = self.docs.get(doc_id)
+            if doc is None or (doc.deleted and not rev):
+                raise not_found("deleted" if doc else "missing")
+            if rev and rev != doc.rev:
+                raise not_found()
+            return doc
+
+    # stores one document the way PUT /db/id and _bulk_docs do. with new_edits
+    # false the document keeps its _rev, which is how replication writes, and
+    # the revision with the highest generation wins
+    def update(self, doc, new_edits=True):
+        doc = dict(doc)
+        doc_id = doc.pop("_id", None) or uuid.uuid4().hex
+        rev = doc.pop("_rev", None)
+        deleted = doc.pop("_deleted", False)
+        attachments = doc.pop("_attachments", None) or {}
+        for key in [k for k in doc if k.startswith("_")]:
+            del doc[key]
+        with self.lock:
+            current = self.docs.get(doc_id)
+            if new_edits:
+                if current and not current.deleted and rev != current.rev:
+                    raise conflict()
+                if (current is None and rev) or (current and current.deleted and rev and rev != current.rev):
+                    raise conflict()
+                new_rev = _next_rev(current.rev if current else None, doc)
+            else:
+                if not rev:
+                    raise CouchError(400, "bad_request", "new_edits=false needs a _rev")
+                if current and (_generation(current.rev), current.rev) >= (_generation(rev), rev):
+                    return {"id": doc_id, "rev": rev}
+                new_rev = rev
+            stored = _Doc(doc_id)
+            stored.rev = new_rev
+            stored.deleted = bool(deleted)
+            stored.body = {} if deleted else _compact(doc)
+            if not deleted:
+                stored.attachments = self._attachments(current, attachments, _generation(new_rev))
+            self._store(stored)
+            return {"id": doc_id, "rev": new_rev}
+
+    def _attachments(self, current, attachments, revpos):
+        result = {}
+        for name, att in attachments.items():
+            if att.get("stub"):
+                if not current or name not in current.attachments:
+                    raise CouchError(412, "missing_stub", "no attachment {0} to keep".format(name))
+                result[name] = current.attachments[name]
+            else:
+                data = base64.b64decode(att.get("data", ""))
+                result[name] = self._attachment(data, att.get("content_type", "application/octet-stream"), revpos)
+        return result
+
+    @staticmethod
+    def _attachment(data, content_type, revpos):
+        return {"data": data, "content_type": content_type, "revpos": revpos,
+                "digest": "md5-" + base64.b64encode(hashlib.md5(data).digest())}
+
+    # data_size and the counts are kept up to date here rather than summed
+    # over all documents on every GET /db
+    def _store(self, doc):
+        current = self.docs.get(doc.id)
+        if current is not None:
+            self.by_seq[current.seq - 1] = None
+            self.data_size -= current.size
+            self.doc_del_count -= current.deleted
+        if (current is None or current.deleted) and not doc.deleted:
+            bisect.insort(self.ids, doc.id)
+        elif current is not None and not current.deleted and doc.deleted:
+            del self.ids[bisect.bisect_left(self.ids, doc.id)]
+        self.update_seq += 1
+        doc.seq = self.update_seq
+        doc.size = 0 if doc.deleted else len(json.dumps(doc.body)) + sum(len(a["data"])
+                                                                          for a in doc.attachments.values())
+        self.docs[doc.id] = doc
+        self.by_seq.append(doc)
+        self.data_size += doc.size
+        self.doc_del_count += doc.deleted
+        # the file is append only until it is compacted
+        self.disk_size += doc.size + 64
+
+    def put_attachment(self, doc_id, rev, name, data, content_type):
+        with self.lock:
+            current = self.docs.get(doc_id)
+            if current and not current.deleted and rev != current.rev:
+                raise conflict()
+            if current is None and rev:
+                raise conflict()
+            body = current.body if current and not current.deleted else {}
+            stored = _Doc(doc_id)
+            stored.rev = _next_rev(current.rev if current else None, [body, name, len(data)])
+            stored.body = body
+            stored.attachments = dict(current.attachments) if current and not current.deleted else {}
+            stored.attachments[name] = self._attachment(data, content_type, _generation(stored.rev))
+            self._store(stored)
+            return {"ok": True, "id": doc_id, "rev": stored.rev}
+
+    def delete_attachment(self, doc_id, rev, name):
+        with self.lock:
+            current = self.get(doc_id)
+            if rev != current.rev:
+                raise conflict()
+            if name not in current.attachments:
+                raise not_found()
+            stored = _Doc(doc_id)
+            stored.rev = _next_rev(current.rev, [current.body, name])
+            stored.body = current.body
+            stored.attachments = dict(current.attachments)
+            del stored.attachments[name]
+            self._store(stored)
+            return {"ok": True, "id": doc_id, "rev": stored.rev}
+
+    def changes(self, since=0):
+        with self.lock:
+            return [d for d in self.by_seq[max(since, 0):] if d is not None]
+
+    def compact(self):
+        def run():
+            time.sleep(min(0.5, len(self.docs) / 100000.0))
+            with self.lock:
+                self.disk_size = self.data_size + 64 * len(self.docs)
+                self.compact_running = False
+        with self.lock:
+            self.compact_running = True
+        threading.Thread(target=run).start()
+
+    # the index of a view, brought up to date unless update is false, as
+    # for stale=ok
+    def view(self, design, name, update=True):
+        ddoc = self.get("_design/" + design)
+        spec = (ddoc.body.get("views") or {}).get(name)
+        if spec is None:
+            raise not_found("missing_named_view")
+        with self.lock:
+            index = self.views.get((design, name))
+            if index is None or index.source != (spec.get("map"), spec.get("reduce")):
+                index = self.views[(design, name)] = ViewIndex(spec.get("map"), spec.get("reduce"))
+            if update:
+                index.update(self)
+            return index
+
+
+# a map index kept up to date incrementally from the changes since it was last
+# queried, like the view server does, and sorted lazily
+class ViewIndex(object):
+    def __init__(self, map_source, reduce_source):
+        self.source = (map_source, reduce_source)
+        self.emitted = []
+        self.map = compile_function(map_source, emit=lambda key, value=None: self.emitted.append((key, value)))
+        self.reduce_source = reduce_source
+        self.seq = 0
+        self.by_doc = {}
+        self.rows = None
+        self.updating = False
+        self.changes = 0
+        self.processed = 0
+        # bytes of json the emitted rows take, in place of the index file size
+        self.size = 0
+        self._sizes = {}
+
+    def update(self, db):
+        changes = db.changes(self.seq)
+        if not changes:
+            return
+        self.updating = True
+        self.changes = len(changes)
+        self.processed = 0
+        try:
+            for doc in changes:
+                self.seq = doc.seq
+                self.processed += 1
+                self.by_doc.pop(doc.id, None)
+                self.size -= self._sizes.pop(doc.id, 0)
+                if doc.deleted or doc.id.startswith("_design/"):
+                    continue
+                self.emitted = []
+                try:
+                    self.map(doc.to_dict())
+                except (JSError, TypeError, ValueError, AttributeError, ZeroDivisionError) as e:
+                    log.debug("map function raised {0} for {1}".format(e, doc.id))
+                    continue
+                if self.emitted:
+                    self.by_doc[doc.id] = [(copy.deepcopy(k), copy.deepcopy(v)) for k, v in self.emitted]
+                    self._sizes[doc.id] = len(json.dumps(self.emitted)) + len(doc.id) * len(self.emitted)
+                    self.size += self._sizes[doc.id]
+            self.rows = None
+        finally:
+            self.updating = False
+
+    def sorted_rows(self):
+        if self.rows is None:
+            rows = [(collate(key), doc_id, key, value) for doc_id, emitted in self.by_doc.items()
+                    for key, value in emitted]
+            rows.sort(key=lambda row: (row[0], row[1]))
+            self.rows = rows
+        return self.rows
+
+    def reduce(self, keys, values):
+        source = self.reduce_source.strip()
+        if source == "_count":
+            return len(values)
+        if source == "_sum":
+            return sum(values)
+        if source == "_stats":
+            return {"sum": sum(values), "count": len(values), "min": min(values), "max": max(values),
+                    "sumsqr": sum(v * v for v in values)}
+        try:
+            return compile_function(source)(keys, values, False)
+        except (JSError, TypeError, ValueError, AttributeError, ZeroDivisionError) as e:
+            raise CouchError(500, "reduce_error", str(e))
+
+
+def _boolean(params, name, default=False):
+    value = params.get(name)
+    if value is None:
+        return default
+    return value.lower() == "true"
+
+
+def _json_param(params, *names):
+    for name in names:
+        if name in params:
+            return True, json.loads(params[name])
+    return False, None
+
+
+# selects the (collation, docid, key, value) rows the usual range parameters
+# ask for from rows sorted ascending, returns them with the offset of the
+# first one
+def select_rows(rows, params, keys=None):
+    descending = _boolean(params, "descending")
+    ordered = list(reversed(rows)) if descending else rows
+    if keys is not None:
+        wanted = [collate(k) for k in keys]
+        selected = [row for k in wanted for row in ordered if row[0] == k]
+        offset = 0
+    else:
+        has_start, startkey = _json_param(params, "startkey", "start_key")
+        has_end, endkey = _json_param(params, "endkey", "end_key")
+        has_key, key = _json_param(params, "key")
+        if has_key:
+            has_start = has_end = True
+            startkey = endkey = key
+        start_docid = params.get("startkey_docid", params.get("start_key_doc_id"))
+        end_docid = params.get("endkey_docid", params.get("end_key_doc_id"))
+        inclusive_end = _boolean(params, "inclusive_end", True)
+        direction = -1 if descending else 1
+        start = (collate(startkey), start_docid) if has_start else None
+        end = (collate(endkey), end_docid) if has_end else None
+
+        def position(row, bound):
+            if row[0] != bound[0]:
+                return direction * cmp(row[0], bound[0])
+            if bound[1] is None:
+                return 0
+            return direction * cmp(row[1], bound[1])
+
+        selected = []
+        offset = 0
+        for row in ordered:
+            if start and position(row, start) < 0:
+                offset += 1
+                continue
+            if end:
+                p = position(row, end)
+                if p > 0 or (p == 0 and not inclusive_end):
+                    break
+            selected.append(row)
+    skip = int(params.get("skip", 0))
+    limit = params.get("limit")
+    selected = selected[skip:]
+    if limit is not None:
+        selected = selected[:int(limit)]
+    return selected, offset + skip
+
+
+class FakeCouch(object):
+    def __init__(self, port=0, host="127.0.0.1"):
+        self.dbs = {}
+        self.lock = threading.RLock()
+        self.tasks = {}
+        self.replications = {}
+        self.config = {"couch_httpd_auth": {"authentication_db": "_users", "require_valid_user": "false"},
+                       "couchdb": {"max_document_size": "4294967296"},
+                       "httpd": {"bind_address": host, "port": str(port)}}
+        self.httpd = _HTTPServer((host, port), _Handler)
+        self.httpd.couch = self
+        self.host, self.port = self.httpd.server_address[:2]
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://{0}:{1}/".format(self.host, self.port)
+
+    # the [couchdb-local] style entry the suites read from tests.ini
+    @property
+    def node(self):
+        return {"ip": self.host, "port": self.port, "username": "", "password": ""}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fakecouch-{0}".format(self.port))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        for replication in self.replications.values():
+            replication.stop()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def db(self, name, create=False):
+        with self.lock:
+            db = self.dbs.get(name)
+            if db is None:
+                if not create:
+                    raise not_found("no_db_file")
+                db = self.dbs[name] = Database(name)
+            return db
+
+    def create_db(self, name):
+        with self.lock:
+            if name in self.dbs:
+                raise CouchError(412, "file_exists", "The database could not be created, the file already exists.")
+            return self.db(name, create=True)
+
+    def delete_db(self, name):
+        with self.lock:
+            if self.dbs.pop(name, None) is None:
+                raise not_found()
+
+    def active_tasks(self):
+        tasks = [dict(task) for task in self.tasks.values()]
+        for db in self.dbs.values():
+            if db.compact_running:
+                tasks.append({"type": "Database Compaction", "task": db.name, "status": "Copied docs", "pid": "<0.1.0>"})
+            for (design, name), index in db.views.items():
+                if index.updating:
+                    tasks.append({"type": "View Group Indexer", "task": "{0} _design/{1}".format(db.name, design),
+                                  "status": "Processed {0} of {1} changes ({2}%)".format(
+                                      index.processed, index.changes, index.processed * 100 / max(index.changes, 1)),
+                                  "pid": "<0.2.0>"})
+        return tasks
+
+    def replicate(self, body):
+        source, target = body.get("source"), body.get("target")
+        if not source or not target:
+            raise CouchError(400, "bad_request", "source and target are required")
+        replication = Replication(self, source, target, body.get("filter"), body.get("query_params"),
+                                  body.get("create_target", False))
+        if body.get("cancel"):
+            running = self.replications.pop(replication.id, None)
+            if running is None:
+                raise not_found()
+            running.stop()
+            return {"ok": True, "_local_id": replication.id}
+        if body.get("continuous"):
+            if replication.id not in self.replications:
+                self.replications[replication.id] = replication
+                replication.start()
+            return {"ok": True, "_local_id": replication.id}
+        return replication.run_once()
+
+
+# copies the changes of a source database to a target with new_edits=false,
+# either database can be a name on the server the replication runs on or a
+# URL of any server
+class Replication(object):
+    def __init__(self, couch, source, target, filter=None, query_params=None, create_target=False):
+        self.couch = couch
+        self.source = source if "://" in source else couch.url + source
+        self.target = target if "://" in target else couch.url + target
+        self.filter = filter
+        self.query_params = query_params or {}
+        self.create_target = create_target
+        self.id = hashlib.md5(json.dumps([self.source, self.target, filter, self.query_params])).hexdigest()
+        self.since = 0
+        self.total = 0
+        self.written = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        # the total is known up front so the task never looks finished early
+        self.total = _request("GET", self.source)["update_seq"]
+        self.couch.tasks[self.id] = self._task()
+        self.thread = threading.Thread(target=self._run_continuous, name="replication-" + self.id[:8])
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.couch.tasks.pop(self.id, None)
+
+    def _run_continuous(self):
+        while not self.stopped.is_set():
+            try:
+                if not self._replicate_batch():
+                    self.stopped.wait(0.1)
+            except Exception as e:
+                log.error("replication {0} failed: {1}".format(self.id, e))
+                self.stopped.wait(1)
+
+    def run_once(self):
+        started = time.time()
+        self.couch.tasks[self.id] = self._task()
+        try:
+            while self._replicate_batch():
+                pass
+        finally:
+            self.couch.tasks.pop(self.id, None)
+        return {"ok": True, "session_id": uuid.uuid4().hex, "source_last_seq": self.since,
+                "history": [{"start_time": time.ctime(started), "end_time": time.ctime(), "recorded_seq": self.since,
+                             "docs_written": self.written, "docs_read": self.written, "doc_write_failures": 0}]}
+
+    def _task(self):
+        return {"type": "Replication", "pid": "<0.3.0>",
+                "task": "{0}+continuous: {1} -> {2}".format(self.id, self.source, self.target),
+                "status": "Processed {0} / {1} changes".format(self.since, self.total)}
+
+    # returns whether there were changes to copy
+    def _replicate_batch(self):
+        params = {"since": self.since, "include_docs": "true", "limit": 100}
+        if self.filter:
+            params["filter"] = self.filter
+            params.update(self.query_params)
+        changes = _request("GET", self.source + "/_changes?" + urllib.urlencode(params))
+        docs = []
+        for change in changes["results"]:
+            doc = change["doc"]
+            if doc.get("_attachments"):
+                doc = _request("GET", "{0}/{1}?attachments=true".format(self.source, _quote_id(doc["_id"])))
+            docs.append(doc)
+        if docs:
+            try:
+                _request("POST", self.target + "/_bulk_docs", {"docs": docs, "new_edits": False})
+            except CouchError as e:
+                if e.status != 404 or not self.create_target:
+                    raise
+                _request("PUT", self.target)
+                _request("POST", self.target + "/_bulk_docs", {"docs": docs, "new_edits": False})
+            self.written += len(docs)
+        self.since = changes["last_seq"]
+        # the total read when the replication started, or how far it got
+        # since, without asking the source for its info after every batch
+        self.total = max(self.total, self.since)
+        if self.id in self.couch.tasks:
+            self.couch.tasks[self.id] = self._task()
+        return bool(changes["results"])
+
+
+def _quote_id(doc_id):
+    if doc_id.startswith("_design/"):
+        return "_design/" + urllib.quote(doc_id[8:], safe="")
+    return urllib.quote(doc_id, safe="")
+
+
+def _request(method, url, body=None):
+    request = urllib2.Request(url, data=json.dumps(body) if body is not None else None,
+                              headers={"Content-Type": "application/json", "Accept": "application/json"})
+    request.get_method = lambda: method
+    try:
+        return json.loads(urllib2.urlopen(request).read())
+    except urllib2.HTTPError as e:
+        error = json.loads(e.read() or "{}")
+        raise CouchError(e.code, error.get("error", "unknown"), error.get("reason", ""))
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive, the suites share pooled connections
+    protocol_version = "HTTP/1.1"
+    server_version = "CouchDB/1.2.0 (fakecouch)"
+    # one buffered write per response, headers and body written separately
+    # wait on delayed acks
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def do_GET(self):
+        self._dispatch()
+
+    do_HEAD = do_PUT = do_POST = do_DELETE = do_COPY = do_GET
+
+    def _body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(";")[0].strip() or "0", 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return "".join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else ""
+
+    def _dispatch(self):
+        couch = self.server.couch
+        parsed = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(parsed.query, keep_blank_values=True))
+        raw = [s for s in parsed.path.split("/") if s]
+        if len(raw) > 2 and raw[1] in ("_design", "_local"):
+            raw[1:3] = [raw[1] + "/" + raw[2]]
+        path = [urllib.unquote(s) for s in raw]
+        body = self._body()
+        try:
+            status, result, headers = _route(couch, self.command, path, params, body, self.headers)
+        except CouchError as e:
+            status, result, headers = e.status, {"error": e.error, "reason": e.reason}, {}
+        except ValueError as e:
+            status, result, headers = 400, {"error": "bad_request", "reason": str(e)}, {}
+        except Exception as e:
+            log.error("{0} {1} failed: {2}".format(self.command, self.path, e))
+            status, result, headers = 500, {"error": "unknown_error", "reason": str(e)}, {}
+        if isinstance(result, str) and "Content-Type" in headers:
+            data = result
+        else:
+            data = json.dumps(result) + "\n"
+            headers["Content-Type"] = "application/json"
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+
+def _route(couch, method, path, params, body, headers):
+    attachment = len(path) > 2 and not (path[1].startswith("_design/") and path[2] in ("_view", "_info"))
+    payload = json.loads(body) if body and not attachment else None
+    if not path:
+        return 200, {"couchdb": "Welcome", "version": "1.2.0"}, {}
+    if path[0].startswith("_"):
+        return _route_server(couch, method, path, params, payload)
+    db_name = path[0]
+    if len(path) == 1:
+        return _route_db(couch, method, db_name, params, payload)
+    db = couch.db(db_name)
+    if path[1] == "_all_docs":
+        keys = (payload or {}).get("keys") if method == "POST" else json.loads(params.get("keys", "null"))
+        return 200, _all_docs(db, params, keys), {}
+    if path[1] == "_bulk_docs" and method == "POST":
+        return 201, _bulk_docs(db, payload), {}
+    if path[1] == "_changes":
+        return 200, _changes(db, params), {}
+    if path[1] == "_compact" and method == "POST":
+        db.compact()
+        return 202, {"ok": True}, {}
+    if path[1] in ("_ensure_full_commit", "_view_cleanup") and method == "POST":
+        return 201, {"ok": True, "instance_start_time": "0"}, {}
+    if path[1].startswith("_design/") and len(path) > 2 and path[2] in ("_view", "_info"):
+        design = path[1][8:]
+        if path[2] == "_info":
+            return 200, _design_info(db, design), {}
+        if len(path) != 4:
+            raise not_found()
+        keys = (payload or {}).get("keys") if method == "POST" else json.loads(params.get("keys", "null"))
+        return 200, _query_view(db, design, path[3], params, keys), {}
+    if path[1].startswith("_") and not path[1].startswith("_design/") and not path[1].startswith("_local/"):
+        raise CouchError(400, "illegal_docid", "Only reserved document ids may start with underscore.")
+    if attachment:
+        return _route_attachment(db, method, path[1], "/".join(path[2:]), params, body, headers)
+    return _route_doc(db, method, path[1], params, payload)
+
+
+def _route_server(couch, method, path, params, payload):
+    if path[0] == "_all_dbs":
+        return 200, sorted(couch.dbs), {}
+    if path[0] == "_active_tasks":
+        return 200, couch.active_tasks(), {}
+    if path[0] == "_replicate" and method == "POST":
+        return 200, couch.replicate(payload or {}), {}
+    if path[0] == "_uuids":
+        return 200, {"uuids": [uuid.uuid4().hex for i in range(int(params.get("count", 1)))]}, {}
+    if path[0] == "_session":
+        return _session(couch, method, payload)
+    if path[0] == "_config":
+        return _config(couch, method, path[1:], payload)
+    raise not_found()
+
+
+def _route_db(couch, method, db_name, params, payload):
+    if method == "PUT":
+        couch.create_db(db_name)
+        return 201, {"ok": True}, {}
+    if method == "DELETE":
+        couch.delete_db(db_name)
+        return 200, {"ok": True}, {}
+    db = couch.db(db_name)
+    if method == "POST":
+        result = db.update(payload or {})
+        return 201, dict(result, ok=True), {}
+    return 200, db.info(), {}
+
+
+def _route_doc(db, method, doc_id, params, payload):
+    if method in ("GET", "HEAD"):
+        doc = db.get(doc_id, params.get("rev"))
+        return 200, doc.to_dict(_boolean(params, "attachments")), {"ETag": '"{0}"'.format(doc.rev)}
+    if method == "PUT":
+        doc = dict(payload or {}, _id=doc_id)
+        if "rev" in params:
+            doc["_rev"] = params["rev"]
+        result = db.update(doc, new_edits=_boolean(params, "new_edits", True))
+        return 201, dict(result, ok=True), {"ETag": '"{0}"'.format(result["rev"])}
+    if method == "DELETE":
+        result = db.update({"_id": doc_id, "_rev": params.get("rev"), "_deleted": True})
+        return 200, dict(result, ok=True), {}
+    raise CouchError(405, "method_not_allowed", "Only GET,HEAD,PUT,DELETE allowed")
+
+
+def _route_attachment(db, method, doc_id, name, params, body, headers):
+    if method in ("GET", "HEAD"):
+        doc = db.get(doc_id, params.get("rev"))
+        att = doc.attachments.get(name)
+        if att is None:
+            raise not_found("Document is missing attachment")
+        return 200, att["data"], {"Content-Type": att["content_type"], "ETag": '"{0}"'.format(att["digest"])}
+    if method == "PUT":
+        content_type = headers.get("Content-Type", "application/octet-stream")
+        return 201, db.put_attachment(doc_id, params.get("rev"), name, body, content_type), {}
+    if method == "DELETE":
+        return 200, db.delete_attachment(doc_id, params.get("rev"), name), {}
+    raise CouchError(405, "method_not_allowed", "Only GET,HEAD,PUT,DELETE allowed")
+
+
+def _bulk_docs(db, payload):
+    new_edits = payload.get("new_edits", True)
+    results = []
+    for doc in payload.get("docs", []):
+        try:
+            results.append(db.update(doc, new_edits=new_edits))
+        except CouchError as e:
+            results.append({"id": doc.get("_id"), "error": e.error, "reason": e.reason})
+    return [] if not new_edits else results
+
+
+def _all_docs(db, params, keys):
+    include_docs = _boolean(params, "include_docs")
+    with db.lock:
+        total = len(db.docs) - db.doc_del_count
+        if keys is not None:
+            rows = []
+            for key in keys[int(params.get("skip", 0)):]:
+                doc = db.docs.get(key)
+                if doc is None:
+                    rows.append({"key": key, "error": "not_found"})
+                    continue
+                value = {"rev": doc.rev, "deleted": True} if doc.deleted else {"rev": doc.rev}
+                row = {"id": doc.id, "key": doc.id, "value": value}
+                if include_docs:
+                    row["doc"] = None if doc.deleted else doc.to_dict()
+                rows.append(row)
+            if "limit" in params:
+                rows = rows[:int(params["limit"])]
+            return {"total_rows": total, "offset": 0, "rows": rows}
+        selected, offset = _id_range(db.ids, params)
+        rows = []
+        for doc_id in selected:
+            doc = db.docs[doc_id]
+            row = {"id": doc_id, "key": doc_id, "value": {"rev": doc.rev}}
+            if include_docs:
+                row["doc"] = doc.to_dict()
+            rows.append(row)
+        return {"total_rows": total, "offset": offset, "rows": rows}
+
+
+# the ids of the _all_docs rows params ask for and their offset, found by
+# bisecting the sorted ids instead of going through every document
+def _id_range(ids, params):
+    has_start, startkey = _json_param(params, "startkey", "start_key")
+    has_end, endkey = _json_param(params, "endkey", "end_key")
+    has_key, key = _json_param(params, "key")
+    if has_key:
+        has_start = has_end = True
+        startkey = endkey = key
+    inclusive_end = _boolean(params, "inclusive_end", True)
+    skip = int(params.get("skip", 0))
+    limit = params.get("limit")
+    if _boolean(params, "descending"):
+        # from first down to last, both included
+        first = bisect.bisect_right(ids, startkey) - 1 if has_start else len(ids) - 1
+        last = 0
+        if has_end:
+            last = bisect.bisect_left(ids, endkey) if inclusive_end else bisect.bisect_right(ids, endkey)
+        count = max(0, first - skip - last + 1)
+        if limit is not None:
+            count = min(count, int(limit))
+        begin = first - skip
+        return ids[begin - count + 1:begin + 1][::-1], len(ids) - 1 - first + skip
+    first = bisect.bisect_left(ids, startkey) if has_start else 0
+    stop = len(ids)
+    if has_end:
+        stop = bisect.bisect_right(ids, endkey) if inclusive_end else bisect.bisect_left(ids, endkey)
+    begin = first + skip
+    if limit is not None:
+        stop = min(stop, begin + int(limit))
+    return ids[begin:max(begin, stop)], first + skip
+
+
+def _query_view(db, design, name, params, keys):
+    stale = params.pop("stale", None)
+    index = db.view(design, name, update=stale not in ("ok", "update_after"))
+    if stale == "update_after":
+        updater = threading.Thread(target=db.view, args=(design, name))
+        updater.daemon = True
+        updater.start()
+    if not index.reduce_source:
+        if "group" in params or "group_level" in params:
+            raise CouchError(400, "query_parse_error", "Invalid use of grouping on a map view.")
+        if _boolean(params, "reduce"):
+            raise CouchError(400, "query_parse_error", "Reduce is invalid for map-only views.")
+    with db.lock:
+        rows = index.sorted_rows()
+        reduce = index.reduce_source and _boolean(params, "reduce", True)
+        if not reduce:
+            selected, offset = select_rows(rows, params, keys)
+            result = []
+            for _, doc_id, key, value in selected:
+                row = {"id": doc_id, "key": key, "value": value}
+                if _boolean(params, "include_docs"):
+                    doc = db.docs.get(doc_id)
+                    row["doc"] = doc.to_dict() if doc and not doc.deleted else None
+                result.append(row)
+            return {"total_rows": len(rows), "offset": offset, "rows": result}
+        limit = params.pop("limit", None)
+        skip = params.pop("skip", 0)
+        selected, offset = select_rows(rows, params, keys)
+        group_level = params.get("group_level")
+        if group_level is not None:
+            group_level = int(group_level)
+        elif _boolean(params, "group"):
+            group_level = sys.maxint
+        groups = []
+        for _, doc_id, key, value in selected:
+            if group_level is None:
+                group = None
+            elif isinstance(key, list):
+                group = key[:group_level]
+            else:
+                group = key
+            if groups and groups[-1][0] == group:
+                groups[-1][1].append([key, doc_id])
+                groups[-1][2].append(value)
+            else:
+                groups.append((group, [[key, doc_id]], [value]))
+        result = [{"key": group, "value": index.reduce(group_keys, values)} for group, group_keys, values in groups]
+        result = result[int(skip):]
+        if limit is not None:
+            result = result[:int(limit)]
+        return {"rows": result}
+
+
+def _design_info(db, design):
+    ddoc = db.get("_design/" + design)
+    indexes = [index for (d, n), index in db.views.items() if d == design]
+    return {"name": design, "view_index": {
+        "signature": hashlib.md5(json.dumps(ddoc.body.get("views"), sort_keys=True)).hexdigest(),
+        "language": ddoc.body.get("language", "javascript"),
+        "update_seq": min([index.seq for index in indexes] or [0]), "purge_seq": 0,
+        "updater_running": any(index.updating for index in indexes), "compact_running": False,
+        "waiting_clients": 0, "waiting_commit": False, "disk_size": sum(index.size for index in indexes)}}
+
+
+def _changes(db, params):
+    since = int(params.get("since", 0))
+    include_docs = _boolean(params, "include_docs")
+    selector = None
+    if params.get("filter"):
+        design, name = params["filter"].split("/", 1)
+        ddoc = db.get("_design/" + design)
+        source = (ddoc.body.get("filters") or {}).get(name)
+        if source is None:
+            raise not_found("missing json key: " + name)
+        request = {"query": params}
+        function = compile_function(source)
+        selector = lambda doc: _safe_filter(function, doc, request)
+    results = []
+    last_seq = since
+    limit = int(params["limit"]) if "limit" in params else None
+    for doc in db.changes(since):
+        last_seq = doc.seq
+        body = doc.to_dict()
+        if selector and not selector(body):
+            continue
+        change = {"seq": doc.seq, "id": doc.id, "changes": [{"rev": doc.rev}]}
+        if doc.deleted:
+            change["deleted"] = True
+        if include_docs:
+            change["doc"] = body
+        results.append(change)
+        if limit is not None and len(results) >= limit:
+            break
+    return {"results": results, "last_seq": last_seq}
+
+
+def _safe_filter(function, doc, request):
+    try:
+        return function(doc, request)
+    except (JSError, TypeError, ValueError, AttributeError):
+        return False
+
+
+def _session(couch, method, payload):
+    if method == "DELETE":
+        return 200, {"ok": True}, {"Set-Cookie": "AuthSession=; Version=1; Path=/; HttpOnly"}
+    if method == "POST":
+        name, password = (payload or {}).get("name"), (payload or {}).get("password")
+        users = couch.config["couch_httpd_auth"]["authentication_db"]
+        try:
+            user = couch.db(users).get("org.couchdb.user:{0}".format(name)).body
+        except CouchError:
+            user = None
+        if not user or hashlib.sha1((password or "") + user.get("salt", "")).hexdigest() != user.get("password_sha"):
+            raise CouchError(401, "unauthorized", "Name or password is incorrect.")
+        cookie = base64.b64encode("{0}:{1:X}".format(name, int(time.time())))
+        return 200, {"ok": True, "name": name, "roles": user.get("roles", [])}, \
+            {"Set-Cookie": "AuthSession={0}; Version=1; Path=/; HttpOnly".format(cookie)}
+    return 200, {"ok": True, "userCtx": {"name": None, "roles": ["_admin"]},
+                 "info": {"authentication_db": couch.config["couch_httpd_auth"]["authentication_db"],
+                          "authentication_handlers": ["oauth", "cookie", "default"]}}, {}
+
+
+def _config(couch, method, path, payload):
+    if not path:
+        return 200, couch.config, {}
+    section = couch.config.setdefault(path[0], {})
+    if len(path) == 1:
+        return 200, section, {}
+    key = path[1]
+    old = section.get(key, "")
+    if method == "PUT":
+        # the suites send {key: value}, CouchDB itself takes a JSON string
+        section[key] = payload.get(key) if isinstance(payload, dict) else payload
+    elif method == "DELETE":
+        if key not in section:
+            raise not_found("unknown_config_value")
+        del section[key]
+    elif key not in section:
+        raise not_found("unknown_config_value")
+    return 200, old, {}
+
+
+if __name__ == "__main__":
+    servers = [FakeCouch(int(port)).start() for port in sys.argv[1:] or ["5984"]]
+    print "serving {0}".format(", ".join(server.url for server in servers))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.stop()
@@ -0,0 +1,154 @@
+import json
+import random
+import threading
+import time
+import unittest
+import uuid
+from nose import tools
+from testconfig import config
+from docmaker import DocumentGenerator
+from designs import design_info
+from stats import LatencyHistogram, percentiles
+from uploader import BulkWriter
+import connpool
+import loadgen
+import stats
+import logger
+
+log = logger.logger("freshness")
+
+# [freshness] settings in tests.ini and their defaults. rate is the writes a
+# second the load keeps up throughout, each of modes (the stale parameter,
+# false for none) is queried every interval seconds for phase_seconds.
+defaults = {"docs": 10000, "rate": 200, "workers": 16, "modes": "false,ok,update_after", "phase_seconds": 30,
+            "interval": 1, "results": "freshness-results.jsonl"}
+
+DESIGN = {
+    "_id": "_design/freshness",
+    "language": "javascript",
+    "views": {
+        "by_written": {"map": "function(doc) { if (doc.written) emit(doc.written, null); }"}
+    }
+}
+
+
+# measures how far behind the writes a view is while they keep coming. an
+# open loop load updates random documents with the time they were written,
+# and every interval the newest write the view returns is compared with the
+# time the query was sent (lag_seconds), and the update_seq of the view index
+# with the one of the database (seq_lag). the stale modes are queried one
+# after the other, each for phase_seconds, as a stale=false query would
+# bring the index up to date for the others.
+class FreshnessProbe(object):
+    def __init__(self, db, params=None):
+        self.params = dict(defaults, **(params or {}))
+        self.db = db
+        self.modes = [mode.strip() for mode in self.params["modes"].split(",") if mode.strip()]
+        self.docs = DocumentGenerator.make_docs(int(self.params["docs"]), {"value": "${rand_int:0:1000}",
+                                                                          "payload": "${padding}"}, {"size": 256})
+        self.timeline = []
+        self.latency = dict((mode, LatencyHistogram()) for mode in self.modes)
+
+    # loads the documents and builds the index before anything is measured
+    def preload(self):
+        BulkWriter(self.db).write(self.docs)
+        self.db.save_doc(dict(DESIGN))
+        self.db.view("freshness/by_written", limit=1).all()
+
+    def _write(self, i):
+        doc = self.db.get(self.docs[random.randrange(len(self.docs))]["_id"])
+        doc["written"] = time.time()
+        self.db.save_doc(doc)
+
+    def run(self):
+        phase = float(self.params["phase_seconds"])
+        reports = []
+        writer = threading.Thread(target=lambda: reports.append(loadgen.run(
+            self._write, profile="constant", rate=self.params["rate"], workers=self.params["workers"],
+            duration=phase * len(self.modes) + 1)), name="freshness-writer")
+        writer.start()
+        self._start = time.time()
+        # the first writes land before the first query
+        time.sleep(1)
+        for mode in self.modes:
+            end = time.time() + phase
+            while time.time() < end:
+                self.probe(mode)
+                time.sleep(max(0, min(float(self.params["interval"]), end - time.time())))
+        writer.join()
+        report = self.report(reports[0] if reports else None)
+        with open(self.params["results"], "a") as f:
+            f.write(json.dumps(dict(report, time=time.time())) + "\n")
+        return report
+
+    def probe(self, mode):
+        params = {"descending": True, "limit": 1}
+        if mode != "false":
+            params["stale"] = mode
+        start = time.time()
+        rows = self.db.view("freshness/by_written", **params).all()
+        latency = time.time() - start
+        self.latency[mode].record(latency)
+        # read once the query has returned, with update_after this shows
+        # whether the update it started has caught up
+        index_seq = design_info(self.db, DESIGN["_id"])["update_seq"]
+        point = {"mode": mode, "elapsed": start - self._start, "latency": latency,
+                 "lag_seconds": start - rows[0]["key"] if rows else None,
+                 "seq_lag": self.db.info()["update_seq"] - index_seq}
+        self.timeline.append(point)
+        log.info("{elapsed:.1f}s stale={mode}: {latency:.4f}s, {seq_lag} changes behind".format(**point) +
+                 (", newest write {0:.2f}s old".format(point["lag_seconds"]) if rows else ""))
+        return point
+
+    def report(self, writes=None):
+        modes = {}
+        for mode in self.modes:
+            points = [point for point in self.timeline if point["mode"] == mode]
+            lags = [point["lag_seconds"] for point in points if point["lag_seconds"] is not None]
+            seq_lags = [point["seq_lag"] for point in points]
+            modes[mode] = {"queries": len(points), "latency": self.latency[mode].summary(),
+                           "lag_seconds": dict(percentiles(lags), max=max(lags) if lags else None),
+                           "seq_lag": dict(percentiles(seq_lags), max=max(seq_lags) if seq_lags else None)}
+            lag = modes[mode]["lag_seconds"]
+            log.info("stale={0}: {1} queries, p99 {2}s, {3}, p99 {4} changes behind".format(
+                mode, len(points), modes[mode]["latency"]["p99"],
+                "newest write p50 {0:.2f}s p99 {1:.2f}s old".format(lag[50], lag[99]) if lags else "no writes seen",
+                modes[mode]["seq_lag"][99]))
+        return {"modes": modes, "writes": writes, "timeline": self.timeline}
+
+
+# how long a write takes to show up in a view while writes keep coming, with
+# stale=false, ok and update_after queries. a run takes phase_seconds for each
+# of the modes, so it is kept out of the functional view suite
+class ViewFreshnessTests(unittest.TestCase):
+    cleanup_dbs = []
+
+    def setUp(self):
+        stats.start_test()
+        self.node = config['couchdb-local']
+        self.params = dict(defaults, **config.get("freshness", {}))
+        self.server = connpool.server(self.node)
+
+    def tearDown(self):
+        stats.dump_test(self.id())
+        for db in self.cleanup_dbs:
+            try:
+                self.server.delete_db(db)
+            except Exception:
+                pass
+        self.cleanup_dbs = []
+
+    def _get_db_name(self):
+        name = "doctests-{0}".format(str(uuid.uuid4())[:6])
+        self.cleanup_dbs.append(name)
+        return name
+
+    def test_view_freshness_under_writes(self):
+        db = self.server.create_db(self._get_db_name())
+        probe = FreshnessProbe(db, self.params)
+        probe.preload()
+        report = probe.run()
+        for mode, summary in report["modes"].items():
+            tools.ok_(summary["queries"] > 0, msg="no stale={0} queries".format(mode))
+        if "false" in report["modes"] and "ok" in report["modes"]:
+            tools.ok_(report["modes"]["false"]["seq_lag"][50] <= report["modes"]["ok"]["seq_lag"][50])
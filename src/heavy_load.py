@@ -1,11 +1,20 @@
+import copy
 import random
+import sys
 import time
 from threading import Thread
 import unittest
 from nose import tools
 import uuid
 from testconfig import config
-from couchdbkit import client
+from docmaker import DocRecord
+from uploader import BulkWriter, WriterPool, dedicated_db
+from designs import MULTI_VIEW_DESIGN, MULTI_VIEW_QUERIES, reduces
+import connpool
+import profiling
+import loadgen
+import stats
+import viewstream
 import logger
 
 class HeavyLoadTests(unittest.TestCase):
@@ -15,6 +24,8 @@ class HeavyLoadTests(unittest.TestCase):
     cleanup_dbs = []
 
     def setUp(self):
+        stats.start_test()
+        self.profile = profiling.start_test(self.id())
         self.log = logger.logger("basictests")
         
         node_names = ['couchdb-local', 'couchdb-remote-1', 'couchdb-remote-2']
@@ -22,10 +33,12 @@ class HeavyLoadTests(unittest.TestCase):
             node = config[name]
             self.nodes.append(node)
             url = "http://{0}:{1}/".format(node['ip'], node['port'])
-            server = client.Server(url, full_commit=False)
+            server = connpool.server(url)
             self.servers.append(server)
         
     def tearDown(self):
+        stats.dump_test(self.id())
+        profiling.stop_test(self.profile)
         for db in self.cleanup_dbs:
             for server in self.servers:
                 try:
@@ -48,6 +61,8 @@ class HeavyLoadTests(unittest.TestCase):
     def _isodd(self, num):
         return num & 1 and True or False
 
+    _random_doc_keys = DocRecord.schema(["_id", "a", "b", "c", "type"])
+
     def _random_docs(self, howmany=1, baseid=0):
         docs = []
         for i in range(howmany):
@@ -59,32 +74,9 @@ class HeavyLoadTests(unittest.TestCase):
             else:
                 type = "even"
             #have random key-values here ?
-            doc = {"_id": id, "a": v1, "b": v2, "c": str(uuid.uuid4())[:6], "type":type }
-            docs.append(doc)
+            docs.append(DocRecord(self._random_doc_keys, (id, v1, v2, str(uuid.uuid4())[:6], type)))
         return docs
 
-    def _crud_db(self, db, num_docs):
-        num_del = random.randint(0, num_docs) / 10
-        del_ids = []
-        for i in range(num_del):
-            del_ids.append(random.randint(0, num_docs))
-
-        for doc in range(num_docs):
-            id = "crud_{0}".format(random.randint(0, num_docs))
-            try:
-                fetched = db.get(id)
-                fetched["c"] = "new field"
-                db.save_doc(fetched)
-            except Exception:
-                self.log.info(id)
-                pass
-        for i in range(num_del):
-            id = "crud_{0}".format(del_ids[i])
-            try:
-                db.del_doc(id)
-            except Exception:
-                pass
-
     def _populate_database(self, server, server_ip, num_db, num_doc, num_attachment, first_only=False):
         text_attachment = "a text attachment"
 
@@ -94,100 +86,82 @@ class HeavyLoadTests(unittest.TestCase):
             local_dbs.append(db_name)
             db = server.get_or_create_db(db_name)
             if i == 0 or not first_only:
+                docs = []
                 for j in range(num_doc):
                     if self._isodd(j):
                         doc = {"_id": str(j), "a": j, "b": str(uuid.uuid4())[:6], "node": server_ip, "type": "odd" }
                     else:
                         doc = {"_id": str(j), "a": j, "b": str(uuid.uuid4())[:6], "node": server_ip, "type": "even" }
-                    db.save_doc(doc)
+                    docs.append(doc)
+                BulkWriter(db).write(docs)
+                for doc in docs:
                     for k in range(num_attachment):
                         db.put_attachment(doc, text_attachment, "test_" + str(k), "text/plain")
 
         return local_dbs
 
-    def _upload_docs(self, db, docs):
-        db.bulk_save(docs)
-
-    def _quick_upload_datdabase(self, db, num_doc, num_writer):
-        for i in range(num_writer):
-            docs = self._random_docs(num_doc, i*num_doc)
-            writer = Thread(target=self._upload_docs, args=(db, docs,))
-            writer.start()
-            writer.join()
+    def _quick_upload_datdabase(self, db, num_doc, num_writer, batch_size=1000, rate_limit=None):
+        sources = [self._random_docs(num_doc, i*num_doc) for i in range(num_writer)]
+        pool = WriterPool(lambda: dedicated_db(db.server_uri, db.dbname), batch_size, rate_limit)
+        return pool.run(sources)
 
     def _multi_design_view(self, db):
         design_name = "_design/test"
-        design_doc = {
-            "_id": design_name,
-            "language": "javascript",
-            "views": {
-                "all_docs": {
-                    "map": "function(doc) { emit([doc.a, doc.b, doc.type], 1) };",
-                    "reduce": "function(keys, values) { return _count; }"
-                },
-                "multi_emit": {
-                    "map": "function(doc) {for(var i = 0 ; i < 3 ; i++) { emit(i, doc.a) ; } }"
-                },
-                "summate": {
-                    "map": "function (doc) {emit(doc.type, 1)};",
-                    "reduce": "function (keys, values) { return _count; };"
-                },
-                "get_by_a" : {
-                    "map": "function(doc) { if (doc.a > 50) emit(doc.a, 1) };"
-                },
-                "get_by_b" : {
-                    "map": "function(doc) { if (doc.b < 1000) emit(doc.b, 1) };",
-                    "reduce": "function(keys, values) { return _sum; };"
-                },
-                "get_by_c" : {
-                    "map": "function(doc) { emit(doc.c, [doc.a, doc.type]); };"
-                },
-                "get_by_ab" : {
-                    "map": "function(doc) { if (a > b) emit([doc.a, doc.b], 1); }",
-                    "reduce": "function(keys, values) { return _count; }"
-                },
-                "get_even" : {
-                    "map": """function(doc) { if (doc.type == "even") emit(null, 1);}"""
-                },
-                "get_odd" : {
-                    "map": """function(doc) { if (doc.type == "odd") emit(null, 1);}"""
-                }
-            }
-        };
+        design_doc = copy.deepcopy(MULTI_VIEW_DESIGN)
 
         if not db.doc_exist(design_name):
             db.save_doc(design_doc)
 
+    # one crud operation for the open loop driver: a random document is
+    # updated, or deleted one time in ten
+    def _crud_operation(self, db, num_docs):
+        def operation(i):
+            id = "crud_{0}".format(random.randint(0, num_docs - 1))
+            if random.random() < 0.1:
+                db.delete_doc(id)
+            else:
+                fetched = db.get(id)
+                fetched["c"] = "new field"
+                db.save_doc(fetched)
+        return operation
+
+    # the corpus size comes from [load] docs, loaded by [load] writers threads,
+    # and the crud load that runs while the views are queried from the [load]
+    # profile, see loadgen.py
     def test_heavy_load_single_db(self):
-        num_db = 1
-        num_doc = 10000
-        num_writer = 20
+        load = config.get("load", {})
+        num_writer = int(load.get("writers", 20))
+        num_doc = int(load.get("docs", 200000)) / num_writer
         db_name = self._get_db_name()
         db = self.servers[0].get_or_create_db(db_name)
         self._quick_upload_datdabase(db, num_doc, num_writer)
-        all_docs = db.all_docs()
-        self.assertEqual(all_docs.total_rows, num_writer * num_doc)
+        self.assertEqual(viewstream.total_rows(db), num_writer * num_doc)
         
         self._multi_design_view(db)
 
-        running = Thread(target=self._crud_db, args=(db,num_writer * num_doc,))
+        reports = []
+        failures = []
+
+        def crud_load():
+            try:
+                reports.append(loadgen.run(self._crud_operation(db, num_writer * num_doc), load))
+            except Exception:
+                failures.append(sys.exc_info())
+        running = Thread(target=crud_load)
         running.start()
 
-        rows = db.view("test/all_docs")
-        rows = db.view("test/multi_emit", startkey=100, endkey=300)
-        rows = db.view("test/summate", reduce=True, startkey_docid="1000", endkey_docid="4000")
-        rows = db.view("test/get_by_a", descending=True)
-        rows = db.view("test/get_by_b", group=True)
-        rows = db.view("test/get_by_c", group=True)
-        rows = db.view("test/get_by_ab", group_level=1)
-        rows = db.view("test/get_even")
-        rows = db.view("test/get_odd")
+        for view, params in MULTI_VIEW_QUERIES:
+            if reduces(view):
+                count = len(db.view(view, **params).all())
+            else:
+                # the rows of a map are streamed a page at a time, see viewstream.py
+                count = sum(1 for row in viewstream.rows(db, view, **params))
+            self.log.info("{0} returned {1} rows".format(view, count))
         
         running.join()
-        
-
-
-
-
-    
-
+        # a failure in the load thread would otherwise only show up as a
+        # missing report
+        if failures:
+            raise failures[0][0], failures[0][1], failures[0][2]
+        self.assertTrue(reports, "the crud load did not report")
+        self.log.info("crud load: {0}".format(reports[0]))
@@ -0,0 +1,637 @@
+import json
+import math
+import random
+import re
+
+# a small interpreter for the javascript the suites put in design documents:
+# map, reduce and filter functions made of var/if/else/for/for-in/while/return
+# statements, the usual operators, object and array literals and a few string,
+# array and Math methods. it is not javascript, undefined and null are both
+# None and there are no prototypes, but it is enough for fakecouch to run the
+# views and filters of this repo.
+
+_TOKENS = re.compile(r"""\s*(?:(//[^\n]*|/\*.*?\*/)
+                      |(\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)
+                      |("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')
+                      |([A-Za-z_$][\w$]*)
+                      |(===|!==|==|!=|<=|>=|&&|\|\||\+\+|--|\+=|-=|\*=|/=|[-+*/%<>!=?:.,;(){}\[\]]))""",
+                     re.S | re.X)
+
+_KEYWORDS = {"true": True, "false": False, "null": None, "undefined": None}
+
+# statements this interpreter does not run, rejected when the function is
+# compiled rather than taken for names that fail once it is called
+_UNSUPPORTED = ("try", "catch", "finally", "throw", "switch", "case", "do", "delete", "with", "class")
+
+
+class JSError(Exception):
+    pass
+
+
+class _Return(Exception):
+    def __init__(self, value):
+        self.value = value
+
+
+class _Break(Exception):
+    pass
+
+
+class _Continue(Exception):
+    pass
+
+
+def _tokenize(source):
+    tokens = []
+    pos = 0
+    source = source.rstrip()
+    while pos < len(source):
+        match = _TOKENS.match(source, pos)
+        if not match or match.end() == pos:
+            raise JSError("unexpected character at {0}: {1!r}".format(pos, source[pos:pos + 20]))
+        pos = match.end()
+        comment, number, string, name, op = match.groups()
+        if number:
+            tokens.append(("num", float(number) if "." in number or "e" in number.lower() else int(number)))
+        elif string:
+            tokens.append(("str", string[1:-1].decode("string_escape")))
+        elif name:
+            tokens.append(("name", name))
+        elif op:
+            tokens.append(("op", op))
+    tokens.append(("end", None))
+    return tokens
+
+
+class _Scope(object):
+    def __init__(self, names, parent=None):
+        self.names = names
+        self.parent = parent
+
+    def find(self, name):
+        scope = self
+        while scope is not None:
+            if name in scope.names:
+                return scope
+            scope = scope.parent
+        return None
+
+    def get(self, name):
+        scope = self.find(name)
+        if scope is None:
+            raise JSError("ReferenceError: {0} is not defined".format(name))
+        return scope.names[name]
+
+    def set(self, name, value):
+        (self.find(name) or self).names[name] = value
+
+
+def truthy(value):
+    if isinstance(value, (list, dict)):
+        return True
+    if isinstance(value, float) and value != value:
+        return False
+    return bool(value)
+
+
+def to_string(value):
+    if value is None:
+        return "null"
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if isinstance(value, float) and value == int(value):
+        return str(int(value))
+    if isinstance(value, (int, long, float)):
+        return repr(value)
+    if isinstance(value, list):
+        return ",".join("" if v is None else to_string(v) for v in value)
+    if isinstance(value, dict):
+        return "[object Object]"
+    return value
+
+
+def _add(a, b):
+    if isinstance(a, basestring) or isinstance(b, basestring):
+        return to_string(a) + to_string(b)
+    return a + b
+
+
+# the sign of the dividend like javascript, an int when both are ints
+def _modulo(a, b):
+    if not b:
+        return float("nan")
+    if isinstance(a, (int, long)) and isinstance(b, (int, long)):
+        return int(math.fmod(a, b))
+    return math.fmod(a, b)
+
+
+def _divide(a, b):
+    if b == 0:
+        return float("nan") if a == 0 else math.copysign(float("inf"), a)
+    return float(a) / b if isinstance(a, (int, long)) and isinstance(b, (int, long)) and a % b else a / b
+
+
+def _compare(op):
+    def compare(a, b):
+        # comparisons with undefined are always false in javascript
+        if a is None or b is None:
+            return False
+        return op(a, b)
+    return compare
+
+
+_BINARY = {
+    "+": _add, "-": lambda a, b: a - b, "*": lambda a, b: a * b, "/": _divide, "%": _modulo,
+    "==": lambda a, b: a == b, "===": lambda a, b: a == b, "!=": lambda a, b: a != b, "!==": lambda a, b: a != b,
+    "<": _compare(lambda a, b: a < b), ">": _compare(lambda a, b: a > b),
+    "<=": _compare(lambda a, b: a <= b), ">=": _compare(lambda a, b: a >= b),
+}
+
+_PRECEDENCE = [("||",), ("&&",), ("==", "!=", "===", "!=="), ("<", ">", "<=", ">="), ("+", "-"), ("*", "/", "%")]
+
+
+def _string_method(value, name):
+    methods = {
+        "indexOf": lambda s, start=0: value.find(s, int(start)),
+        "substring": lambda start, end=None: value[int(start):None if end is None else int(end)],
+        "substr": lambda start, length=None: value[int(start):None if length is None else int(start) + int(length)],
+        "charAt": lambda i: value[int(i):int(i) + 1],
+        "toLowerCase": lambda: value.lower(),
+        "toUpperCase": lambda: value.upper(),
+        "split": lambda sep: value.split(sep) if sep else list(value),
+        "trim": lambda: value.strip(),
+    }
+    return methods.get(name)
+
+
+def _array_method(value, name):
+    def push(*items):
+        value.extend(items)
+        return len(value)
+    methods = {
+        "push": push,
+        "indexOf": lambda item: value.index(item) if item in value else -1,
+        "join": lambda sep=",": to_string(sep).join(to_string(v) for v in value),
+        "concat": lambda *others: value + [v for other in others for v in (other if isinstance(other, list) else [other])],
+        "slice": lambda start=0, end=None: value[int(start):None if end is None else int(end)],
+        "forEach": lambda fn: [fn(v, i) for i, v in enumerate(value)] and None,
+    }
+    return methods.get(name)
+
+
+def get_member(obj, name):
+    if isinstance(obj, dict):
+        if name == "hasOwnProperty":
+            return lambda key: key in obj
+        return obj.get(name)
+    if isinstance(obj, basestring):
+        return len(obj) if name == "length" else _string_method(obj, name)
+    if isinstance(obj, list):
+        if name == "length":
+            return len(obj)
+        if isinstance(name, basestring) and name.isdigit():
+            name = int(name)
+        if isinstance(name, (int, long, float)):
+            return obj[int(name)] if 0 <= name < len(obj) else None
+        return _array_method(obj, name)
+    if obj is None:
+        raise JSError("TypeError: cannot read property {0} of null".format(name))
+    return None
+
+
+def set_member(obj, name, value):
+    if isinstance(obj, list):
+        index = int(name)
+        while len(obj) <= index:
+            obj.append(None)
+        obj[index] = value
+    elif isinstance(obj, dict):
+        obj[to_string(name) if not isinstance(name, basestring) else name] = value
+    else:
+        raise JSError("TypeError: cannot set property {0}".format(name))
+
+
+class _Parser(object):
+    def __init__(self, source):
+        self.tokens = _tokenize(source)
+        self.pos = 0
+        self.ref = None
+
+    def peek(self, value=None):
+        kind, token = self.tokens[self.pos]
+        if value is None:
+            return token
+        return kind in ("op", "name") and token == value
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expect(self, value):
+        kind, token = self.next()
+        if token != value:
+            raise JSError("expected {0!r} but found {1!r}".format(value, token))
+
+    def accept(self, value):
+        if self.peek(value):
+            self.pos += 1
+            return True
+        return False
+
+    # statements compile to functions of a scope that return nothing, control
+    # flow uses the _Return, _Break and _Continue exceptions
+    def statement(self):
+        if self.accept("{"):
+            body = []
+            while not self.accept("}"):
+                body.append(self.statement())
+            return lambda scope: [s(scope) for s in body] and None
+        if self.accept(";"):
+            return lambda scope: None
+        if self.accept("var"):
+            declarations = []
+            while True:
+                kind, name = self.next()
+                value = self.assignment() if self.accept("=") else (lambda scope: None)
+                declarations.append((name, value))
+                if not self.accept(","):
+                    break
+            self.accept(";")
+
+            def declare(scope):
+                for name, value in declarations:
+                    scope.names[name] = value(scope)
+            return declare
+        if self.accept("if"):
+            self.expect("(")
+            condition = self.expression()
+            self.expect(")")
+            then = self.statement()
+            otherwise = self.statement() if self.accept("else") else None
+
+            def branch(scope):
+                if truthy(condition(scope)):
+                    then(scope)
+                elif otherwise:
+                    otherwise(scope)
+            return branch
+        if self.accept("for"):
+            return self.for_statement()
+        if self.accept("while"):
+            self.expect("(")
+            condition = self.expression()
+            self.expect(")")
+            body = self.statement()
+            return self.loop(condition, body, lambda scope: None)
+        if self.accept("return"):
+            value = (lambda scope: None) if self.peek(";") or self.peek("}") else self.expression()
+            self.accept(";")
+
+            def do_return(scope):
+                raise _Return(value(scope))
+            return do_return
+        if self.accept("break"):
+            self.accept(";")
+
+            def do_break(scope):
+                raise _Break()
+            return do_break
+        if self.accept("continue"):
+            self.accept(";")
+
+            def do_continue(scope):
+                raise _Continue()
+            return do_continue
+        if self.peek("function") and self.tokens[self.pos + 1][0] == "name":
+            self.next()
+            kind, name = self.next()
+            function = self.function_body()
+
+            def define(scope):
+                scope.names[name] = function(scope)
+            return define
+        expression = self.expression()
+        self.accept(";")
+        return expression
+
+    def loop(self, condition, body, update):
+        def run(scope):
+            while truthy(condition(scope)):
+                try:
+                    body(scope)
+                except _Break:
+                    break
+                except _Continue:
+                    pass
+                update(scope)
+        return run
+
+    def for_statement(self):
+        self.expect("(")
+        if self.tokens[self.pos + 2][1] == "in" or self.tokens[self.pos + 1][1] == "in":
+            self.accept("var")
+            kind, name = self.next()
+            self.expect("in")
+            collection = self.expression()
+            self.expect(")")
+            body = self.statement()
+
+            def for_in(scope):
+                value = collection(scope)
+                keys = [str(i) for i in range(len(value))] if isinstance(value, list) else list(value or {})
+                for key in keys:
+                    scope.set(name, key)
+                    try:
+                        body(scope)
+                    except _Break:
+                        break
+                    except _Continue:
+                        pass
+            return for_in
+        init = self.statement() if not self.peek(";") else (lambda scope: None)
+        if not self.tokens[self.pos - 1][1] == ";":
+            self.expect(";")
+        condition = self.expression() if not self.peek(";") else (lambda scope: True)
+        self.expect(";")
+        update = self.expression() if not self.peek(")") else (lambda scope: None)
+        self.expect(")")
+        body = self.statement()
+        run = self.loop(condition, body, update)
+
+        def for_loop(scope):
+            init(scope)
+            run(scope)
+        return for_loop
+
+    def function_body(self):
+        self.expect("(")
+        params = []
+        while not self.accept(")"):
+            params.append(self.next()[1])
+            self.accept(",")
+        self.expect("{")
+        self.pos -= 1
+        body = self.statement()
+
+        def make(scope):
+            def function(*args):
+                names = dict(zip(params, args))
+                names["arguments"] = list(args)
+                try:
+                    body(_Scope(names, scope))
+                except _Return as e:
+                    return e.value
+                return None
+            return function
+        return make
+
+    def expression(self):
+        first = self.assignment()
+        if not self.peek(","):
+            return first
+        rest = []
+        while self.accept(","):
+            rest.append(self.assignment())
+
+        def sequence(scope):
+            value = first(scope)
+            for e in rest:
+                value = e(scope)
+            return value
+        return sequence
+
+    def assignment(self):
+        start = self.pos
+        target = self.ternary()
+        op = self.peek()
+        if op in ("=", "+=", "-=", "*=", "/=") and self.tokens[self.pos][0] == "op":
+            setter = self.setter(start)
+            self.next()
+            value = self.assignment()
+            if op == "=":
+                return lambda scope: setter(scope, lambda current: value(scope))
+            binary = _BINARY[op[0]]
+            return lambda scope: setter(scope, lambda current: binary(current, value(scope)))
+        return target
+
+    # postfix() remembers the name or member access it parsed last, this turns
+    # it into a setter taking a function of the current value when it spans
+    # the tokens from start up to here
+    def setter(self, start):
+        if not self.ref or self.ref[0] != start or self.ref[1] != self.pos:
+            raise JSError("invalid assignment target")
+        ref = self.ref[2]
+        if ref[0] == "name":
+            name = ref[1]
+
+            def set_name(scope, update):
+                found = scope.find(name)
+                value = update(found.names[name] if found else None)
+                scope.set(name, value)
+                return value
+            return set_name
+        obj, key = ref[1], ref[2]
+
+        def set_item(scope, update):
+            container, name = obj(scope), key(scope)
+            value = update(get_member(container, name))
+            set_member(container, name, value)
+            return value
+        return set_item
+
+    def ternary(self):
+        condition = self.binary(0)
+        if not self.accept("?"):
+            return condition
+        then = self.assignment()
+        self.expect(":")
+        otherwise = self.assignment()
+        return lambda scope: then(scope) if truthy(condition(scope)) else otherwise(scope)
+
+    def binary(self, level):
+        if level == len(_PRECEDENCE):
+            return self.unary()
+        left = self.binary(level + 1)
+        while self.tokens[self.pos][0] == "op" and self.peek() in _PRECEDENCE[level]:
+            op = self.next()[1]
+            right = self.binary(level + 1)
+            if op == "&&":
+                left = (lambda l, r: lambda scope: (lambda v: r(scope) if truthy(v) else v)(l(scope)))(left, right)
+            elif op == "||":
+                left = (lambda l, r: lambda scope: (lambda v: v if truthy(v) else r(scope))(l(scope)))(left, right)
+            else:
+                left = (lambda l, r, f: lambda scope: f(l(scope), r(scope)))(left, right, _BINARY[op])
+        return left
+
+    def unary(self):
+        if self.tokens[self.pos][0] == "op" and self.peek() in ("!", "-", "+", "++", "--"):
+            op = self.next()[1]
+            if op in ("++", "--"):
+                start = self.pos
+                self.postfix()
+                setter = self.setter(start)
+                delta = 1 if op == "++" else -1
+                return lambda scope: setter(scope, lambda current: current + delta)
+            operand = self.unary()
+            if op == "!":
+                return lambda scope: not truthy(operand(scope))
+            if op == "-":
+                return lambda scope: -operand(scope)
+            return operand
+        if self.accept("typeof"):
+            operand = self.unary()
+            return lambda scope: _typeof(operand(scope))
+        start = self.pos
+        value = self.postfix()
+        if self.tokens[self.pos][0] == "op" and self.peek() in ("++", "--"):
+            setter = self.setter(start)
+            delta = 1 if self.next()[1] == "++" else -1
+
+            def increment(scope):
+                previous = []
+
+                def update(current):
+                    previous.append(current)
+                    return current + delta
+                setter(scope, update)
+                return previous[0]
+            return increment
+        return value
+
+    def postfix(self):
+        start = self.pos
+        kind, token = self.tokens[self.pos]
+        value = self.primary()
+        ref = ("name", token) if kind == "name" and token not in _KEYWORDS else None
+        while True:
+            if self.accept("."):
+                name = self.next()[1]
+                if self.peek("("):
+                    value, ref = self.call(value, lambda scope, name=name: name), None
+                else:
+                    ref = ("member", value, lambda scope, name=name: name)
+                    value = (lambda v, n: lambda scope: get_member(v(scope), n))(value, name)
+            elif self.accept("["):
+                key = self.expression()
+                self.expect("]")
+                if self.peek("("):
+                    value, ref = self.call(value, key), None
+                else:
+                    ref = ("member", value, key)
+                    value = (lambda v, k: lambda scope: get_member(v(scope), k(scope)))(value, key)
+            elif self.peek("("):
+                value, ref = self.call(None, value), None
+            else:
+                self.ref = (start, self.pos, ref) if ref else None
+                return value
+
+    def call(self, obj, function):
+        self.expect("(")
+        args = []
+        while not self.accept(")"):
+            args.append(self.assignment())
+            self.accept(",")
+        if obj is None:
+            def call_function(scope):
+                fn = function(scope)
+                if not callable(fn):
+                    raise JSError("TypeError: not a function")
+                return fn(*[a(scope) for a in args])
+            return call_function
+
+        def call_method(scope):
+            fn = get_member(obj(scope), function(scope))
+            if not callable(fn):
+                raise JSError("TypeError: {0} is not a function".format(function(scope)))
+            return fn(*[a(scope) for a in args])
+        return call_method
+
+    def primary(self):
+        kind, token = self.next()
+        if kind in ("num", "str"):
+            return lambda scope: token
+        if kind == "name":
+            if token in _UNSUPPORTED:
+                raise JSError("unsupported syntax: {0}".format(token))
+            if token in _KEYWORDS:
+                value = _KEYWORDS[token]
+                return lambda scope: value
+            if token == "function":
+                return self.function_body()
+            if token == "new":
+                return self.postfix()
+            return lambda scope: scope.get(token)
+        if token == "(":
+            value = self.expression()
+            self.expect(")")
+            return value
+        if token == "[":
+            items = []
+            while not self.accept("]"):
+                items.append(self.assignment())
+                self.accept(",")
+            return lambda scope: [i(scope) for i in items]
+        if token == "{":
+            pairs = []
+            while not self.accept("}"):
+                key = self.next()[1]
+                self.expect(":")
+                pairs.append((to_string(key), self.assignment()))
+                self.accept(",")
+            return lambda scope: dict((k, v(scope)) for k, v in pairs)
+        raise JSError("unexpected token {0!r}".format(token))
+
+
+def _typeof(value):
+    if value is None:
+        return "undefined"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, (int, long, float)):
+        return "number"
+    if isinstance(value, basestring):
+        return "string"
+    if callable(value):
+        return "function"
+    return "object"
+
+
+def js_sum(values):
+    return sum(v for v in values if v is not None)
+
+
+_GLOBALS = {
+    "sum": js_sum,
+    "isArray": lambda value: isinstance(value, list),
+    "toJSON": json.dumps,
+    "log": lambda message: None,
+    "parseInt": lambda value, base=10: int(str(value), int(base)),
+    "parseFloat": float,
+    "String": to_string,
+    "Math": {"max": max, "min": min, "floor": lambda v: int(math.floor(v)), "ceil": lambda v: int(math.ceil(v)),
+             "abs": abs, "round": lambda v: int(math.floor(v + 0.5)), "sqrt": math.sqrt,
+             "random": random.random, "PI": math.pi},
+    "JSON": {"stringify": json.dumps, "parse": json.loads},
+}
+
+_cache = {}
+
+
+# compiles the source of a javascript function expression and returns a
+# python callable. names is the extra global environment, e.g. emit.
+def compile_function(source, **names):
+    make = _cache.get(source)
+    if make is None:
+        parser = _Parser(source)
+        if not parser.accept("function"):
+            raise JSError("expected a function")
+        if parser.tokens[parser.pos][0] == "name":
+            parser.next()
+        make = parser.function_body()
+        if parser.peek() is not None and not parser.peek(";"):
+            raise JSError("unexpected {0!r} after the function".format(parser.peek()))
+        _cache[source] = make
+    return make(_Scope(dict(_GLOBALS, **names)))
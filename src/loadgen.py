@@ -0,0 +1,156 @@
+import random
+import threading
+import time
+from stats import LatencyHistogram
+import logger
+
+log = logger.logger("loadgen")
+
+# [load] settings in tests.ini and their defaults
+defaults = {"profile": "constant", "rate": 200, "end_rate": 1000, "steps": "100,200,400,800", "step_seconds": 10,
+            "duration": 60, "workers": 64, "tolerance": 0.1}
+
+
+# the target request rate over time. the profiles are
+#   constant  rate ops/sec, evenly spaced
+#   poisson   rate ops/sec on average with exponential gaps, like independent clients
+#   ramp      from rate up to end_rate ops/sec linearly over the duration
+#   step      each rate of steps in turn for step_seconds, the last one until the end
+class LoadProfile(object):
+    def __init__(self, kind="constant", rate=200, end_rate=None, steps=None, step_seconds=10, duration=60):
+        if kind not in ("constant", "poisson", "ramp", "step"):
+            raise ValueError("unknown load profile {0}".format(kind))
+        self.kind = kind
+        self.rate = float(rate)
+        self.end_rate = float(end_rate if end_rate is not None else rate)
+        self.steps = [float(s) for s in steps or [rate]]
+        self.step_seconds = float(step_seconds)
+        self.duration = float(duration)
+
+    @staticmethod
+    def from_config(section):
+        params = dict(defaults, **section)
+        steps = [s for s in str(params["steps"]).split(",") if s.strip()]
+        return LoadProfile(params["profile"], params["rate"], params["end_rate"], steps, params["step_seconds"],
+                           params["duration"])
+
+    def rate_at(self, t):
+        if self.kind == "ramp":
+            return self.rate + (self.end_rate - self.rate) * min(t / self.duration, 1.0)
+        if self.kind == "step":
+            return self.steps[min(int(t / self.step_seconds), len(self.steps) - 1)]
+        return self.rate
+
+    # the intended send times, in seconds from the start, of every operation
+    def arrivals(self, rng=random):
+        t = 0.0
+        while True:
+            rate = self.rate_at(t)
+            t += rng.expovariate(rate) if self.kind == "poisson" else 1.0 / rate
+            if t >= self.duration:
+                return
+            yield t
+
+
+# runs operation(i) open loop: operation i is due at the i-th arrival of the
+# profile whether or not the earlier ones have finished, and its latency is
+# measured from that intended time rather than from when a worker got to it,
+# so a slow server shows up as queueing delay instead of a lower offered load
+# (coordinated omission). operations still waiting max_lag seconds after the
+# end of the profile are dropped and counted instead of run.
+class OpenLoopDriver(object):
+    def __init__(self, operation, profile, workers=64, tolerance=0.1, max_lag=None):
+        self._operation = operation
+        self.profile = profile
+        self._workers = workers
+        self._tolerance = tolerance
+        self._max_lag = max_lag if max_lag is not None else max(5.0, profile.duration * 0.5)
+        self._lock = threading.Lock()
+
+    def run(self):
+        self._arrivals = enumerate(self.profile.arrivals())
+        self.latency = LatencyHistogram()
+        self.service = LatencyHistogram()
+        self.errors = 0
+        self.dropped = 0
+        self._scheduled = {}
+        self._completed = {}
+        self._start = time.time() + 0.05
+        threads = [threading.Thread(target=self._work) for i in range(self._workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(time.time() - self._start)
+
+    def _next(self):
+        with self._lock:
+            for i, offset in self._arrivals:
+                second = int(offset)
+                self._scheduled[second] = self._scheduled.get(second, 0) + 1
+                if time.time() > self._start + self.profile.duration + self._max_lag:
+                    self.dropped += 1
+                    continue
+                return i, self._start + offset
+            return None, None
+
+    def _work(self):
+        latency, service, errors = LatencyHistogram(), LatencyHistogram(), 0
+        completed = {}
+        while True:
+            i, intended = self._next()
+            if i is None:
+                break
+            wait = intended - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            started = time.time()
+            try:
+                self._operation(i)
+            except Exception as e:
+                errors += 1
+                log.debug("operation {0} failed: {1}".format(i, e))
+            done = time.time()
+            latency.record(done - intended)
+            service.record(done - started)
+            second = int(done - self._start)
+            completed[second] = completed.get(second, 0) + 1
+        with self._lock:
+            self.latency.merge(latency)
+            self.service.merge(service)
+            self.errors += errors
+            for second, count in completed.items():
+                self._completed[second] = self._completed.get(second, 0) + count
+
+    # saturation is the first whole second in which fewer operations completed
+    # than were due, by more than the tolerance and one operation of jitter
+    def _saturation(self):
+        for second in range(int(self.profile.duration)):
+            target = self._scheduled.get(second, 0)
+            if target and self._completed.get(second, 0) + 1 < target * (1 - self._tolerance):
+                return {"second": second, "target_rate": target, "achieved_rate": self._completed.get(second, 0)}
+        return None
+
+    def report(self, elapsed):
+        scheduled = sum(self._scheduled.values())
+        report = {"profile": self.profile.kind, "scheduled": scheduled, "completed": self.latency.count,
+                  "errors": self.errors, "dropped": self.dropped, "seconds": elapsed,
+                  "target_rate": scheduled / self.profile.duration if self.profile.duration else 0,
+                  "achieved_rate": self.latency.count / elapsed if elapsed else 0,
+                  "latency": self.latency.summary(), "service": self.service.summary(),
+                  "saturation": self._saturation()}
+        log.info("{0} load: {1:.0f} ops/sec offered, {2:.0f} achieved, p99 {3}s, {4} errors, {5} dropped".format(
+            report["profile"], report["target_rate"], report["achieved_rate"], report["latency"]["p99"],
+            self.errors, self.dropped))
+        if report["saturation"]:
+            log.info("fell behind the target at second {second}: {achieved_rate} of {target_rate} ops/sec".format(
+                **report["saturation"]))
+        return report
+
+
+def run(operation, section=None, **overrides):
+    params = dict(defaults, **(section or {}))
+    params.update(overrides)
+    driver = OpenLoopDriver(operation, LoadProfile.from_config(params), int(params["workers"]),
+                            float(params["tolerance"]))
+    return driver.run()
@@ -1,28 +1,132 @@
+import atexit
 import logging
+import Queue
+import threading
+import time
 from logging.handlers import RotatingFileHandler
+from testconfig import config
 
+# [logging] settings in tests.ini and their defaults. file is the rotating log
+# file, empty for the console only. rate is how many INFO or DEBUG messages a
+# second one line of code may log, 0 for no limit.
+defaults = {"level": "INFO", "file": "couchtests.log", "max_bytes": 20 * 1024 * 1024, "backup_count": 2,
+            "rate": 20, "queue_size": 100000}
 
-def logger(name):
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
+_lock = threading.Lock()
+_handler = None
+_limiter = None
+
+
+# lets through at most rate INFO and DEBUG records a second from each call
+# site, a token bucket per file and line, so a message logged on every
+# operation of a hot loop costs a dict lookup once the site is over its rate.
+# the next record let through says how many were suppressed.
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = float(rate)
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.rate or record.levelno > logging.INFO:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.time()
+        with self._lock:
+            tokens, last, suppressed = self._sites.get(key, (self.rate, now, 0))
+            tokens = min(self.rate, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._sites[key] = (tokens, now, suppressed + 1)
+                return False
+            self._sites[key] = (tokens - 1, now, 0)
+        if suppressed:
+            record.msg = "{0} ({1} similar messages suppressed)".format(record.getMessage(), suppressed)
+            record.args = ()
+        return True
+
+
+# hands records to the writer thread so the caller never waits on the console
+# or the disk. the message is rendered here, the arguments could change
+# before the writer gets to them. records are dropped and counted when the
+# queue is full.
+class QueueHandler(logging.Handler):
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
 
-    # create console handler and set level to debug
-    consoleHandler = logging.StreamHandler()
-    consoleHandler.setLevel(logging.INFO)
+    def emit(self, record):
+        record.msg = record.getMessage()
+        record.args = ()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
 
-    # create formatter
-    formatter = logging.Formatter("[%(asctime)s] - [%(module)s] [%(thread)d] - %(levelname)s - %(message)s")
 
-    max_size = 20 * 1024 * 1024 #max size is 50 megabytes
+def _write(queue, handlers):
+    while True:
+        record = queue.get()
+        try:
+            if record is None:
+                return
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        finally:
+            queue.task_done()
 
-    filename = "{0}.log".format(name)
-    fileHandler = RotatingFileHandler(filename, backupCount=2, maxBytes=max_size)
 
-    # add formatter to ch
-    consoleHandler.setFormatter(formatter)
-    fileHandler.setFormatter(formatter)
+# creates the queue, the console and file handlers and the writer thread the
+# first time a logger is asked for
+def _setup():
+    global _handler, _limiter
+    with _lock:
+        if _handler is not None:
+            return _handler
+        params = dict(defaults, **config.get("logging", {}))
+        formatter = logging.Formatter("[%(asctime)s] - [%(module)s] [%(thread)d] - %(levelname)s - %(message)s")
+        handlers = [logging.StreamHandler()]
+        if params["file"]:
+            handlers.append(RotatingFileHandler(params["file"], maxBytes=int(params["max_bytes"]),
+                                                backupCount=int(params["backup_count"])))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        queue = Queue.Queue(int(params["queue_size"]))
+        writer = threading.Thread(target=_write, args=(queue, handlers), name="log-writer")
+        writer.daemon = True
+        writer.start()
+        _handler = QueueHandler(queue)
+        _handler.setLevel(params["level"].upper())
+        _limiter = RateLimitFilter(params["rate"])
 
-    # add ch to logger
-    logger.addHandler(consoleHandler)
-#    logger.addHandler(fileHandler)
-    return logger
\ No newline at end of file
+        def close():
+            queue.put(None)
+            writer.join(5)
+            for handler in handlers:
+                handler.close()
+        atexit.register(close)
+        return _handler
+
+
+# waits until everything logged so far has been written
+def flush():
+    if _handler is not None:
+        _handler.queue.join()
+
+
+# the named logger with the shared handler and rate limit attached once,
+# however many times it is asked for. the limit is on the logger so it also
+# applies to what propagates to nose's log capture.
+def logger(name):
+    log = logging.getLogger(name)
+    handler = _setup()
+    if handler not in log.handlers:
+        log.setLevel(handler.level)
+        log.addHandler(handler)
+        log.addFilter(_limiter)
+    return log
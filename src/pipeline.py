@@ -0,0 +1,83 @@
+import multiprocessing
+import threading
+import time
+from docmaker import GeneratedDocuments
+from uploader import post_bulk_docs, failed_results
+import logger
+
+log = logger.logger("DocumentPipeline")
+
+
+# builds the bulk bodies of one index range, runs in a worker process
+def _produce(spec, batch_size, queue):
+    docs = GeneratedDocuments.from_spec(*spec)
+    for body in docs.bulk_bodies(batch_size):
+        queue.put(body)
+
+
+# generates and encodes documents in a pool of processes, each owning a
+# disjoint index range of the GeneratedDocuments, and posts the finished
+# bulk bodies from writer threads. the queue between them is bounded so the
+# producers never run far ahead of the uploads.
+class DocumentPipeline(object):
+    def __init__(self, docs, processes=None, batch_size=500, queue_size=64):
+        self._docs = docs
+        self._processes = processes or multiprocessing.cpu_count()
+        self._batch_size = batch_size
+        self._queue_size = queue_size
+
+    # db_factory is called once per writer thread so each one can use its
+    # own connection. returns (docs saved, failed results, seconds)
+    def run(self, db_factory, writers=4, post=post_bulk_docs):
+        queue = multiprocessing.Queue(self._queue_size)
+        producers = [multiprocessing.Process(target=_produce, args=(part.spec(), self._batch_size, queue))
+                     for part in self._docs.partition(self._processes)]
+        self._lock = threading.Lock()
+        self._saved = 0
+        self._failed = []
+        self._errors = []
+        start = time.time()
+        for producer in producers:
+            producer.daemon = True
+            producer.start()
+        threads = [threading.Thread(target=self._write, args=(db_factory, queue, post)) for i in range(writers)]
+        for thread in threads:
+            thread.start()
+        for producer in producers:
+            producer.join()
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        if self._errors:
+            raise self._errors[0]
+        if [producer for producer in producers if producer.exitcode != 0]:
+            raise Exception("document producer failed")
+        log.info("saved {0} docs in {1:.2f} seconds, {2:.0f} docs/sec".format(
+            self._saved, elapsed, self._saved / max(elapsed, 0.001)))
+        return self._saved, self._failed, elapsed
+
+    # keeps draining the queue after an error, even without a connection, so
+    # the producers are never left blocked on a full queue
+    def _write(self, db_factory, queue, post):
+        connected = False
+        try:
+            db = db_factory()
+            connected = True
+        except Exception as ex:
+            with self._lock:
+                self._errors.append(ex)
+        body = queue.get()
+        while body is not None:
+            if connected:
+                try:
+                    results = post(db, body)
+                    failed = failed_results(results)
+                    with self._lock:
+                        self._saved += len(results) - len(failed)
+                        self._failed.extend(failed)
+                except Exception as ex:
+                    with self._lock:
+                        self._errors.append(ex)
+            body = queue.get()
@@ -0,0 +1,168 @@
+import collections
+import cProfile
+import os
+import pstats
+import re
+import StringIO
+import sys
+import threading
+import time
+from testconfig import config
+import logger
+
+log = logger.logger("profiling")
+
+# opt in with --tc=profile:cpu for the sampling profiler or --tc=profile:cprofile
+# for cProfile in every thread. [profiling] settings in tests.ini and their
+# defaults: interval is the sampling period in seconds, output the directory
+# the profiles are written to.
+defaults = {"interval": 0.005, "output": "profiles", "top": 25}
+
+
+def _label(code, cache={}):
+    label = cache.get(code)
+    if label is None:
+        label = cache[code] = "{0} ({1}:{2})".format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno)
+    return label
+
+
+# samples the stack of every thread except its own from sys._current_frames()
+# every interval seconds and counts identical stacks, rooted at the thread
+# name. cheap enough to leave on for a whole load test, and what it writes is
+# the folded format flamegraph.pl and speedscope read. greenlets other than
+# the running one are not seen.
+class SamplingProfiler(object):
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = collections.defaultdict(int)
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.current_thread().ident
+        while not self._stop.wait(self.interval):
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.counts[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        return ["{0} {1}".format(";".join(frame.replace(";", ":") for frame in stack), count)
+                for stack, count in sorted(self.counts.items())]
+
+    # the functions most often on top of a stack, with their share of samples.
+    # only python frames are seen, so a thread blocked in C, sleeping or
+    # waiting on a socket, counts against the python function that called it
+    def top(self, n):
+        totals = collections.defaultdict(int)
+        for stack, count in self.counts.items():
+            totals[stack[-1]] += count
+        total = float(sum(totals.values()) or 1)
+        return [(frame, count / total) for frame, count in sorted(totals.items(), key=lambda i: -i[1])[:n]]
+
+
+# a cProfile.Profile for the thread that starts it and for every thread
+# started after that, merged into one pstats.Stats. each new thread enables
+# its own profile from the hook threading.setprofile installs, as cProfile
+# only ever profiles the thread it was enabled in.
+class ThreadProfiler(object):
+    def __init__(self):
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def _start_thread(self, frame, event, arg):
+        profile = cProfile.Profile()
+        with self._lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        threading.setprofile(self._start_thread)
+        self._main = cProfile.Profile()
+        self.profiles.append(self._main)
+        self._main.enable()
+        return self
+
+    def stop(self):
+        self._main.disable()
+        threading.setprofile(None)
+
+    def stats(self):
+        with self._lock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            try:
+                stats.add(profile)
+            except TypeError:
+                # a thread that never made a call has nothing to add
+                pass
+        return stats
+
+
+def _file_name(test_id):
+    return re.sub(r"[^\w.-]", "_", test_id)
+
+
+# profiles one test when profile is set in the test config, returns None
+# otherwise so callers can always pass the result to stop_test
+def start_test(test_id):
+    mode = config.get("profile")
+    if not mode or mode == "off":
+        return None
+    if mode not in ("cpu", "cprofile"):
+        raise ValueError("unknown profile mode {0}, use cpu or cprofile".format(mode))
+    params = dict(defaults, **config.get("profiling", {}))
+    if mode == "cpu":
+        profiler = SamplingProfiler(float(params["interval"]))
+    else:
+        profiler = ThreadProfiler()
+    return test_id, mode, params, profiler.start(), time.time()
+
+
+# writes <output>/<test id>.folded for the sampling profiler or .pstats for
+# cProfile and logs the top functions
+def stop_test(session):
+    if session is None:
+        return None
+    test_id, mode, params, profiler, started = session
+    profiler.stop()
+    if not os.path.isdir(params["output"]):
+        os.makedirs(params["output"])
+    path = os.path.join(params["output"], _file_name(test_id))
+    top = int(params["top"])
+    if mode == "cpu":
+        path += ".folded"
+        with open(path, "w") as f:
+            f.write("\n".join(profiler.folded()) + "\n")
+        summary = "\n".join("{0:6.1%}  {1}".format(share, frame) for frame, share in profiler.top(top))
+        log.info("{0} samples over {1:.1f} seconds written to {2}, busiest functions:\n{3}".format(
+            profiler.samples, time.time() - started, path, summary))
+    else:
+        path += ".pstats"
+        stats = profiler.stats()
+        stats.dump_stats(path)
+        output = StringIO.StringIO()
+        stats.stream = output
+        stats.sort_stats("cumulative").print_stats(top)
+        log.info("{0} threads profiled, written to {1}:\n{2}".format(len(profiler.profiles), path, output.getvalue()))
+    return path
@@ -5,7 +5,10 @@ import unittest
 from nose import tools
 import uuid
 from testconfig import config
-from couchdbkit import client
+from uploader import BulkWriter
+import connpool
+import stats
+import viewstream
 import logger
 
 class BasicTests(unittest.TestCase):
@@ -15,6 +18,7 @@ class BasicTests(unittest.TestCase):
     cleanup_dbs = []
 
     def setUp(self):
+        stats.start_test()
         self.log = logger.logger("basictests")
         
         node_names = ['couchdb-local', 'couchdb-remote-1', 'couchdb-remote-2']
@@ -22,10 +26,11 @@ class BasicTests(unittest.TestCase):
             node = config[name]
             self.nodes.append(node)
             url = "http://{0}:{1}/".format(node['ip'], node['port'])
-            server = client.Server(url, full_commit=False)
+            server = connpool.server(url)
             self.servers.append(server)
         
     def tearDown(self):
+        stats.dump_test(self.id())
         for db in self.cleanup_dbs:
             for server in self.servers:
                 try:
@@ -57,12 +62,15 @@ class BasicTests(unittest.TestCase):
             local_dbs.append(db_name)
             db = server.get_or_create_db(db_name)
             if i == 0 or not first_only:
+                docs = []
                 for j in range(num_doc):
                     if self._isodd(j):
                         doc = {"_id": str(j), "a": j, "b": str(uuid.uuid4())[:6], "node": server_ip, "type": "odd" }
                     else:
                         doc = {"_id": str(j), "a": j, "b": str(uuid.uuid4())[:6], "node": server_ip, "type": "even" }
-                    db.save_doc(doc)
+                    docs.append(doc)
+                BulkWriter(db).write(docs)
+                for doc in docs:
                     for k in range(num_attachment):
                         db.put_attachment(doc, text_attachment, "test_" + str(k), "text/plain")
 
@@ -90,8 +98,7 @@ class BasicTests(unittest.TestCase):
         self.servers[0].replicate(source_url, target_url, continuous=continuous, cancel=False, create_target=True)
         if not continuous: 
             db = self.servers[0].get_or_create_db(local_dbs[1])
-            result = db.all_docs()
-            self.assertEqual(result.total_rows, num_doc)
+            self.assertEqual(viewstream.total_rows(db), num_doc)
 
     def _replicate_db(self, source_server, source_node, remote_node, local_db, continuous):
         source_url = "http://{0}:{1}".format(source_node['ip'], source_node['port']) + "/" + local_db
@@ -118,8 +125,7 @@ class BasicTests(unittest.TestCase):
         self.servers[0].replicate(source_url, target_url, continuous=continuous, cancel=False, create_target=True)
         if not continuous: 
             db = self.servers[0].get_or_create_db(local_dbs[1])
-            result = db.all_docs()
-            self.assertEqual(result.total_rows, num_doc)
+            self.assertEqual(viewstream.total_rows(db), num_doc)
 
     def _filter(self, db_name):
         design_name = "_design/test_filter";
@@ -151,8 +157,7 @@ class BasicTests(unittest.TestCase):
         self.servers[0].replicate(source_url, target_url, continuous=continuous, cancel=False, create_target=True, filter="test_filter/even")
         if not continuous: 
             db = self.servers[0].get_or_create_db(local_dbs[1])
-            result = db.all_docs()
-            self.assertEqual(result.total_rows, num_doc/2)
+            self.assertEqual(viewstream.total_rows(db), num_doc/2)
 
     def _compact_db(self, db_name):
         db = self.servers[0].get_or_create_db(db_name)
@@ -174,8 +179,7 @@ class BasicTests(unittest.TestCase):
         self.servers[0].replicate(source_url, target_url, continuous=continuous, cancel=False, create_target=True)
         if not continuous: 
             db = self.servers[0].get_or_create_db(local_dbs[1])
-            result = db.all_docs()
-            self.assertEqual(result.total_rows, num_doc)
+            self.assertEqual(viewstream.total_rows(db), num_doc)
         compactor.join()
 
     def _random_doc(self, howmany=1):
@@ -240,8 +244,7 @@ class BasicTests(unittest.TestCase):
         self.servers[0].replicate(source_url, target_url, continuous=continuous, cancel=False, create_target=True, filter="test_filter/even")
         if not continuous: 
             db = self.servers[0].get_or_create_db(local_dbs[1])
-            result = db.all_docs()
-            self.assertEqual(result.total_rows, num_doc)
+            self.assertEqual(viewstream.total_rows(db), num_doc)
 
     def test_local_circle(self):
         num_doc=5
@@ -257,8 +260,8 @@ class BasicTests(unittest.TestCase):
                 target_db =  local_dbs[i+1]
             self.servers[0].replicate(url+source_db, url+target_db, continuous=continuous, cancel=False, create_target=True)
             if not continuous:
-                self.assertEqual(self.servers[0].get_or_create_db(source_db).all_docs().total_rows, 
-                                 self.servers[0].get_or_create_db(target_db).all_docs().total_rows)
+                self.assertEqual(viewstream.total_rows(self.servers[0].get_or_create_db(source_db)),
+                                 viewstream.total_rows(self.servers[0].get_or_create_db(target_db)))
     
     def test_local_to_remote_circle(self):
         num_db=5
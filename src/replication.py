@@ -3,9 +3,12 @@ import unittest
 from nose import tools
 import uuid
 from testconfig import config
-from couchdbkit import client
 import time
 from docmaker import DocumentGenerator
+from verify import ReplicationVerifier
+from uploader import BulkWriter
+import connpool
+import stats
 import logger
 
 log = logger.logger("ReplicationTests")
@@ -14,16 +17,18 @@ class ReplicationTests(unittest.TestCase):
     cleanup_dbs = []
 
     def setUp(self):
+        stats.start_test()
         self.node = config['couchdb-local']
         self.log = log
         url = "http://{0}:{1}/".format(self.node['ip'], self.node['port'])
         self.log.info("connecting to couchdb @ {0}".format(url))
-        self.server = client.Server(url, full_commit=False)
+        self.server = connpool.server(url)
 
     def tearDown(self):
+        stats.dump_test(self.id())
         nodes = [config["couchdb-local"], config["couchdb-remote-1"], config["couchdb-remote-2"]]
         urls = ["http://{0}:{1}/".format(n['ip'], n['port']) for n in nodes]
-        servers = [client.Server(url, full_commit=False) for url in urls]
+        servers = [connpool.server(url) for url in urls]
         for server in servers:
             for db in server:
                 if db.dbname.find("doctest") != -1 or db.dbname in self.cleanup_dbs:
@@ -54,7 +59,7 @@ class ReplicationTests(unittest.TestCase):
         self.server.create_db(src_db_name)
         dst_db_name = self._get_db_name(replication_type)
         url = "http://{0}:{1}/".format(destination['ip'], destination['port'])
-        self.dst_server = client.Server(url, full_commit=False)
+        self.dst_server = connpool.server(url)
         self.dst_server.create_db(dst_db_name)
         description = "insert {0} items in source database.start replication from {1}(db:{2}) to {3}(db:{4})"
         self.log.info(description.format(items, config["couchdb-local"]["ip"],
@@ -62,8 +67,7 @@ class ReplicationTests(unittest.TestCase):
         docs = DocumentGenerator.make_docs(items, {"name": "user-${prefix}", "payload": "payload-${prefix}-${padding}"},
                 {"size": doc_size})
         src_db = self.server[src_db_name]
-        for doc in docs:
-            src_db.save_doc(doc)
+        BulkWriter(src_db, batch_size=100).write(docs.json_docs())
         self.log.info("saved {0} docs".format(len(docs)))
         source = "http://{0}:{1}/{2}".format(self.node["ip"], self.node["port"], src_db_name)
         destination = "http://{0}:{1}/{2}".format(destination["ip"], destination["port"], dst_db_name)
@@ -97,20 +101,14 @@ class ReplicationTests(unittest.TestCase):
                   msg="replication did not replicate some items")
 
 
+    # compares the id and rev listings of both databases and only fetches the
+    # bodies of documents whose revs differ, see ReplicationVerifier
     def _verify_replication(self, src_server, src_db, dst_server, dst_db, docs):
-        for doc in docs:
-            id = doc["_id"]
-            src_fetched = src_server[src_db].get(id)
-            try:
-                dst_fetched = dst_server[dst_db].get(id)
-            except Exception:
-                self.log.info("document {0} still not replicated".format(id))
-                return False
-            equal = self._compare_object_one_level(src_fetched, dst_fetched)
-            if not equal:
-                self.log.info("{0} != {1}".format(src_fetched, dst_fetched))
-                return False
-        return True
+        report = ReplicationVerifier(src_server[src_db], dst_server[dst_db]).verify()
+        if report["source"] != len(docs):
+            self.log.info("{0} docs in {1}, expected {2}".format(report["source"], src_db, len(docs)))
+            return False
+        return not report["divergences"]
 
 
     # does a one level comparison
@@ -0,0 +1,115 @@
+import csv
+import json
+import os
+import threading
+import time
+from testconfig import config
+import stats
+import logger
+
+log = logger.logger("reporter")
+
+# [reporter] settings in tests.ini and their defaults. output is the file name
+# without extension, format one or both of jsonl and csv.
+defaults = {"interval": 10, "output": "couch-intervals", "format": "jsonl,csv"}
+
+DB_FIELDS = ("doc_count", "doc_del_count", "disk_size", "data_size", "update_seq", "compact_running")
+
+CSV_FIELDS = ("test", "time", "elapsed", "seconds", "op", "count", "ops_per_sec", "mean", "p50", "p95", "p99",
+              "max", "errors", "db") + DB_FIELDS
+
+
+# writes what happened in every interval of a long running test: for each
+# operation recorded in stats.operations its throughput, latency percentiles
+# and errors over the interval, and the db.info() fields that show the
+# database growing and compacting. the jsonl file gets one object per
+# interval, the csv file one row per operation per interval, both appended
+# to so several tests can share them.
+class IntervalReporter(object):
+    def __init__(self, dbs, test_id="", params=None):
+        self.params = dict(defaults, **(params if params is not None else config.get("reporter", {})))
+        self.dbs = dbs if isinstance(dbs, (list, tuple)) else [dbs]
+        self.test_id = test_id
+        self.interval = float(self.params["interval"])
+        self.formats = [f.strip() for f in self.params["format"].split(",") if f.strip()]
+        self.points = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._started = time.time()
+        stats.operations.interval()
+        self._thread = threading.Thread(target=self._run, name="interval-reporter")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    # writes the last, partial, interval too
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+        self.report()
+
+    def _db_info(self, db):
+        try:
+            info = db.info()
+        except Exception as e:
+            log.error("could not get info of {0}: {1}".format(db.dbname, e))
+            return {}
+        return dict((field, info.get(field)) for field in DB_FIELDS)
+
+    def report(self):
+        operations, seconds = stats.operations.interval()
+        now = time.time()
+        point = {"test": self.test_id, "time": now, "elapsed": now - self._started, "seconds": seconds,
+                 "operations": operations, "dbs": dict((db.dbname, self._db_info(db)) for db in self.dbs)}
+        self.points.append(point)
+        self._write(point)
+        summary = ", ".join("{0} {1:.1f}/s p99 {2}s".format(op, s["ops_per_sec"], s["p99"])
+                            for op, s in sorted(operations.items()))
+        sizes = ", ".join("{0} {1} docs {2} bytes{3}".format(name, info.get("doc_count"), info.get("disk_size"),
+                                                              " compacting" if info.get("compact_running") else "")
+                          for name, info in sorted(point["dbs"].items()))
+        log.info("{0:.0f}s: {1}; {2}".format(point["elapsed"], summary or "no requests", sizes))
+        return point
+
+    def _write(self, point):
+        output = self.params["output"]
+        if "jsonl" in self.formats:
+            with open(output + ".jsonl", "a") as f:
+                f.write(json.dumps(point) + "\n")
+        if "csv" in self.formats:
+            path = output + ".csv"
+            new = not os.path.exists(path)
+            with open(path, "ab") as f:
+                writer = csv.DictWriter(f, CSV_FIELDS)
+                if new:
+                    writer.writeheader()
+                for row in self._rows(point):
+                    writer.writerow(row)
+
+    # one row per operation and database
+    def _rows(self, point):
+        base = {"test": point["test"], "time": "{0:.3f}".format(point["time"]),
+                "elapsed": "{0:.3f}".format(point["elapsed"]), "seconds": "{0:.3f}".format(point["seconds"])}
+        dbs = sorted(point["dbs"].items()) or [("", {})]
+        operations = sorted(point["operations"].items()) or [("", {})]
+        for name, info in dbs:
+            for op, summary in operations:
+                row = dict(base, op=op, db=name)
+                row.update((field, summary.get(field)) for field in ("count", "ops_per_sec", "mean", "p50", "p95",
+                                                                     "p99", "max", "errors"))
+                row.update(info)
+                yield row
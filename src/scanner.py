@@ -0,0 +1,148 @@
+import Queue
+import threading
+from testconfig import config
+import viewstream
+import logger
+
+log = logger.logger("scanner")
+
+# [scan] settings in tests.ini and their defaults
+defaults = {"partitions": 8, "page_size": 1000}
+
+_DONE = object()
+
+
+class _Failed(object):
+    def __init__(self, error):
+        self.error = error
+
+
+# reads all of _all_docs or of a view over several connections at once. the
+# key space is split into partitions ranges at boundary rows sampled with
+# skip at even steps of total_rows, every range is paged through by its own
+# thread with viewstream.rows and the rows are handed over through bounded
+# queues, so at most partitions pages are held whatever the size of the scan.
+# params are other view parameters (include_docs, and reduce=False for a
+# view with a reduce), the scan always covers the whole view.
+#
+#   for doc in PartitionedScanner(db, partitions=16).docs(ordered=False):
+#       ...
+class PartitionedScanner(object):
+    def __init__(self, db, view="_all_docs", partitions=None, page_size=None, **params):
+        settings = dict(defaults, **config.get("scan", {}))
+        self.db = db
+        self.view = view
+        self.partitions = int(partitions or settings["partitions"])
+        self.page_size = int(page_size or settings["page_size"])
+        self.params = params
+        self.counts = []
+
+    # the first row of every partition but the first, at most partitions - 1
+    # of them as a small database may not have enough distinct rows. couchdb
+    # walks the index up to the skip offset, so the rows are sampled in
+    # parallel and the sampling takes as long as the furthest one
+    def boundaries(self):
+        sample = dict((k, v) for k, v in self.params.items() if k != "include_docs")
+        total = viewstream.total_rows(self.db, self.view, **sample)
+        found = [None] * (self.partitions - 1)
+        errors = []
+
+        def read(i):
+            try:
+                rows = list(viewstream.stream(self.db, self.view, skip=total * (i + 1) / self.partitions, limit=1,
+                                              **sample))
+                if rows:
+                    found[i] = {"key": rows[0]["key"], "id": rows[0].get("id")}
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=read, args=(i,), name="scan-sample-{0}".format(i))
+                   for i in range(len(found))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        bounds = []
+        for bound in found:
+            if bound and bound not in bounds:
+                bounds.append(bound)
+        return bounds
+
+    def _range(self, lower, upper):
+        params = dict(self.params)
+        by_id = self.view == "_all_docs"
+        if lower is not None:
+            params["startkey"] = lower["key"]
+            if not by_id:
+                params["startkey_docid"] = lower["id"]
+        if upper is not None:
+            params["endkey"] = upper["key"]
+            params["inclusive_end"] = False
+            if not by_id:
+                params["endkey_docid"] = upper["id"]
+        return params
+
+    def _read(self, i, params, queue, stop):
+        count = 0
+        try:
+            for row in viewstream.rows(self.db, self.view, self.page_size, **params):
+                if not self._put(queue, row, stop):
+                    return
+                count += 1
+            self.counts[i] = count
+            self._put(queue, _DONE, stop)
+        except Exception as e:
+            log.error("partition {0} of {1} failed after {2} rows: {3}".format(i, self.view, count, e))
+            self._put(queue, _Failed(e), stop)
+
+    @staticmethod
+    def _put(queue, item, stop):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    # yields the rows of the view, in view order when ordered is true (later
+    # partitions read ahead until their queue is full) or as they arrive
+    def scan(self, ordered=True):
+        bounds = [None] + self.boundaries() + [None]
+        ranges = [self._range(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+        self.counts = [None] * len(ranges)
+        stop = threading.Event()
+        if ordered:
+            queues = [Queue.Queue(self.page_size) for r in ranges]
+        else:
+            queues = [Queue.Queue(self.page_size * len(ranges))] * len(ranges)
+        threads = [threading.Thread(target=self._read, args=(i, params, queues[i], stop), name="scan-{0}".format(i))
+                   for i, params in enumerate(ranges)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            pending = len(threads)
+            current = 0
+            while pending:
+                item = queues[current].get()
+                if item is _DONE:
+                    pending -= 1
+                    if ordered:
+                        current += 1
+                elif isinstance(item, _Failed):
+                    raise item.error
+                else:
+                    yield item
+        finally:
+            stop.set()
+        log.info("scanned {0} rows of {1} in {2} partitions: {3}".format(sum(self.counts), self.view, len(ranges),
+                                                                           self.counts))
+
+    # the documents of the rows, with include_docs
+    def docs(self, ordered=True):
+        self.params["include_docs"] = True
+        for row in self.scan(ordered):
+            if row.get("doc") is not None:
+                yield row["doc"]
@@ -0,0 +1,177 @@
+import json
+import threading
+import time
+from testconfig import config
+
+
+# returns {p: value} for the given percentiles of values, nearest rank
+def percentiles(values, ps=(50, 95, 99)):
+    ordered = sorted(values)
+    result = {}
+    for p in ps:
+        if not ordered:
+            result[p] = None
+        else:
+            rank = int(round(p / 100.0 * len(ordered) + 0.5)) - 1
+            result[p] = ordered[max(0, min(rank, len(ordered) - 1))]
+    return result
+
+
+# HDR style latency histogram with constant memory: values are kept in
+# microseconds, exactly below 128us and in 64 linear sub buckets per power of
+# two above that, so every recorded value is within 1.6% of the real one.
+class LatencyHistogram(object):
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def _index(us):
+        if us < 128:
+            return us
+        shift = us.bit_length() - 7
+        return 128 + (shift - 1) * 64 + ((us >> shift) - 64)
+
+    # the highest value in seconds which falls into bucket index
+    @staticmethod
+    def _value(index):
+        if index < 128:
+            return index / 1000000.0
+        shift = (index - 128) / 64 + 1
+        top = (index - 128) % 64 + 64
+        return (((top + 1) << shift) - 1) / 1000000.0
+
+    def record(self, seconds):
+        index = self._index(int(seconds * 1000000))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        wanted = max(1, int(round(p / 100.0 * self.count + 0.5)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= wanted:
+                return min(self._value(index), self.max)
+        return self.max
+
+    def summary(self, elapsed=None):
+        summary = {"count": self.count, "mean": self.total / self.count if self.count else None,
+                   "max": self.max, "p50": self.percentile(50), "p95": self.percentile(95),
+                   "p99": self.percentile(99), "p999": self.percentile(99.9)}
+        if elapsed:
+            summary["ops_per_sec"] = self.count / elapsed
+        return summary
+
+
+# latency histograms and error counters per operation name, for the whole
+# test and for the current interval of a reporter
+class OperationStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.errors = {}
+            self.started = time.time()
+            self._interval = ({}, {}, self.started)
+
+    def record(self, op, seconds, error=False):
+        with self._lock:
+            for histograms, errors in ((self.histograms, self.errors), self._interval[:2]):
+                histogram = histograms.get(op)
+                if histogram is None:
+                    histogram = histograms[op] = LatencyHistogram()
+                histogram.record(seconds)
+                if error:
+                    errors[op] = errors.get(op, 0) + 1
+
+    @staticmethod
+    def _summarize(histograms, errors, elapsed):
+        result = {}
+        for op, histogram in histograms.items():
+            result[op] = histogram.summary(elapsed)
+            result[op]["errors"] = errors.get(op, 0)
+        return result
+
+    def summary(self):
+        with self._lock:
+            return self._summarize(self.histograms, self.errors, time.time() - self.started)
+
+    # the summary since the previous call, or since the test started, and
+    # the seconds it covers. starts the next interval.
+    def interval(self):
+        now = time.time()
+        with self._lock:
+            (histograms, errors, started), self._interval = self._interval, ({}, {}, now)
+        return self._summarize(histograms, errors, now - started), now - started
+
+
+# every couchdb request made through connpool is recorded here
+operations = OperationStats()
+
+
+# names the couchdb operation of a request from its method and url path
+def classify(method, path):
+    segments = [s for s in path.split("/") if s]
+    if not segments or segments[0].startswith("_"):
+        return segments[0][1:] if segments and segments[0] in ("_replicate", "_active_tasks") else "other"
+    rest = segments[1:]
+    if rest and rest[0] in ("_design", "_local") and len(rest) > 1:
+        rest = [rest[0] + "/" + rest[1]] + rest[2:]
+    if not rest:
+        return "save" if method == "POST" else "other"
+    if rest[0] == "_bulk_docs":
+        return "bulk"
+    if rest[0] in ("_all_docs", "_temp_view") or "_view" in rest:
+        return "view"
+    if rest[0] == "_compact":
+        return "compact"
+    if rest[0].startswith("_"):
+        return "other"
+    if len(rest) > 1 and not rest[1].startswith("_"):
+        return {"PUT": "attachment_put", "GET": "attachment_fetch"}.get(method, "attachment_" + method.lower())
+    return {"GET": "get", "HEAD": "get", "PUT": "save", "POST": "save", "DELETE": "delete"}.get(method, "other")
+
+
+# more per test summaries for dump_test, name: (summary, reset) functions,
+# e.g. the requests per couchdb node connpool adds as "nodes"
+sections = {}
+
+
+def start_test():
+    operations.reset()
+    for summary, reset in sections.values():
+        reset()
+
+
+# appends the operation summary of the test that just ran, and the ones of
+# sections, to the file named by [stats] output in tests.ini, one json
+# object per line
+def dump_test(test_id):
+    summary = operations.summary()
+    elapsed = time.time() - operations.started
+    line = {"test": test_id, "time": time.time(), "elapsed": elapsed, "operations": summary}
+    for name, (section, reset) in sections.items():
+        line[name] = section()
+    output = config.get("stats", {}).get("output", "couch-stats.jsonl")
+    with open(output, "a") as f:
+        f.write(json.dumps(line) + "\n")
+    start_test()
+    return summary
@@ -1,5 +1,32 @@
-from docmaker import DocumentGenerator
+import csv
+import json
+import os
+import StringIO
+import tempfile
+from couchdbkit import Server
+from testconfig import config
+from couchdbkit.exceptions import BulkSaveError, RequestFailed
+from docmaker import DocumentGenerator, DocumentRandom, DocRecord
+from pipeline import DocumentPipeline
+from uploader import BulkWriter, WriterPool
+from verify import DocumentVerifier, ReplicationVerifier
+from fakecouch import FakeCouch
+from jsview import compile_function, JSError
+from loadgen import LoadProfile, OpenLoopDriver
+from workload import KeyChooser, Workload
+from reporter import IntervalReporter
+from scanner import PartitionedScanner
+from profiling import SamplingProfiler, ThreadProfiler
+from viewbench import indexer_progress, measure_index_build
+from freshness import FreshnessProbe
+import threading
+import connpool
+from stats import LatencyHistogram
 import logger
+import logging
+import stats
+import time
+import viewstream
 import unittest
 
 class BasicTests(unittest.TestCase):
@@ -10,3 +37,491 @@ class BasicTests(unittest.TestCase):
         for doc in docs:
             log.info(doc)
 
+
+
+    def test_make_docs_batch(self):
+        docs = DocumentGenerator.make_docs(25, {"name": "employee-${prefix}", "payload": "${prefix}-${padding}"},
+                {"size": 16, "seed": "batch"})
+        batches = list(docs.batches(10))
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual(batches[2][4], {"_id": "24-batch", "name": "employee-24", "payload": "24-" + "*" * 16})
+
+    def test_compile_template(self):
+        template = DocumentGenerator.compile_template(
+            {"name": "employee-${prefix}", "age": "${rand_int:20:60}", "id": "${uuid}", "order": "${seq}",
+             "address": {"street": "${prefix} main st", "tags": ["home", "${prefix}"]}, "unknown": "${foo}"})
+        doc = template(7)
+        self.assertEqual(doc["name"], "employee-7")
+        self.assertTrue(20 <= doc["age"] <= 60)
+        self.assertEqual(len(doc["id"]), 36)
+        self.assertEqual(doc["address"], {"street": "7 main st", "tags": ["home", "7"]})
+        self.assertEqual(doc["unknown"], "${foo}")
+        self.assertEqual(template(8)["order"], doc["order"] + 1)
+
+    def test_make_docs_json(self):
+        template = {"name": "employee-${prefix}", "payload": "${prefix}-${padding}", "age": "${rand_int:1:1}",
+                    "nested": {"tags": ["a", "${prefix}\""]}}
+        options = {"size": 16, "seed": "json"}
+        expected = list(DocumentGenerator.make_docs(5, template, options))
+        bodies = list(DocumentGenerator.make_docs(5, template, options).bulk_bodies(2))
+        self.assertEqual(len(bodies), 3)
+        docs = []
+        for body in bodies:
+            docs.extend(json.loads(body)["docs"])
+        self.assertEqual(docs, expected)
+
+    def test_make_docs_seekable(self):
+        template = {"name": "employee-${prefix}", "id": "${uuid}", "age": "${rand_int:20:60}"}
+        docs = DocumentGenerator.make_docs(100, template, {"size": 16, "seed": "seekable"})
+        expected = list(DocumentGenerator.make_docs(100, template, {"size": 16, "seed": "seekable"}))
+        self.assertEqual(docs[42], expected[42])
+        self.assertEqual(docs[-1], expected[99])
+        self.assertEqual(list(docs[10:20]), expected[10:20])
+        parts = docs.partition(3)
+        self.assertEqual([len(part) for part in parts], [33, 33, 34])
+        self.assertEqual(sum([list(part) for part in parts], []), expected)
+
+    def test_verify_docs(self):
+        docs = DocumentGenerator.make_docs(50, {"name": "employee-${prefix}"}, {"size": 16, "seed": "verify"})
+        stored = dict((doc["_id"], dict(doc, _rev="1-abc")) for doc in docs)
+        stored["7-verify"]["name"] = "changed"
+        del stored["8-verify"]
+
+        class StoredDocs(object):
+            def all_docs(self, keys, include_docs):
+                return [{"doc": stored[k]} if k in stored else {"key": k, "error": "not_found"} for k in keys]
+
+        checked, mismatches = DocumentVerifier(docs, page_size=20).verify(StoredDocs())
+        self.assertEqual(checked, 50)
+        self.assertEqual(mismatches, [("7-verify", "field name differs"), ("8-verify", "not_found")])
+
+    def test_make_docs_threaded(self):
+        docs = DocumentGenerator.make_docs(200, {"n": "${rand_int:0:1000000}", "u": "${uuid}"},
+                                           {"size": 16, "seed": "threads"})
+        expected = [docs[i] for i in range(200)]
+        results = [None] * 4
+
+        def build(n):
+            results[n] = [docs[i] for i in range(200)]
+        threads = [threading.Thread(target=build, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [expected] * 4)
+
+    def test_document_random(self):
+        rng = DocumentRandom("seed:1")
+        ints = [rng.randint(3, 7) for i in range(1000)]
+        self.assertEqual(sorted(set(ints)), [3, 4, 5, 6, 7])
+        again = DocumentRandom("seed:1")
+        self.assertEqual([again.randint(3, 7) for i in range(1000)], ints)
+        self.assertTrue(all(0 <= rng.random() < 1 for i in range(1000)))
+        self.assertTrue(0 <= rng.getrandbits(128) < 1 << 128)
+        self.assertTrue(0 <= rng.randint(0, 1 << 70) <= 1 << 70)
+        values = [rng.gauss(100, 10) for i in range(2000)]
+        self.assertTrue(98 < sum(values) / len(values) < 102)
+        self.assertNotEqual(DocumentRandom("seed:2").random(), DocumentRandom("seed:1").random())
+
+    def test_make_docs_constant_padding(self):
+        docs = DocumentGenerator.make_docs(2, {"p": "${padding}", "q": ["x-${padding}"]}, {"size": 1024})
+        doc = docs[0]
+        self.assertEqual(len(doc["p"]), 1024)
+        self.assertEqual(doc["q"][0], "x-" + doc["p"])
+        self.assertTrue(1024 <= len(json.dumps({"p": doc["p"]})) < 1100)
+        self.assertEqual(json.loads(list(docs.json_docs())[0])["p"], doc["p"])
+
+    def test_make_docs_size_distribution(self):
+        options = {"size": 512, "seed": "sizes", "size_dist": "histogram", "histogram": [[100, 1], [2000, 1]],
+                   "entropy": "random"}
+        docs = list(DocumentGenerator.make_docs(200, {"payload": "${padding}"}, options))
+        sizes = set([len(doc["payload"]) for doc in docs])
+        self.assertEqual(sizes, set([100, 2000]))
+        self.assertEqual(len(set([doc["payload"] for doc in docs])), 200)
+        self.assertEqual(docs, list(DocumentGenerator.make_docs(200, {"payload": "${padding}"}, options)))
+        for dist in ["uniform", "normal", "zipf"]:
+            options = {"size": 512, "seed": "sizes", "size_dist": dist, "min_size": 10, "max_size": 1024,
+                       "entropy": "text"}
+            for doc in DocumentGenerator.make_docs(50, {"payload": "${padding}"}, options):
+                self.assertTrue(10 <= len(doc["payload"]) <= 1024)
+
+    def test_document_pipeline(self):
+        docs = DocumentGenerator.make_docs(1000, {"name": "employee-${prefix}"}, {"size": 16})
+        posted = []
+
+        def post(db, body):
+            results = [{"id": doc["_id"], "rev": "1-abc"} for doc in json.loads(body)["docs"]]
+            posted.extend(results)
+            return results
+
+        saved, failed, elapsed = DocumentPipeline(docs, processes=3, batch_size=64).run(lambda: None, 2, post)
+        self.assertEqual(saved, 1000)
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted([result["id"] for result in posted]), sorted([doc["_id"] for doc in docs]))
+
+        def no_connection():
+            raise IOError("no connection")
+        # the writers keep draining the queue, so the producers finish and the
+        # error is raised instead of run() hanging
+        self.assertRaises(IOError, DocumentPipeline(docs, processes=2, batch_size=16, queue_size=2).run,
+                          no_connection, 2, post)
+
+    def test_make_docs_records(self):
+        template = {"name": "employee-${prefix}", "age": "${rand_int:20:60}", "dept": "qa"}
+        options = {"size": 16, "seed": "records"}
+        records = list(DocumentGenerator.make_docs(10, template, options).records())
+        self.assertEqual([record.to_dict() for record in records],
+                         list(DocumentGenerator.make_docs(10, template, options)))
+        self.assertTrue(records[0].keys is records[9].keys)
+        self.assertEqual(records[3]["name"], "employee-3")
+        self.assertEqual(DocRecord.from_dict({"b": 2, "a": 1}).to_dict(), {"a": 1, "b": 2})
+
+    def test_bulk_writer(self):
+        stored = {"3-bulk": "1-old"}
+        posts = []
+
+        def post(db, body):
+            posts.append(body)
+            results = []
+            for doc in json.loads(body)["docs"]:
+                if doc["_id"] in stored and doc.get("_rev") != stored[doc["_id"]]:
+                    results.append({"id": doc["_id"], "error": "conflict", "reason": "Document update conflict."})
+                else:
+                    stored[doc["_id"]] = "2-new"
+                    results.append({"id": doc["_id"], "rev": "2-new"})
+            return results
+
+        class RevisionDb(object):
+            def all_docs(self, keys):
+                return [{"id": k, "key": k, "value": {"rev": stored[k]}} for k in keys]
+
+        docs = list(DocumentGenerator.make_docs(10, {"name": "employee-${prefix}"}, {"size": 16, "seed": "bulk"}))
+        writer = BulkWriter(RevisionDb(), batch_size=4, on_conflict="update", post=post)
+        self.assertEqual(writer.write(docs), 10)
+        self.assertEqual(len(posts), 4)
+        self.assertEqual(docs[3]["_rev"], "2-new")
+        stored["3-bulk"] = "3-newer"
+        self.assertRaises(BulkSaveError, BulkWriter(RevisionDb(), post=post).write, docs[:4])
+
+    def test_writer_pool(self):
+        def post(db, body):
+            time.sleep(0.01)
+            return [{"id": doc["_id"], "rev": "1-abc"} for doc in json.loads(body)["docs"]]
+
+        sources = [DocumentGenerator.make_docs(100, {"name": "employee-${prefix}"}, {"size": 16})
+                   for i in range(4)]
+        start = time.time()
+        report = WriterPool(lambda: None, batch_size=10, post=post).run(sources)
+        self.assertEqual(report["docs"], 400)
+        self.assertEqual(len(report["writers"]), 4)
+        self.assertTrue(time.time() - start < 0.35)
+        self.assertTrue(report["p50"] >= 0.01)
+        report = WriterPool(lambda: None, batch_size=10, post=post).run(docs.regenerate() for docs in sources)
+        self.assertEqual(report["docs"], 400)
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram()
+        for us in range(1, 10001):
+            histogram.record(us / 1000000.0)
+        for p, expected in [(50, 0.005), (99, 0.0099), (99.9, 0.00999)]:
+            self.assertTrue(abs(histogram.percentile(p) - expected) / expected < 0.02)
+        self.assertEqual(stats.classify("PUT", "/db/doc1"), "save")
+        self.assertEqual(stats.classify("GET", "/db/_design/test/_view/all"), "view")
+        self.assertEqual(stats.classify("PUT", "/db/doc1/file.txt"), "attachment_put")
+        self.assertEqual(stats.classify("POST", "/db/_bulk_docs"), "bulk")
+
+    def test_fakecouch(self):
+        local, remote = FakeCouch().start(), FakeCouch().start()
+        try:
+            db = Server(local.url).create_db("doctests-fake")
+            docs = DocumentGenerator.make_docs(50, {"name": "employee-${prefix}", "age": "${rand_int:20:60}"},
+                    {"size": 16, "seed": "fake"})
+            self.assertEqual(BulkWriter(db, batch_size=20).write(docs.json_docs()), 50)
+            db.save_doc({"_id": "_design/test", "views": {"by_age": {
+                "map": "function(doc) { if (doc.age >= 40) emit(doc.age, 1); }",
+                "reduce": "function(keys, values) { return sum(values); }"}}})
+            older = len([doc for doc in docs.regenerate() if doc["age"] >= 40])
+            self.assertEqual(db.view("test/by_age").first()["value"], older)
+            self.assertEqual(db.view("test/by_age", reduce=False, startkey=40).total_rows, older)
+            db.put_attachment(db.get("7-fake"), "attached", "note.txt", "text/plain")
+            Server(local.url).replicate(local.url + "doctests-fake", remote.url + "doctests-copy", create_target=True)
+            copy = Server(remote.url)["doctests-copy"]
+            self.assertEqual(DocumentVerifier(docs.regenerate()).verify(copy), (50, []))
+            self.assertEqual(copy.fetch_attachment("7-fake", "note.txt"), "attached")
+            db.save_doc({"_id": "_design/names", "views": {"by_name": {"map": "function(doc) { emit(doc.name); }"}}})
+            self.assertRaises(RequestFailed, db.view("names/by_name", group=True).all)
+            db.delete_doc("12-fake")
+            ids = sorted(doc["_id"] for doc in docs.regenerate() if doc["_id"] != "12-fake")
+            rows = db.all_docs(startkey="11", endkey="3", skip=1, limit=5)
+            # with the two design documents
+            self.assertEqual((rows.total_rows, rows.offset), (51, 4))
+            self.assertEqual([row["id"] for row in rows], [i for i in ids if "11" <= i <= "3"][1:6])
+            rows = db.all_docs(startkey="3", endkey="11", inclusive_end=False, descending=True)
+            self.assertEqual([row["id"] for row in rows], [i for i in reversed(ids) if "11" < i <= "3"])
+        finally:
+            local.stop()
+            remote.stop()
+
+    def test_jsview_operators(self):
+        def value(expression):
+            return compile_function("function() { return " + expression + "; }")()
+        self.assertEqual(value("1 + 2 * 3"), 7)
+        self.assertEqual(value("(1 + 2) * 3"), 9)
+        self.assertEqual(value("10 - 4 - 3"), 3)
+        self.assertEqual(value("7 % 3"), 1)
+        self.assertEqual(value("-7 % 3"), -1)
+        self.assertEqual(value("7 / 2"), 3.5)
+        self.assertEqual(value("1 / 0"), float("inf"))
+        self.assertEqual(value("1 + 2 + 'a'"), "3a")
+        self.assertEqual(value("'a' + 1 + 2"), "a12")
+        self.assertEqual(value("1 < 2 && 2 < 1 || 'x'"), "x")
+        self.assertEqual(value("0 && undefined_name"), 0)
+        self.assertEqual(value("null || 'd'"), "d")
+        self.assertEqual(value("!0 ? 'y' : 'n'"), "y")
+        self.assertEqual(value("-(-2)"), 2)
+        self.assertEqual(value("typeof 'a' + typeof 1 + typeof null"), "stringnumberundefined")
+        self.assertEqual(value("{a: 1, 'b': [2, 3]}"), {"a": 1, "b": [2, 3]})
+
+    def test_jsview_functions(self):
+        emitted = []
+        map = compile_function("""function(doc) {
+            var total = 0, i;
+            for (i = 0; i < doc.v.length; i++) {
+                if (doc.v[i] % 2) continue;
+                total += doc.v[i];
+            }
+            for (var k in doc.o) emit([doc.type, k], doc.o[k]);
+            var adder = function(n) { return function(m) { return n + m; }; };
+            var plus5 = adder(5);
+            emit([doc.type, total], plus5(total));
+            var j = 0;
+            while (true) { if (++j > 3) break; }
+            function twice(x) { return x * 2; }
+            emit(null, twice(j));
+            doc.v.forEach(function(v, index) { if (index == 0) emit("first", v); });
+        }""", emit=lambda key, value=None: emitted.append((key, value)))
+        map({"type": "t", "v": [1, 2, 3, 4], "o": {"a": 1}})
+        self.assertEqual(emitted, [(["t", "a"], 1), (["t", 6], 11), (None, 8), ("first", 1)])
+        strings = compile_function("""function(s) {
+            var parts = s.split(",");
+            parts.push(" c ".trim().toUpperCase());
+            return [parts.join("-"), s.indexOf("b"), s.substring(0, 1), parts.slice(1).concat([4]).length,
+                    parts.indexOf("C"), Math.max(1, 5), sum([1, 2, null])];
+        }""")
+        self.assertEqual(strings("a,b"), ["a-b-C", 2, "a", 3, 2, 5, 3])
+
+    def test_jsview_errors(self):
+        for source in ("function(doc) { emit(doc.a) ", "function(doc) { doc.a = ; }", "var x = 1",
+                       "function(doc) { 1 = 2; }", "function(doc) { x = 1 @ 2 }",
+                       "function(doc) { try { emit(1); } catch (e) {} }", "function(doc) { switch (doc.a) {} }"):
+            self.assertRaises(JSError, compile_function, source)
+        self.assertRaises(JSError, compile_function("function(doc) { return missing; }"), {})
+        self.assertRaises(JSError, compile_function("function(doc) { return doc.a.b; }"), {"a": None})
+
+    def test_open_loop_driver(self):
+        self.assertEqual(len(list(LoadProfile("step", steps=[10, 20], step_seconds=1, duration=3).arrivals())), 49)
+        self.assertEqual(len(list(LoadProfile("ramp", rate=10, end_rate=30, duration=2).arrivals())), 39)
+        # two workers at 20ms an operation can do 100 ops/sec, half of the target
+        report = OpenLoopDriver(lambda i: time.sleep(0.02), LoadProfile("constant", rate=200, duration=1),
+                                workers=2).run()
+        self.assertEqual(report["completed"] + report["dropped"], 199)
+        self.assertEqual(report["saturation"]["second"], 0)
+        self.assertTrue(report["latency"]["p99"] > 0.5 > report["service"]["p99"])
+
+    def test_workload_mix(self):
+        counts = [0] * 100
+        chooser = KeyChooser("zipf", 1.2)
+        for i in range(10000):
+            counts[chooser.choose(100)] += 1
+        self.assertTrue(counts[0] > counts[10] > counts[99])
+        self.assertTrue(sum(KeyChooser("latest").choose(100) for i in range(1000)) / 1000 > 75)
+        couch = FakeCouch().start()
+        try:
+            workload = Workload(Server(couch.url).create_db("doctests-mix"), {"workers": 4, "doc_size": 64})
+            workload.preload(50)
+            report = workload.run(operations=300)
+            self.assertEqual(sum(summary["count"] for summary in report["operations"].values()), 300)
+            self.assertEqual(sorted(report["operations"]), sorted(["read", "insert", "update", "delete", "view",
+                                                                  "attachment"]))
+            self.assertEqual(sum(summary["error"] for summary in report["operations"].values()), 0)
+        finally:
+            couch.stop()
+
+    def test_interval_reporter(self):
+        couch = FakeCouch().start()
+        output = os.path.join(tempfile.mkdtemp(), "intervals")
+        try:
+            db = Server(couch.url).create_db("doctests-report")
+            reporter = IntervalReporter(db, "test", {"interval": 0.2, "output": output, "format": "jsonl,csv"})
+            with reporter:
+                for i in range(5):
+                    stats.operations.record("save", 0.01)
+                db.save_doc({"_id": "1"})
+                time.sleep(0.3)
+                stats.operations.record("get", 0.02, error=True)
+            self.assertTrue(len(reporter.points) >= 2)
+            self.assertEqual(reporter.points[0]["operations"]["save"]["count"], 5)
+            self.assertEqual(reporter.points[-1]["operations"]["get"]["errors"], 1)
+            self.assertEqual(reporter.points[-1]["dbs"]["doctests-report"]["doc_count"], 1)
+            with open(output + ".jsonl") as f:
+                self.assertEqual(len(f.readlines()), len(reporter.points))
+            with open(output + ".csv") as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual([row["op"] for row in rows if row["op"] != ""], ["save", "get"])
+        finally:
+            couch.stop()
+
+    def test_dump_test(self):
+        couch = FakeCouch().start()
+        output = os.path.join(tempfile.mkdtemp(), "stats.jsonl")
+        config["stats"] = {"output": output}
+        try:
+            stats.start_test()
+            connpool.server(couch.node).create_db("doctests-stats").save_doc({"_id": "1"})
+            stats.dump_test("test")
+            with open(output) as f:
+                line = json.loads(f.read())
+            node = line["nodes"]["{0}:{1}".format(couch.host, couch.port)]
+            # create_db looks for the database first, a 404
+            self.assertEqual((node["requests"], node["errors"]), (3, 1))
+            self.assertEqual(line["operations"]["save"]["count"], 1)
+            self.assertEqual(connpool.node_stats()[node["node"]]["requests"], 0)
+        finally:
+            del config["stats"]
+            couch.stop()
+
+    def test_logger(self):
+        log = logger.logger("test_logger")
+        self.assertTrue(logger.logger("test_logger") is log)
+        self.assertEqual(len(log.handlers), 1)
+        limiter = logger.RateLimitFilter(5)
+        records = [logging.LogRecord("test", logging.INFO, "hot.py", 10, "miss %s", (i,), None) for i in range(100)]
+        self.assertEqual(len([r for r in records if limiter.filter(r)]), 5)
+        error = logging.LogRecord("test", logging.ERROR, "hot.py", 10, "failed", (), None)
+        self.assertTrue(limiter.filter(error))
+        time.sleep(0.25)
+        record = logging.LogRecord("test", logging.INFO, "hot.py", 10, "miss %s", (100,), None)
+        self.assertTrue(limiter.filter(record))
+        self.assertEqual(record.getMessage(), "miss 100 (95 similar messages suppressed)")
+        log.info("written by the log writer thread")
+        logger.flush()
+
+    def test_profilers(self):
+        def busy():
+            end = time.time() + 0.2
+            while time.time() < end:
+                json.dumps({"a": range(100)})
+
+        sampler = SamplingProfiler(0.002).start()
+        worker = threading.Thread(target=busy, name="busy-worker")
+        worker.start()
+        worker.join()
+        sampler.stop()
+        folded = [line for line in sampler.folded() if line.startswith("busy-worker;")]
+        # a sample can land while the thread is still starting or finishing
+        in_busy = sum(int(line.rsplit(" ", 1)[1]) for line in folded if "busy (unittesting.py:" in line)
+        self.assertTrue(in_busy > sum(int(line.rsplit(" ", 1)[1]) for line in folded) / 2)
+
+        profiler = ThreadProfiler().start()
+        threads = [threading.Thread(target=busy) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        profiler.stop()
+        calls = [key for key in profiler.stats().stats if key[2] == "busy"]
+        self.assertEqual(profiler.stats().stats[calls[0]][0], 2)
+
+    def test_view_index_build(self):
+        couch = FakeCouch().start()
+        try:
+            server = Server(couch.url)
+            db = server.create_db("doctests-viewbench")
+            BulkWriter(db).write(DocumentGenerator.make_docs(40, {"a": "${rand_int:0:100}"}, {"size": 16}))
+            result = measure_index_build(server, db, "_design/bench", "by_a",
+                                         {"map": "function(doc) { emit(doc.a, null); }", "reduce": "_count"}, 0.01)
+            self.assertEqual((result["docs"], result["rows"]), (40, 40))
+            self.assertTrue(result["disk_size"] > 0)
+            self.assertFalse(db.doc_exist("_design/bench"))
+            self.assertEqual(indexer_progress(server, db.dbname, "_design/bench"), None)
+        finally:
+            couch.stop()
+
+    def test_view_freshness(self):
+        couch = FakeCouch().start()
+        try:
+            db = Server(couch.url).create_db("doctests-freshness")
+            probe = FreshnessProbe(db, {"docs": 20, "modes": "false,ok"})
+            probe.preload()
+            probe._start = time.time()
+            for i in range(3):
+                probe._write(i)
+            self.assertEqual(probe.probe("ok")["seq_lag"], 3)
+            self.assertEqual(probe.probe("ok")["lag_seconds"], None)
+            fresh = probe.probe("false")
+            self.assertEqual(fresh["seq_lag"], 0)
+            self.assertTrue(0 <= fresh["lag_seconds"] < 1)
+            self.assertEqual(probe.report()["modes"]["ok"]["queries"], 2)
+        finally:
+            couch.stop()
+
+    def test_view_stream(self):
+        body = '{"total_rows":3,"offset":1,"rows":[\r\n{"id":"a","key":["x",1],"value":{"s":"],\\""}},\r\n' \
+               '{"id":"b","key":null,"value":2}\r\n],"update_seq":9}\n'
+        stream = viewstream.RowStream(StringIO.StringIO(body), chunk_size=5)
+        self.assertEqual([row["id"] for row in stream], ["a", "b"])
+        self.assertEqual(stream.header, {"total_rows": 3, "offset": 1, "update_seq": 9})
+        couch = FakeCouch().start()
+        try:
+            db = Server(couch.url).create_db("doctests-stream")
+            BulkWriter(db).write(DocumentGenerator.make_docs(25, {"a": "${rand_int:0:3}"}, {"size": 16}))
+            db.save_doc({"_id": "_design/test", "views": {"by_a": {"map": "function(doc) { emit(doc.a, 1); }"}}})
+            expected = [(row["key"], row["id"]) for row in db.view("test/by_a", descending=True)]
+            paged = [(row["key"], row["id"]) for row in viewstream.rows(db, "test/by_a", page_size=4, descending=True)]
+            self.assertEqual(paged, expected)
+            self.assertEqual(len(list(viewstream.rows(db, "_all_docs", page_size=7, skip=2, limit=20))), 20)
+            self.assertEqual(viewstream.total_rows(db, "test/by_a"), 25)
+        finally:
+            couch.stop()
+
+    def test_partitioned_scan(self):
+        couch = FakeCouch().start()
+        try:
+            db = Server(couch.url).create_db("doctests-scan")
+            BulkWriter(db).write(DocumentGenerator.make_docs(100, {"a": "${rand_int:0:9}"}, {"size": 16}))
+            db.save_doc({"_id": "_design/test", "views": {"by_a": {"map": "function(doc) { emit(doc.a, 1); }",
+                                                                   "reduce": "_count"}}})
+            expected = [(row["key"], row["id"]) for row in db.view("test/by_a", reduce=False)]
+            scan = PartitionedScanner(db, "test/by_a", partitions=4, page_size=7, reduce=False)
+            self.assertEqual(len(scan.boundaries()), 3)
+            self.assertEqual([(row["key"], row["id"]) for row in scan.scan()], expected)
+            self.assertEqual(sum(scan.counts), 100)
+            unordered = PartitionedScanner(db, partitions=5, page_size=9).docs(ordered=False)
+            self.assertEqual(sorted(doc["_id"] for doc in unordered), sorted(row["id"] for row in db.all_docs()))
+        finally:
+            couch.stop()
+
+    def test_replication_verifier(self):
+        couch = FakeCouch().start()
+        try:
+            server = Server(couch.url)
+            source = server.create_db("doctests-source")
+            BulkWriter(source).write(DocumentGenerator.make_docs(60, {"a": "${rand_int:0:9}"}, {"size": 16}))
+            source.save_doc({"_id": "_design/filters", "filters": {"all": "function(doc, req) { return true; }"}})
+            server.replicate(couch.url + "doctests-source", couch.url + "doctests-target", create_target=True)
+            target = server["doctests-target"]
+            self.assertEqual(ReplicationVerifier(source, target, partitions=3, page_size=7).verify()["matched"], 60)
+            ids = sorted(row["id"] for row in source.all_docs() if not row["id"].startswith("_design/"))
+            changed = target.get(ids[5])
+            changed["a"] = "changed"
+            target.save_doc(changed)
+            target.delete_doc(ids[10])
+            target.save_doc({"_id": "zz-extra"})
+            report = ReplicationVerifier(source, target, partitions=3, page_size=7, workers=2).verify()
+            self.assertEqual((report["source"], report["target"], report["matched"]), (60, 60, 58))
+            self.assertEqual(sorted(report["divergences"]), sorted([
+                (ids[10], "missing on target"), ("zz-extra", "only on target"),
+                (ids[5], "rev {0} on source, {1} on target, fields a differ".format(source.get(ids[5])["_rev"],
+                                                                                     changed["_rev"]))]))
+        finally:
+            couch.stop()
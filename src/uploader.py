@@ -0,0 +1,203 @@
+import json
+import threading
+import time
+from couchdbkit import client
+from couchdbkit.exceptions import BulkSaveError
+from restkit.conn import Connection
+from socketpool import ConnectionPool
+from docmaker import DocRecord
+from stats import percentiles
+import connpool
+import logger
+
+log = logger.logger("BulkWriter")
+
+
+# posts an already encoded {"docs": [...]} body to _bulk_docs, the body is sent
+# as is so nothing gets encoded twice. returns the per document results.
+def post_bulk_docs(db, body):
+    return db.res.post("/_bulk_docs", payload=body,
+                       headers={"Content-Type": "application/json"}).json_body
+
+
+# returns db_name on the server at url through a connection pool of its own
+# instead of the process wide default one
+def dedicated_db(url, db_name, pool_size=1):
+    url = url.rstrip("/")
+    pool = ConnectionPool(factory=Connection, max_size=pool_size)
+    resource = connpool.PooledResource(url, pool=pool)
+    return client.Server(url, full_commit=False, resource_instance=resource)[db_name]
+
+
+# returns the results of a _bulk_docs response which were not saved
+def failed_results(results):
+    return [result for result in results if "error" in result]
+
+
+# saves any iterator of documents (dicts, DocRecords or JSON text) through
+# _bulk_docs. a batch is sent once it holds batch_size documents or
+# batch_bytes of JSON, whichever comes first. saved dicts get their _id and
+# _rev set like bulk_save does. rate_limit caps the docs/sec of one writer and
+# latencies keeps the duration of every _bulk_docs request.
+#
+# on_conflict decides what happens to documents rejected with a conflict:
+#   raise   raise BulkSaveError once the batch is done (like save_doc)
+#   skip    count them and carry on
+#   update  fetch the current revisions and save again, like force_update
+class BulkWriter(object):
+    def __init__(self, db, batch_size=500, batch_bytes=1024 * 1024, on_conflict="raise", post=post_bulk_docs,
+                 report_interval=30, rate_limit=None):
+        if on_conflict not in ("raise", "skip", "update"):
+            raise ValueError("unknown on_conflict {0}".format(on_conflict))
+        self._db = db
+        self._batch_size = batch_size
+        self._batch_bytes = batch_bytes
+        self._on_conflict = on_conflict
+        self._post = post
+        self._report_interval = report_interval
+        self._rate_limit = rate_limit
+        self.latencies = []
+        self.saved = 0
+        self.conflicts = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    # returns the number of documents saved by this call
+    def write(self, docs):
+        saved = self.saved
+        start = time.time()
+        self._last_report = start
+        batch = []
+        size = 0
+        for doc in docs:
+            text = self._encode(doc)
+            batch.append((doc, text))
+            size += len(text)
+            if len(batch) >= self._batch_size or size >= self._batch_bytes:
+                self._flush(batch)
+                batch = []
+                size = 0
+                self._throttle(start, saved)
+                self._report(start, saved)
+        if batch:
+            self._flush(batch)
+        self.elapsed += time.time() - start
+        log.info("saved {0} docs ({1} conflicts) in {2:.2f} seconds, {3:.0f} docs/sec".format(
+            self.saved - saved, self.conflicts, time.time() - start, self.rate(start, saved)))
+        return self.saved - saved
+
+    def rate(self, start=None, saved=0):
+        if start is None:
+            return self.saved / max(self.elapsed, 0.001)
+        return (self.saved - saved) / max(time.time() - start, 0.001)
+
+    def _throttle(self, start, saved):
+        if self._rate_limit:
+            ahead = (self.saved - saved) / float(self._rate_limit) - (time.time() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def _report(self, start, saved):
+        now = time.time()
+        if now - self._last_report >= self._report_interval:
+            self._last_report = now
+            log.info("saved {0} docs so far, {1:.0f} docs/sec".format(self.saved - saved, self.rate(start, saved)))
+
+    @staticmethod
+    def _encode(doc):
+        if isinstance(doc, basestring):
+            return doc
+        if isinstance(doc, DocRecord):
+            return doc.to_json()
+        return json.dumps(doc)
+
+    def _flush(self, batch, retry=True):
+        body = '{"docs": [' + ", ".join([text for doc, text in batch]) + "]}"
+        self.bytes += len(body)
+        sent = time.time()
+        results = self._post(self._db, body)
+        self.latencies.append(time.time() - sent)
+        conflicts = []
+        errors = []
+        for (doc, text), result in zip(batch, results):
+            if "error" not in result:
+                self.saved += 1
+                if isinstance(doc, dict):
+                    doc["_id"] = result["id"]
+                    doc["_rev"] = result["rev"]
+            elif result["error"] == "conflict":
+                conflicts.append((doc, text, result))
+            else:
+                errors.append(result)
+        if conflicts and self._on_conflict == "update" and retry:
+            self._flush(self._with_current_revs(conflicts), retry=False)
+        elif conflicts:
+            self.conflicts += len(conflicts)
+            if self._on_conflict != "skip":
+                errors.extend([result for doc, text, result in conflicts])
+        if errors:
+            raise BulkSaveError(errors, results)
+
+    # returns the conflicting documents as a new batch with _rev set to the
+    # revision the database currently has
+    def _with_current_revs(self, conflicts):
+        rows = self._db.all_docs(keys=[result["id"] for doc, text, result in conflicts])
+        batch = []
+        for (doc, text, result), row in zip(conflicts, rows):
+            if not isinstance(doc, dict):
+                doc = json.loads(text)
+            if "value" in row:
+                doc["_rev"] = row["value"]["rev"]
+            batch.append((doc, json.dumps(doc)))
+        return batch
+
+
+# runs one BulkWriter per document source at the same time, each on the db
+# returned by its own db_factory() call so writers do not share a connection.
+# run() returns the aggregate and per writer throughput and _bulk_docs
+# latency percentiles.
+class WriterPool(object):
+    def __init__(self, db_factory, batch_size=500, rate_limit=None, on_conflict="raise", post=post_bulk_docs):
+        self._db_factory = db_factory
+        self._post = post
+        self._batch_size = batch_size
+        self._rate_limit = rate_limit
+        self._on_conflict = on_conflict
+
+    def run(self, sources):
+        # iterated twice below, a generator would leave no source to write
+        sources = list(sources)
+        writers = [BulkWriter(self._db_factory(), batch_size=self._batch_size, rate_limit=self._rate_limit,
+                              on_conflict=self._on_conflict, post=self._post) for source in sources]
+        errors = []
+        threads = [threading.Thread(target=self._write, args=(writer, source, errors))
+                   for writer, source in zip(writers, sources)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        if errors:
+            raise errors[0]
+        report = self._summary([writer.latencies for writer in writers], sum([w.saved for w in writers]), elapsed)
+        report["writers"] = [self._summary([w.latencies], w.saved, w.elapsed) for w in writers]
+        log.info("{0} writers saved {1} docs in {2:.2f} seconds, {3:.0f} docs/sec, "
+                 "batch latency p50 {4:.3f}s p95 {5:.3f}s p99 {6:.3f}s".format(
+            len(writers), report["docs"], elapsed, report["docs_per_sec"], report["p50"] or 0,
+            report["p95"] or 0, report["p99"] or 0))
+        return report
+
+    @staticmethod
+    def _write(writer, source, errors):
+        try:
+            writer.write(source)
+        except Exception as ex:
+            errors.append(ex)
+
+    @staticmethod
+    def _summary(latencies, docs, elapsed):
+        summary = {"docs": docs, "seconds": elapsed, "docs_per_sec": docs / max(elapsed, 0.001)}
+        for p, value in percentiles(sum(latencies, [])).items():
+            summary["p{0}".format(p)] = value
+        return summary
@@ -1,4 +1,4 @@
-from couchdbkit import client, CouchdbResource
+import copy
 from couchdbkit.exceptions import ResourceConflict
 import uuid
 import time
@@ -9,8 +9,16 @@ from threading import Thread
 
 import unittest
 from nose import tools
+from nose.plugins.skip import SkipTest
 from testconfig import config
-from couchdbkit import client
+from docmaker import DocRecord
+from uploader import WriterPool, dedicated_db
+from asyncclient import AsyncServer
+import asyncclient
+from designs import MULTI_VIEW_DESIGN, MULTI_VIEW_QUERIES
+import connpool
+import profiling
+import stats
 import logger
 
 
@@ -36,7 +44,7 @@ def prepareUserDoc(user_doc, new_password=None):
     return user_doc
     
 def modify_server(settings):
-    resource = CouchdbResource()
+    resource = connpool.resource()
     for s in settings:
         confpath = "/_config/{0}/{1}".format(s["section"], s["key"])
         payload = {}
@@ -44,19 +52,19 @@ def modify_server(settings):
         info = resource.put(path=confpath, payload=payload, headers={"X-Couch-Persist": "false"})
 
 def get_userdb():
-    resource = CouchdbResource()
+    resource = connpool.resource()
     path = "/_config/couch_httpd_auth/authentication_db"
     info = resource.get(path)
     
     return info.json_body
 
 def session():
-    resource = CouchdbResource()
+    resource = connpool.resource()
     info = resource.get("/_session")
     return info.json_body
 
 def login(name, password):
-    resource = CouchdbResource()
+    resource = connpool.resource()
     info = resource.request("POST", path="/_session",
             headers = {"Content-Type": "application/json",
                        "X-CouchDB-WWW-Authenticate": "Cookie"},
@@ -65,7 +73,7 @@ def login(name, password):
     return info.json_body
 
 def logout():
-    resource = CouchdbResource()
+    resource = connpool.resource()
     info = resource.request("DELETE", "/_session", 
                             headers = {"Content-Type": "application/json",
                                        "X-CouchDB-WWW-Authenticate": "Cookie"})
@@ -87,23 +95,24 @@ def generateSecret(length):
 class UserTests(unittest.TestCase):
 
     def setUp(self):
+        stats.start_test()
+        self.profile = profiling.start_test(self.id())
         self.log = logger.logger("usertests")
         
-        url = "http://127.0.0.1:5984/"
-        self.server = client.Server(url, full_commit=False)
+        self.url = "http://127.0.0.1:5984/"
+        self.server = connpool.server(self.url)
         self.num_user = 100
         self.user_dbname = get_userdb()
         self.user_db = self.server.get_or_create_db(self.user_dbname)
 
     def tearDown(self):
+        stats.dump_test(self.id())
+        profiling.stop_test(self.profile)
         all_dbs = self.server.all_dbs()
         for db in self.server.all_dbs():
             if db.find("doctest") != -1:
                 self.server.delete_db(db)
 
-    def _upload_docs(self, db, docs):
-        db.bulk_save(docs)
-
     def _create_user_docs(self, num_user, baseid):
         docs = []
         for i in range(num_user):
@@ -111,16 +120,14 @@ class UserTests(unittest.TestCase):
             passwd = "password_{0}_{1}".format(i+baseid, name)
             doc = prepareUserDoc({"name": name, "roles": ["dev"]}, passwd)
             if not self.user_db.doc_exist(doc["_id"]) :
-                docs.append(doc)
+                docs.append(DocRecord.from_dict(doc))
         
         return docs
 
     def createUsers(self, db, num_user, num_writer):
-        for i in range(num_writer):
-            docs = self._create_user_docs(num_user, i*num_writer)
-            writer = Thread(target=self._upload_docs, args=(db, docs,))
-            writer.start()
-            writer.join()
+        sources = [self._create_user_docs(num_user, i*num_user) for i in range(num_writer)]
+        pool = WriterPool(lambda: dedicated_db(db.server_uri, db.dbname), on_conflict="skip")
+        return pool.run(sources)
 
     def actor(self, server, user, password):
         db_name = _get_db_name()
@@ -145,6 +152,32 @@ class UserTests(unittest.TestCase):
         except Exception:
             pass
 
+    # same work as actor() but the save/get/save of every document runs in its
+    # own greenlet, so all requests of one user are in flight together
+    def async_actor(self, server, user, password):
+        db = server.get_or_create_db(_get_db_name())
+        self.log.info("user:"+user+" pwd:"+password)
+        try:
+            tools.ok_(server.login(user, password).get()['ok'])
+        except Exception:
+            self.log.info("Exception launched: Name or password is incorrect")
+            pass
+
+        num_doc = 100
+        id_range = 1000
+        AsyncServer.wait([server.spawn(self._save_get_save, db.sync, i, id_range) for i in range(num_doc)])
+        try:
+            tools.ok_(server.logout().get()['ok'])
+        except Exception:
+            pass
+
+    def _save_get_save(self, db, i, id_range):
+        doc = {"_id":"id_{0}".format(i), "a":random.randint(0, id_range), "b":1}
+        res = db.save_doc(doc)
+        fetched = db.get(res['id'])
+        doc["a"] = random.randint(0,id_range)
+        res = db.save_doc(doc)
+
     def _test_multiple_users_multi_db(self):
         num_user = 1000
         num_writer = 20
@@ -160,6 +193,8 @@ class UserTests(unittest.TestCase):
     def _isodd(self, num):
         return num & 1 and True or False
 
+    _random_doc_keys = DocRecord.schema(["_id", "a", "b", "c", "type"])
+
     def _random_docs(self, howmany=1, baseid=0):
         docs = []
         for i in range(howmany):
@@ -171,8 +206,7 @@ class UserTests(unittest.TestCase):
             else:
                 type = "even"
             #have random key-values here ?
-            doc = {"_id": id, "a": v1, "b": v2, "c": str(uuid.uuid4())[:6], "type":type }
-            docs.append(doc)
+            docs.append(DocRecord(self._random_doc_keys, (id, v1, v2, str(uuid.uuid4())[:6], type)))
         return docs
 
     def _crud_db(self, db, num_docs):
@@ -188,7 +222,7 @@ class UserTests(unittest.TestCase):
                 fetched["c"] = "new field"
                 db.save_doc(fetched)
             except Exception:
-                self.log.info(id)
+                self.log.info("could not update {0}".format(id))
                 pass
         for i in range(num_del):
             id = "crud_{0}".format(del_ids[i])
@@ -197,55 +231,14 @@ class UserTests(unittest.TestCase):
             except Exception:
                 pass
 
-    def _upload_docs(self, db, docs):
-        db.bulk_save(docs)
-
-    def _quick_upload_datdabase(self, db, num_doc, num_writer):
-        for i in range(num_writer):
-            docs = self._random_docs(num_doc, i*num_doc)
-            writer = Thread(target=self._upload_docs, args=(db, docs,))
-            writer.start()
-            writer.join()
+    def _quick_upload_datdabase(self, db, num_doc, num_writer, batch_size=1000, rate_limit=None):
+        sources = [self._random_docs(num_doc, i*num_doc) for i in range(num_writer)]
+        pool = WriterPool(lambda: dedicated_db(db.server_uri, db.dbname), batch_size, rate_limit)
+        return pool.run(sources)
 
     def _multi_design_view(self, db):
         design_name = "_design/test"
-        design_doc = {
-            "_id": design_name,
-            "language": "javascript",
-            "views": {
-                "all_docs": {
-                    "map": "function(doc) { emit([doc.a, doc.b, doc.type], 1) };",
-                    "reduce": "function(keys, values) { return _count; }"
-                },
-                "multi_emit": {
-                    "map": "function(doc) {for(var i = 0 ; i < 3 ; i++) { emit(i, doc.a) ; } }"
-                },
-                "summate": {
-                    "map": "function (doc) {emit(doc.type, 1)};",
-                    "reduce": "function (keys, values) { return _count; };"
-                },
-                "get_by_a" : {
-                    "map": "function(doc) { if (doc.a > 50) emit(doc.a, 1) };"
-                },
-                "get_by_b" : {
-                    "map": "function(doc) { if (doc.b < 1000) emit(doc.b, 1) };",
-                    "reduce": "function(keys, values) { return _sum; };"
-                },
-                "get_by_c" : {
-                    "map": "function(doc) { emit(doc.c, [doc.a, doc.type]); };"
-                },
-                "get_by_ab" : {
-                    "map": "function(doc) { if (a > b) emit([doc.a, doc.b], 1); }",
-                    "reduce": "function(keys, values) { return _count; }"
-                },
-                "get_even" : {
-                    "map": """function(doc) { if (doc.type == "even") emit(null, 1);}"""
-                },
-                "get_odd" : {
-                    "map": """function(doc) { if (doc.type == "odd") emit(null, 1);}"""
-                }
-            }
-        };
+        design_doc = copy.deepcopy(MULTI_VIEW_DESIGN)
 
         if not db.doc_exist(design_name):
             db.save_doc(design_doc)
@@ -267,6 +260,46 @@ class UserTests(unittest.TestCase):
         except Exception:
             pass
             
+    def async_heavy_actor(self, server, db, user, password, total_doc):
+        self.log.info("user:"+user+" pwd:"+password)
+        try:
+            tools.ok_(server.login(user, password).get()['ok'])
+        except Exception:
+            self.log.info("Exception launched: Name or password is incorrect")
+            pass
+
+        self._async_crud_db(server, db, total_doc)
+
+        try:
+            tools.ok_(server.logout().get()['ok'])
+        except Exception:
+            pass
+
+    # _crud_db with every update and delete in its own greenlet
+    def _async_crud_db(self, server, db, num_docs):
+        num_del = random.randint(0, num_docs) / 10
+        pending = [server.spawn(self._update_doc, db.sync, "crud_{0}".format(random.randint(0, num_docs)))
+                   for i in range(num_docs)]
+        AsyncServer.wait(pending)
+        pending = [server.spawn(self._delete_doc, db.sync, "crud_{0}".format(random.randint(0, num_docs)))
+                   for i in range(num_del)]
+        AsyncServer.wait(pending)
+
+    def _update_doc(self, db, id):
+        try:
+            fetched = db.get(id)
+            fetched["c"] = "new field"
+            db.save_doc(fetched)
+        except Exception:
+            self.log.info("could not update {0}".format(id))
+            pass
+
+    def _delete_doc(self, db, id):
+        try:
+            db.delete_doc(id)
+        except Exception:
+            pass
+
     def test_multiple_users_single_db(self):
         num_user = 1
         num_writer = 2
@@ -299,4 +332,31 @@ class UserTests(unittest.TestCase):
         rows = work_db.view("test/get_by_c", group=True)
         rows = work_db.view("test/get_by_ab", group_level=1)
         rows = work_db.view("test/get_even")
-        rows = work_db.view("test/get_odd")
\ No newline at end of file
+        rows = work_db.view("test/get_odd")
+
+    def test_multiple_users_single_db_async(self):
+        if asyncclient.gevent is None:
+            raise SkipTest("gevent is not installed")
+        num_user = 1
+        num_writer = 2
+        self.createUsers(self.user_db, num_user, num_writer)
+
+        db_name = _get_db_name()
+        work_db = self.server.get_or_create_db(db_name)
+
+        num_doc = 10
+        num_writer = 2
+
+        self._quick_upload_datdabase(work_db, num_doc, num_writer)
+        self._multi_design_view(work_db)
+
+        server = AsyncServer(self.url)
+        db = server[db_name]
+        users = []
+        for i in range(self.num_user):
+            name = "user_{0}".format(i)
+            passwd = "password_{0}_{1}".format(i, name)
+            users.append(server.start_actor(self.async_heavy_actor, server, db, name, passwd, num_writer * num_doc))
+        AsyncServer.wait(users)
+
+        AsyncServer.wait([db.view(view, **params) for view, params in MULTI_VIEW_QUERIES])
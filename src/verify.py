@@ -0,0 +1,155 @@
+import Queue
+import threading
+from scanner import PartitionedScanner
+import logger
+
+log = logger.logger("verify")
+
+
+# checks the documents of a GeneratedDocuments spec against what a database
+# holds. expected documents are rebuilt page by page from the generator and
+# the stored ones fetched with one _all_docs request per page, so memory
+# depends on page_size and not on how many documents were generated.
+class DocumentVerifier(object):
+    def __init__(self, docs, page_size=500, max_reported=100):
+        self._docs = docs
+        self._page_size = page_size
+        self._max_reported = max_reported
+
+    # returns (number of documents checked, [(doc id, reason)]) with at most
+    # max_reported mismatches listed
+    def verify(self, db):
+        checked = 0
+        mismatches = []
+        for expected in self._docs.regenerate().batches(self._page_size):
+            ids = [doc["_id"] for doc in expected]
+            rows = db.all_docs(keys=ids, include_docs=True)
+            for doc, row in zip(expected, rows):
+                checked += 1
+                reason = self._compare(doc, row)
+                if reason and len(mismatches) < self._max_reported:
+                    mismatches.append((doc["_id"], reason))
+        return checked, mismatches
+
+    @staticmethod
+    def _compare(expected, row):
+        if "error" in row:
+            return row["error"]
+        stored = row.get("doc")
+        if stored is None:
+            return "deleted"
+        for k in expected:
+            if k not in stored:
+                return "missing field {0}".format(k)
+            if stored[k] != expected[k]:
+                return "field {0} differs".format(k)
+        return None
+
+
+# checks that target holds the same documents as source, as replication
+# should have left them. the id and rev of every document are listed from
+# the _all_docs of both at once, each with a PartitionedScanner, and merged
+# in id order. only the documents whose revs differ have their bodies
+# fetched, page_size at a time by workers threads, to tell which fields
+# differ. every divergence is reported, not just the first. design
+# documents are left out unless include_design is true, a filtered
+# replication does not copy them.
+class ReplicationVerifier(object):
+    def __init__(self, source, target, partitions=None, page_size=500, workers=4, include_design=False):
+        self._source = source
+        self._target = target
+        self._partitions = partitions
+        self._page_size = page_size
+        self._workers = workers
+        self._include_design = include_design
+
+    # returns {"source": docs in source, "target": docs in target, "matched":
+    # docs with the same rev in both, "divergences": [(doc id, reason)]}
+    def verify(self):
+        report = {"source": 0, "target": 0, "matched": 0, "divergences": []}
+        differing = []
+        for source, target in self._merge(self._listing(self._source), self._listing(self._target)):
+            if source is None:
+                report["target"] += 1
+                report["divergences"].append((target["id"], "only on target"))
+            elif target is None:
+                report["source"] += 1
+                report["divergences"].append((source["id"], "missing on target"))
+            else:
+                report["source"] += 1
+                report["target"] += 1
+                if source["value"]["rev"] == target["value"]["rev"]:
+                    report["matched"] += 1
+                else:
+                    differing.append((source["id"], source["value"]["rev"], target["value"]["rev"]))
+        report["divergences"].extend(self._compare_bodies(differing))
+        log.info("{0} docs in {1}, {2} in {3}, {4} with the same rev, {5} divergences{6}".format(
+            report["source"], self._source.dbname, report["target"], self._target.dbname, report["matched"],
+            len(report["divergences"]), ": {0}".format(report["divergences"][:20]) if report["divergences"] else ""))
+        return report
+
+    def _listing(self, db):
+        rows = PartitionedScanner(db, partitions=self._partitions, page_size=self._page_size).scan()
+        return (row for row in rows if self._include_design or not row["id"].startswith("_design/"))
+
+    # pairs the rows of two id ordered listings, (row, None) or (None, row)
+    # for ids only one of them has
+    @staticmethod
+    def _merge(sources, targets):
+        source, target = next(sources, None), next(targets, None)
+        while source is not None or target is not None:
+            if target is None or (source is not None and source["id"] < target["id"]):
+                yield source, None
+                source = next(sources, None)
+            elif source is None or target["id"] < source["id"]:
+                yield None, target
+                target = next(targets, None)
+            else:
+                yield source, target
+                source, target = next(sources, None), next(targets, None)
+
+    def _compare_bodies(self, differing):
+        batches = Queue.Queue()
+        for i in range(0, len(differing), self._page_size):
+            batches.put(differing[i:i + self._page_size])
+        divergences = []
+        errors = []
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                try:
+                    batch = batches.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    found = self._compare_batch(batch)
+                except Exception as e:
+                    errors.append(e)
+                    return
+                with lock:
+                    divergences.extend(found)
+        workers = [threading.Thread(target=work) for i in range(min(self._workers, batches.qsize()))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # a batch that could not be compared must not pass for one that matched
+        if errors:
+            raise errors[0]
+        return sorted(divergences)
+
+    def _compare_batch(self, batch):
+        ids = [doc_id for doc_id, source_rev, target_rev in batch]
+        sources = self._source.all_docs(keys=ids, include_docs=True)
+        targets = self._target.all_docs(keys=ids, include_docs=True)
+        found = []
+        for (doc_id, source_rev, target_rev), source, target in zip(batch, sources, targets):
+            fields = self._differing_fields(source.get("doc") or {}, target.get("doc") or {})
+            found.append((doc_id, "rev {0} on source, {1} on target, {2}".format(
+                source_rev, target_rev, "fields {0} differ".format(", ".join(fields)) if fields else "same body")))
+        return found
+
+    @staticmethod
+    def _differing_fields(source, target):
+        return sorted(k for k in set(source) | set(target) if k != "_rev" and source.get(k) != target.get(k))
@@ -5,8 +5,9 @@ import uuid
 import hashlib
 import time
 from testconfig import config
-from couchdbkit import client
 from couchdbkit.exceptions import ResourceConflict
+import connpool
+import stats
 import logger
 
 class BasicTests(unittest.TestCase):
@@ -14,13 +15,15 @@ class BasicTests(unittest.TestCase):
     cleanup_dbs = []
 
     def setUp(self):
+        stats.start_test()
         node = config['couchdb-local']
         self.log = logger.logger("viewtest")
         url = "http://{0}:{1}/".format(node['ip'], node['port'])
-        self.server = client.Server(url, full_commit=False)
+        self.server = connpool.server(url)
         self.node = node
 
     def tearDown(self):
+        stats.dump_test(self.id())
         for db in self.cleanup_dbs:
             try:
                 self.server.delete_db(db)
@@ -0,0 +1,134 @@
+import json
+import re
+import threading
+import time
+import unittest
+import uuid
+from testconfig import config
+from docmaker import DocumentGenerator
+from designs import MULTI_VIEW_DESIGN, design_info
+from uploader import BulkWriter
+import connpool
+import stats
+import logger
+
+log = logger.logger("ViewIndexBenchmark")
+
+# [viewbench] settings in tests.ini and their defaults. sizes are the document
+# counts the indexes are built at, poll the seconds between two looks at
+# _active_tasks, timeout the longest one index build may take.
+defaults = {"sizes": "10000,50000,200000", "poll": 0.5, "timeout": 3600, "results": "viewbench-results.jsonl"}
+
+
+# (changes done, total changes) of the indexer building design in db_name, or
+# None when it is not running. couchdb 1.2 and later report the counts as
+# fields, 1.0 and 1.1 only as "Processed n of m changes (p%)"
+def indexer_progress(server, db_name, design_id):
+    for task in server.active_tasks():
+        if "changes_done" in task and task.get("database") == db_name and task.get("design_document") == design_id:
+            return task["changes_done"], task["total_changes"]
+        if task.get("task") == "{0} {1}".format(db_name, design_id):
+            match = re.match(r"Processed (\d+) of (\d+)", task.get("status", ""))
+            if match:
+                return int(match.group(1)), int(match.group(2))
+    return None
+
+
+# saves view in a design document of its own, as couchdb builds all the views
+# of a design document together, queries it so the index is built and polls
+# _active_tasks until the query returns. the index is then as big as _info
+# says and rows tells how many rows it has. the design document is deleted
+# again so that the next build sees the same documents.
+def measure_index_build(server, db, design_id, name, view, poll=0.5, timeout=3600):
+    docs = db.info()["doc_count"]
+    design = {"_id": design_id, "language": "javascript", "views": {name: view}}
+    db.save_doc(design)
+    params = {"reduce": False} if "reduce" in view else {}
+    result = {}
+
+    def build():
+        try:
+            result["rows"] = db.view("{0}/{1}".format(design_id[8:], name), limit=0, **params).total_rows
+        except Exception as e:
+            result["error"] = e
+    builder = threading.Thread(target=build, name="index-build")
+    builder.daemon = True
+    start = time.time()
+    builder.start()
+    progress = []
+    while builder.is_alive() and time.time() - start < timeout:
+        done = indexer_progress(server, db.dbname, design_id)
+        if done is not None:
+            progress.append((round(time.time() - start, 3),) + done)
+            log.info("{0} {1}: processed {2} of {3} changes".format(name, docs, done[0], done[1]))
+        builder.join(poll)
+    seconds = time.time() - start
+    if builder.is_alive():
+        raise Exception("index of {0} was not built after {1} seconds".format(name, timeout))
+    if "error" in result:
+        raise result["error"]
+    info = design_info(db, design_id)
+    db.delete_doc(design)
+    return {"view": name, "docs": docs, "seconds": seconds, "docs_per_sec": docs / max(seconds, 0.001),
+            "rows": result["rows"], "disk_size": info.get("disk_size"), "progress": progress}
+
+
+# how long the views of MULTI_VIEW_DESIGN take to index from scratch, with the
+# docs/sec indexed and the index size, at each of the growing sizes: the
+# documents are topped up to the next size and every view is built again
+# under a new design document. one json line per view and size goes to the
+# results file, the scaling curve of each view is logged at the end.
+class ViewIndexBenchmark(unittest.TestCase):
+    cleanup_dbs = []
+
+    def setUp(self):
+        stats.start_test()
+        self.node = config['couchdb-local']
+        self.params = dict(defaults, **config.get("viewbench", {}))
+        self.log = log
+        self.server = connpool.server(self.node)
+
+    def tearDown(self):
+        stats.dump_test(self.id())
+        for db in self.cleanup_dbs:
+            try:
+                self.server.delete_db(db)
+            except Exception:
+                pass
+        self.cleanup_dbs = []
+
+    def _get_db_name(self):
+        name = "doctests-{0}".format(str(uuid.uuid4())[:6])
+        self.cleanup_dbs.append(name)
+        return name
+
+    def test_index_build_scaling(self):
+        sizes = sorted(int(size) for size in str(self.params["sizes"]).split(",") if size.strip())
+        db = self.server.create_db(self._get_db_name())
+        # half even and half odd documents, like benchmark.py loads
+        template = {"a": "${rand_int:0:100}", "b": "${rand_int:0:10000}", "c": "${uuid}", "payload": "${padding}"}
+        halves = [DocumentGenerator.make_docs(sizes[-1] / 2 + 1, dict(template, type=type),
+                                              {"size": 1024, "seed": type}) for type in ("even", "odd")]
+        loaded = 0
+        curves = {}
+        for size in sizes:
+            writer = BulkWriter(db)
+            writer.write(halves[0][loaded / 2:size / 2])
+            writer.write(halves[1][loaded - loaded / 2:size - size / 2])
+            loaded = size
+            for name, view in sorted(MULTI_VIEW_DESIGN["views"].items()):
+                result = measure_index_build(self.server, db, "_design/bench_{0}_{1}".format(name, size), name, view,
+                                             float(self.params["poll"]), float(self.params["timeout"]))
+                self.log.info("{view} at {docs} docs: {seconds:.2f}s, {docs_per_sec:.0f} docs/sec, {rows} rows, "
+                              "{disk_size} bytes".format(**result))
+                with open(self.params["results"], "a") as f:
+                    f.write(json.dumps(dict(result, time=time.time(), size=size)) + "\n")
+                curves.setdefault(name, []).append(result)
+                self.assertEqual(result["docs"], size)
+        for name, results in sorted(curves.items()):
+            first = results[0]
+            # 1.0 keeps the docs/sec of the smallest size, below 1.0 indexing
+            # gets slower per document as the database grows
+            self.log.info("{0}: {1}".format(name, ", ".join(
+                "{0} docs {1:.2f}s x{2:.2f}".format(r["docs"], r["seconds"], r["docs_per_sec"] / first["docs_per_sec"])
+                for r in results)))
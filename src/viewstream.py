@@ -0,0 +1,146 @@
+import json
+import re
+
+# reads view and _all_docs responses row by row as they arrive instead of
+# parsing the whole body at once, and pages through big results with
+# startkey/startkey_docid so no request returns more than page_size rows.
+# memory then stays the same however many rows a scan goes through.
+#
+#   for row in viewstream.rows(db, "test/get_by_a", page_size=1000):
+#       ...
+#   viewstream.total_rows(db)
+
+_SEPARATORS = re.compile(r"[\s,]*")
+_decoder = json.JSONDecoder()
+
+
+def view_path(view):
+    if view == "_all_docs":
+        return view
+    design, name = view.split("/", 1)
+    return "_design/{0}/_view/{1}".format(design, name)
+
+
+# iterates over the rows of a view response read from body chunk_size bytes
+# at a time. the fields around the rows (total_rows, offset, update_seq) are
+# in header, the ones couchdb sends before the rows as soon as the first row
+# is read and any that come after them once the last one is.
+class RowStream(object):
+    def __init__(self, body, chunk_size=64 * 1024, close=None):
+        self._body = body
+        self._chunk_size = chunk_size
+        self._close = close
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self.done = False
+        self.header = {}
+        self._rows = self._parse()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._rows)
+
+    @property
+    def total_rows(self):
+        return self.header.get("total_rows")
+
+    # gives the connection up when the rows were not all read
+    def close(self):
+        if not self.done and self._close:
+            self._close()
+        self.done = True
+
+    def _read(self):
+        chunk = self._body.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _skip_separators(self):
+        while True:
+            self._pos = _SEPARATORS.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._read():
+                return
+
+    def _parse(self):
+        start = -1
+        while start < 0:
+            start = self._buffer.find('"rows"')
+            if start < 0 and not self._read():
+                # no rows at all, e.g. an error
+                self.header.update(json.loads(self._buffer or "{}"))
+                self.done = True
+                return
+        self.header.update(json.loads(self._buffer[:start].rstrip().rstrip(",") + "}"))
+        while self._buffer.find("[", start) < 0:
+            if not self._read():
+                raise ValueError("truncated view response")
+            start = self._buffer.find('"rows"')
+        self._pos = self._buffer.find("[", start) + 1
+        while True:
+            self._skip_separators()
+            if self._buffer.startswith("]", self._pos):
+                break
+            try:
+                row, self._pos = _decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if not self._read():
+                    raise ValueError("truncated view response")
+                continue
+            yield row
+        rest = self._buffer[self._pos + 1:]
+        self._buffer, self._pos = "", 0
+        while self._read():
+            rest += self._buffer
+            self._buffer = ""
+        rest = rest.strip().lstrip(",")
+        if rest != "}":
+            self.header.update(json.loads("{" + rest))
+        self.done = True
+
+
+# one request for the rows of view ("design/name" or "_all_docs") as a
+# RowStream. params are the usual view parameters.
+def stream(db, view, chunk_size=64 * 1024, **params):
+    response = db.res.get(view_path(view), **params)
+    return RowStream(response.body_stream(), chunk_size, response.close)
+
+
+# the rows of view with every request limited to page_size rows. each page
+# asks for one row more than it returns, the first row of the next page,
+# whose key and id (for rows with the same key) the next page starts from
+# so no row is skipped or read twice. limit and skip apply to the whole scan.
+def rows(db, view, page_size=1000, **params):
+    limit = params.pop("limit", None)
+    returned = 0
+    while limit is None or returned < int(limit):
+        count = page_size if limit is None else min(page_size, int(limit) - returned)
+        page = stream(db, view, limit=count + 1, **params)
+        params.pop("skip", None)
+        following = None
+        try:
+            for i, row in enumerate(page):
+                if i == count:
+                    following = row
+                else:
+                    yield row
+                    returned += 1
+        finally:
+            page.close()
+        if following is None:
+            return
+        params["startkey"] = following["key"]
+        if "id" in following and view != "_all_docs":
+            params["startkey_docid"] = following["id"]
+
+
+# the row count of _all_docs or of a view (with reduce=False when it has a
+# reduce) without any rows sent
+def total_rows(db, view="_all_docs", **params):
+    return db.res.get(view_path(view), limit=0, **params).json_body["total_rows"]
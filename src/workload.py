@@ -0,0 +1,205 @@
+import random
+import threading
+import time
+from couchdbkit.exceptions import ResourceConflict, ResourceNotFound
+from docmaker import DocumentGenerator
+from stats import LatencyHistogram
+from uploader import BulkWriter
+import logger
+
+log = logger.logger("workload")
+
+OPERATIONS = ("read", "insert", "update", "delete", "view", "attachment")
+
+# [workload] settings in tests.ini and their defaults. the operation weights
+# are relative, keys is uniform, zipf or latest.
+defaults = {"read": 50, "insert": 15, "update": 20, "delete": 5, "view": 5, "attachment": 5,
+            "keys": "uniform", "zipf_s": 1.2, "workers": 8, "interval": 10, "doc_size": 1024}
+
+DESIGN = {
+    "_id": "_design/workload",
+    "language": "javascript",
+    "views": {
+        "by_name": {"map": "function(doc) { if (doc.name) emit(doc.name, null); }"}
+    }
+}
+
+
+# picks which existing document an operation works on, out of the first n
+# documents of the generator:
+#   uniform  every document alike
+#   zipf     a power law with exponent zipf_s over the oldest documents, a
+#            handful of hot keys get most of the traffic
+#   latest   the same power law over the newest documents
+class KeyChooser(object):
+    def __init__(self, distribution="uniform", zipf_s=1.2):
+        if distribution not in ("uniform", "zipf", "latest"):
+            raise ValueError("unknown key distribution {0}".format(distribution))
+        self.distribution = distribution
+        self.zipf_s = float(zipf_s)
+
+    # inverse transform of the continuous power law x^-s on [1, n+1)
+    def _rank(self, n, rng):
+        s = self.zipf_s
+        if s == 1.0:
+            x = (n + 1) ** rng.random()
+        else:
+            x = (((n + 1) ** (1 - s) - 1) * rng.random() + 1) ** (1 / (1 - s))
+        return min(int(x) - 1, n - 1)
+
+    def choose(self, n, rng=random):
+        if self.distribution == "uniform":
+            return rng.randrange(n)
+        rank = self._rank(n, rng)
+        return rank if self.distribution == "zipf" else n - 1 - rank
+
+
+# runs a weighted mix of read, insert, update, delete, view and attachment
+# operations against db from several workers. the documents are docs[i] of a
+# generator, the first preload of them bulk loaded up front and inserts
+# adding the next ones. every interval seconds the throughput and latency of
+# each operation over that interval is logged and kept in timeline.
+class Workload(object):
+    def __init__(self, db, params=None, seed=None):
+        self.params = dict(defaults, **(params or {}))
+        self.db = db
+        self.weights = [(op, float(self.params[op])) for op in OPERATIONS if float(self.params[op]) > 0]
+        self.keys = KeyChooser(self.params["keys"], self.params["zipf_s"])
+        self.docs = DocumentGenerator.make_docs(2 ** 31, {"name": "user-${prefix}", "payload": "${padding}"},
+                                                {"size": int(self.params["doc_size"]), "seed": seed})
+        self.timeline = []
+        self._lock = threading.Lock()
+        self._inserted = 0
+        self._deleted = set()
+        self._interval = {}
+        self.totals = {}
+
+    def preload(self, items):
+        BulkWriter(self.db, on_conflict="skip").write(self.docs[0:items])
+        self._inserted = items
+        if not self.db.doc_exist(DESIGN["_id"]):
+            self.db.save_doc(dict(DESIGN))
+
+    # runs for duration seconds, or until operations operations are done
+    def run(self, duration=None, operations=None):
+        self._remaining = operations
+        self._finish = time.time() + duration if duration else None
+        self._start = self._last_report = time.time()
+        workers = [threading.Thread(target=self._work, args=(random.Random(),))
+                   for i in range(int(self.params["workers"]))]
+        for worker in workers:
+            worker.start()
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(0.5)
+            if time.time() - self._last_report >= float(self.params["interval"]):
+                self._report()
+        self._report()
+        return self.report()
+
+    def _pick(self, rng):
+        point = rng.random() * sum(weight for op, weight in self.weights)
+        for op, weight in self.weights:
+            point -= weight
+            if point < 0:
+                return op
+        return self.weights[-1][0]
+
+    def _more(self):
+        with self._lock:
+            if self._finish and time.time() >= self._finish:
+                return False
+            if self._remaining is not None:
+                if self._remaining <= 0:
+                    return False
+                self._remaining -= 1
+            return True
+
+    def _work(self, rng):
+        while self._more():
+            op = self._pick(rng)
+            start = time.time()
+            outcome = "ok"
+            try:
+                getattr(self, "_" + op)(rng)
+            except ResourceNotFound:
+                outcome = "missing"
+            except ResourceConflict:
+                outcome = "conflict"
+            except Exception as e:
+                outcome = "error"
+                log.debug("{0} failed: {1}".format(op, e))
+            self._record(op, time.time() - start, outcome)
+
+    def _key(self, rng):
+        with self._lock:
+            n = self._inserted
+        if not n:
+            raise ResourceNotFound("no documents yet")
+        return self.docs[self.keys.choose(n, rng)]["_id"]
+
+    def _read(self, rng):
+        self.db.open_doc(self._key(rng))
+
+    def _insert(self, rng):
+        with self._lock:
+            i = self._inserted
+            self._inserted += 1
+            doc = self.docs[i]
+        self.db.save_doc(doc)
+
+    def _update(self, rng):
+        doc = self.db.open_doc(self._key(rng))
+        doc["updated"] = time.time()
+        self.db.save_doc(doc)
+
+    def _delete(self, rng):
+        doc_id = self._key(rng)
+        self.db.delete_doc(self.db.open_doc(doc_id))
+        with self._lock:
+            self._deleted.add(doc_id)
+
+    def _view(self, rng):
+        self.db.view("workload/by_name", startkey="user-{0}".format(rng.randrange(self._inserted or 1)),
+                     limit=10).all()
+
+    def _attachment(self, rng):
+        doc = self.db.open_doc(self._key(rng))
+        self.db.put_attachment(doc, DocumentGenerator.create_value("attachment ", 1024), "workload", "text/plain")
+
+    def _record(self, op, seconds, outcome):
+        with self._lock:
+            for counters in (self._interval, self.totals):
+                entry = counters.get(op)
+                if entry is None:
+                    entry = counters[op] = {"latency": LatencyHistogram(), "ok": 0, "missing": 0, "conflict": 0,
+                                            "error": 0}
+                entry["latency"].record(seconds)
+                entry[outcome] += 1
+
+    def _report(self):
+        with self._lock:
+            interval, self._interval = self._interval, {}
+        now = time.time()
+        elapsed = max(now - self._last_report, 0.001)
+        self._last_report = now
+        point = {"time": now - self._start, "seconds": elapsed}
+        for op, entry in sorted(interval.items()):
+            point[op] = self._summary(entry, elapsed)
+            log.info("{0:.0f}s {1}: {2:.1f} ops/sec, p99 {3}s, {4} missing, {5} conflicts, {6} errors".format(
+                point["time"], op, point[op]["ops_per_sec"], point[op]["p99"], entry["missing"], entry["conflict"],
+                entry["error"]))
+        self.timeline.append(point)
+
+    @staticmethod
+    def _summary(entry, elapsed):
+        summary = entry["latency"].summary(elapsed)
+        for outcome in ("ok", "missing", "conflict", "error"):
+            summary[outcome] = entry[outcome]
+        return summary
+
+    def report(self):
+        elapsed = max(time.time() - self._start, 0.001)
+        return {"seconds": elapsed, "documents": self._inserted - len(self._deleted),
+                "operations": dict((op, self._summary(entry, elapsed)) for op, entry in self.totals.items()),
+                "timeline": self.timeline}